@@ -0,0 +1,532 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark the snapshot pipeline (rsync.run and snapshot.run) on a synthetic
+source tree. Each cycle changes a part of the source tree, syncs it into
+'backup.latest' and creates a new snapshot from it.
+
+Run it from the root of the repo: python -m benchmarks.snapshot_pipeline
+
+Usage:
+    snapshot_pipeline [options]
+    snapshot_pipeline -h | --help
+
+Options:
+    --dir PATH              Work dir, by default a temp dir that is removed.
+    --files N               Files in the source tree [default: 10000].
+    --depth N               Dir levels below the source root [default: 3].
+    --files-per-dir N       Files per leaf dir [default: 100].
+    --size-median BYTES     Median of the file sizes [default: 4096].
+    --size-sigma S          Spread of the log-normal file sizes [default: 1.5].
+    --size-max BYTES        Largest file size [default: 16777216].
+    --change-rate R         Part of the files to change per cycle [default: 0.01].
+    --cycles N              Snapshot cycles to run [default: 5].
+    --keep-amount N         Snapshots to keep, older ones are pruned [default: 3].
+    --engine ENGINE         'native' or 'cp' [default: native].
+    --rotation MODE         'shift' or 'stable' [default: shift].
+    --share                 Share one tree between the snapshots of a cycle.
+    --snapshots NAMES       Snapshots per cycle, comma separated [default: hourly].
+    --seed N                Seed of the random tree [default: 1].
+    --no-syscalls           Don't count syscalls, for undisturbed timings.
+    --output FILE           Write the results to this JSON file.
+    --compare FILE          Compare the phase timings with an earlier result.
+    --keep                  Keep the work dir.
+    -h, --help              Show this screen.
+
+Syscalls are counted by wrapping the functions of the 'os' module, so only
+the native hardlink engine reports them, 'cp' and 'rsync' run in their own
+processes.
+"""
+
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Iterator, Optional
+
+from docopt import docopt
+
+from vhpi import config, job, rsync, snapshot, stats, timestamp_store, trash
+from vhpi.app import _get_version
+from vhpi.types import App
+
+# The 'os' functions that are counted as syscalls.
+_COUNTED_CALLS = (
+    "chmod",
+    "chown",
+    "link",
+    "listdir",
+    "lstat",
+    "mkdir",
+    "readlink",
+    "rename",
+    "replace",
+    "rmdir",
+    "scandir",
+    "stat",
+    "symlink",
+    "unlink",
+    "utime",
+)
+
+# File contents are sliced from this block, the content does not matter for
+# the benchmark.
+_BLOCK = random.Random(0).randbytes(1024 * 1024)
+
+_PHASES = ("rsync", "hardlink", "shift", "timestamp", "prune")
+
+
+@dataclass
+class TreeParams:
+    files: int
+    depth: int
+    files_per_dir: int
+    size_median: int
+    size_sigma: float
+    size_max: int
+    change_rate: float
+    seed: int
+
+
+@dataclass
+class Changes:
+    modified: int = 0
+    added: int = 0
+    deleted: int = 0
+
+
+class SyscallCounter:
+    """
+    Count the calls of the 'os' functions in _COUNTED_CALLS, from all threads,
+    while it is active.
+    """
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._originals: dict[str, Any] = {}
+
+    def _wrap(self, name: str, func):
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.counts[name] += 1
+
+            return func(*args, **kwargs)
+
+        return counted
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self.counts)
+
+    def __enter__(self) -> "SyscallCounter":
+        for name in _COUNTED_CALLS:
+            self._originals[name] = getattr(os, name)
+            setattr(os, name, self._wrap(name, self._originals[name]))
+
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for name, func in self._originals.items():
+            setattr(os, name, func)
+
+        self._originals.clear()
+
+
+@contextmanager
+def _count_phases(
+    counter: Optional[SyscallCounter],
+    phase_calls: dict[str, Counter],
+) -> Iterator[None]:
+    """
+    Attribute the counted syscalls to the phases of stats.phase(). Phases
+    that run several times per cycle (e.g. 'shift' per snapshot) are summed.
+    """
+    original = stats.phase
+
+    @contextmanager
+    def phase(job_stats, name):
+        before = counter.snapshot() if counter else Counter()
+
+        with original(job_stats, name):
+            yield
+
+        if counter:
+            phase_calls.setdefault(name, Counter()).update(counter.snapshot() - before)
+
+    stats.phase = phase
+
+    try:
+        yield
+
+    finally:
+        stats.phase = original
+
+
+def _get_size(rng: random.Random, params: TreeParams) -> int:
+    size = rng.lognormvariate(math.log(max(1, params.size_median)), params.size_sigma)
+
+    return min(params.size_max, int(size))
+
+
+def _write_file(path: str, size: int) -> None:
+    with open(path, "wb") as f:
+        while size > 0:
+            chunk = _BLOCK[: min(size, len(_BLOCK))]
+            f.write(chunk)
+            size -= len(chunk)
+
+
+def _get_leaf_dirs(src: str, params: TreeParams) -> list[str]:
+    leaf_count = max(1, math.ceil(params.files / max(1, params.files_per_dir)))
+
+    if params.depth <= 0:
+        return [src]
+
+    fanout = max(1, math.ceil(leaf_count ** (1 / params.depth)))
+    dirs = [src]
+
+    for level in range(params.depth):
+        dirs = [f"{dir_}/d{level}_{i}" for dir_ in dirs for i in range(fanout)]
+
+    return dirs[:leaf_count]
+
+
+def generate_tree(src: str, params: TreeParams, rng: random.Random) -> list[str]:
+    """
+    Create a source tree with 'params.files' files below 'src', spread
+    evenly across the leaf dirs. Returns the paths of the files.
+    """
+    dirs = _get_leaf_dirs(src, params)
+    files = []
+
+    for dir_ in dirs:
+        os.makedirs(dir_, exist_ok=True)
+
+    for i in range(params.files):
+        path = f"{dirs[i % len(dirs)]}/f{i}"
+        _write_file(path, _get_size(rng, params))
+        files.append(path)
+
+    return files
+
+
+def change_tree(
+    files: list[str],
+    params: TreeParams,
+    rng: random.Random,
+    cycle: int,
+) -> Changes:
+    """
+    Modify, add and delete files in the ratio 2:1:1, so that 'change_rate' of
+    the files differ from the previous cycle.
+    """
+    changes = Changes()
+    amount = min(len(files), round(len(files) * params.change_rate))
+
+    for path in rng.sample(files, amount):
+        choice = rng.random()
+
+        if choice < 0.5:
+            _write_file(path, _get_size(rng, params))
+            changes.modified += 1
+
+        elif choice < 0.75:
+            new_path = f"{path}_c{cycle}"
+            _write_file(new_path, _get_size(rng, params))
+            files.append(new_path)
+            changes.added += 1
+
+        else:
+            os.unlink(path)
+            files.remove(path)
+            changes.deleted += 1
+
+    return changes
+
+
+def _get_app(work_dir: str) -> App:
+    return App(
+        version=_get_version(),
+        home_dir=work_dir,
+        root_dir=os.path.dirname(config.__file__),
+        cfg_dir=f"{work_dir}/cfg",
+        cfg_file=f"{work_dir}/cfg/vhpi_cfg.yaml",
+        log_dir=f"{work_dir}/logs",
+        timestamp_file_name=".backup_timestamps",
+        state_dir_name=".vhpi",
+        timestamp_format="%Y-%m-%d %H:%M:%S",
+    )
+
+
+def _get_user_cfg(args: dict[str, Any], src: str, dst: str) -> dict[str, Any]:
+    names = [name.strip() for name in args["--snapshots"].split(",") if name.strip()]
+    keep_amount = int(args["--keep-amount"])
+
+    return {
+        "app_cfg": {
+            "intervals": {name: 0 for name in names},
+            "hardlink_engine": args["--engine"],
+            "snapshot_rotation": args["--rotation"],
+            "share_snapshots": bool(args["--share"]),
+        },
+        "jobs": [
+            {
+                "name": "benchmark",
+                "rsync_src": f"{src}/",
+                "rsync_dst": dst,
+                "rsync_options": "--archive --delete",
+                "snapshots": {name: keep_amount for name in names},
+            }
+        ],
+    }
+
+
+def _count_inodes(path: str) -> dict[str, int]:
+    """
+    Count the entries and the distinct inodes of a tree.
+    """
+    entries = 0
+    inodes = set()
+    stack = [path]
+
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            st = entry.stat(follow_symlinks=False)
+            entries += 1
+            inodes.add(st.st_ino)
+
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+
+    return {"entries": entries, "inodes": len(inodes)}
+
+
+def _wait_for_trash(state_dir: str, timeout: float = 600) -> None:
+    trash_dir = trash.get_trash_dir(state_dir)
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if not os.path.isdir(trash_dir) or not os.listdir(trash_dir):
+            return
+
+        time.sleep(0.1)
+
+
+def _run_cycle(
+    app: App,
+    cfg,
+    counter: Optional[SyscallCounter],
+    changes: Changes,
+) -> dict[str, Any]:
+    plan = cfg.jobs[0]
+    job_ = job.get_job(app, plan, cfg)
+
+    snapshots = [
+        snapshot.get_snapshot(app, job_, name, keep_amount, 0)
+        for name, keep_amount in plan.snapshots.items()
+    ]
+
+    phase_calls: dict[str, Counter] = {}
+    start = time.monotonic()
+
+    with _count_phases(counter, phase_calls):
+        ok = rsync.run(app, job_)
+
+        if ok:
+            snapshot.run(app, job_, snapshots)
+
+    return {
+        "ok": ok,
+        "duration": round(time.monotonic() - start, 3),
+        "changes": asdict(changes),
+        "phases": dict(job_.stats.phases),
+        "syscalls": {name: dict(calls) for name, calls in phase_calls.items()},
+        "rsync": asdict(job_.stats.rsync) if job_.stats.rsync else None,
+    }
+
+
+def _summarize(cycles: list[dict[str, Any]]) -> dict[str, Any]:
+    """
+    Get the median and the range of the phase durations. The first cycle
+    syncs the whole tree and is left out, if there are others.
+    """
+    measured = cycles[1:] or cycles
+    summary = {}
+
+    for name in _PHASES:
+        values = [c["phases"][name] for c in measured if name in c["phases"]]
+
+        if values:
+            summary[name] = {
+                "median": round(statistics.median(values), 3),
+                "min": min(values),
+                "max": max(values),
+            }
+
+    return summary
+
+
+def _print_report(result: dict[str, Any], previous: Optional[dict[str, Any]]):
+    print(f"\n{'cycle':>5} {'total':>8} " + " ".join(f"{p:>9}" for p in _PHASES))
+
+    for i, cycle in enumerate(result["cycles"]):
+        phases = " ".join(f"{cycle['phases'].get(p, 0):>9.3f}" for p in _PHASES)
+        print(f"{i:>5} {cycle['duration']:>8.3f} {phases}")
+
+    print("\nMedian of the incremental cycles:")
+
+    for name, values in result["summary"].items():
+        line = f"    {name:<10} {values['median']:>9.3f}s"
+        before = (previous or {}).get("summary", {}).get(name)
+
+        if before and before["median"]:
+            line += f"  ({values['median'] / before['median']:.2f}x of before)"
+
+        print(line)
+
+    last = result["cycles"][-1]["syscalls"]
+
+    if last:
+        print("\nSyscalls of the last cycle:")
+
+        for name, calls in last.items():
+            counts = ", ".join(f"{call}={n}" for call, n in sorted(calls.items()))
+            print(f"    {name:<10} {counts}")
+
+
+def run(args: dict[str, Any]) -> dict[str, Any]:
+    params = TreeParams(
+        files=int(args["--files"]),
+        depth=int(args["--depth"]),
+        files_per_dir=int(args["--files-per-dir"]),
+        size_median=int(args["--size-median"]),
+        size_sigma=float(args["--size-sigma"]),
+        size_max=int(args["--size-max"]),
+        change_rate=float(args["--change-rate"]),
+        seed=int(args["--seed"]),
+    )
+
+    work_dir = args["--dir"] or tempfile.mkdtemp(prefix="vhpi-bench-")
+    src = f"{work_dir}/src"
+    dst = f"{work_dir}/dst"
+    app = _get_app(work_dir)
+    rng = random.Random(params.seed)
+
+    for dir_ in (src, dst, app.cfg_dir, app.log_dir):
+        os.makedirs(dir_, exist_ok=True)
+
+    # Let trashed snapshots be deleted as fast as possible.
+    trash.reclaimer.pause = 0
+
+    print(f"Generate {params.files} files in: {src}")
+    start = time.monotonic()
+    files = generate_tree(src, params, rng)
+    generate_duration = round(time.monotonic() - start, 3)
+
+    cfg = config.parse(app, _get_user_cfg(args, src, dst))
+
+    if not cfg.jobs:
+        sys.exit("Invalid benchmark config.")
+
+    counter = None if args["--no-syscalls"] else SyscallCounter()
+    cycles = []
+
+    try:
+        if counter:
+            counter.__enter__()
+
+        for i in range(int(args["--cycles"])):
+            changes = change_tree(files, params, rng, i) if i else Changes()
+
+            # Snapshot names have a resolution of one second.
+            time.sleep(1 - time.time() % 1)
+
+            cycles.append(_run_cycle(app, cfg, counter, changes))
+            print(f"Cycle {i}: {cycles[-1]['duration']:.3f}s")
+
+            if not cycles[-1]["ok"]:
+                print("rsync failed, stop.")
+                break
+
+    finally:
+        if counter:
+            counter.__exit__()
+
+    _wait_for_trash(f"{dst}/{app.state_dir_name}")
+
+    result = {
+        "benchmark": "snapshot_pipeline",
+        "created_at": int(time.time()),
+        "vhpi_version": app.version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backup_root": dst,
+        "params": asdict(params),
+        "options": {
+            "engine": args["--engine"],
+            "rotation": args["--rotation"],
+            "share": bool(args["--share"]),
+            "snapshots": list(cfg.jobs[0].snapshots),
+            "keep_amount": int(args["--keep-amount"]),
+            "syscalls_counted": counter is not None,
+        },
+        "generate_duration": generate_duration,
+        "cycles": cycles,
+        "summary": _summarize(cycles),
+        "backup_root_inodes": _count_inodes(dst),
+        "timestamps": timestamp_store.store.load(app, dst),
+    }
+
+    if not args["--keep"] and not args["--dir"]:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return result
+
+
+def main() -> None:
+    args = docopt(__doc__)
+    previous = None
+
+    if args["--compare"]:
+        with open(args["--compare"], "r") as f:
+            previous = json.load(f)
+
+    result = run(args)
+
+    _print_report(result, previous)
+
+    output = args["--output"] or time.strftime("vhpi-bench-%Y%m%d-%H%M%S.json")
+
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"Results: {output}")
+
+
+if __name__ == "__main__":
+    main()
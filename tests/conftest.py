@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from vhpi.types import App, Config, JobPlan
+
+MOCK_DIR = os.path.join(os.path.dirname(__file__), "mock")
+
+
+@pytest.fixture
+def app(tmp_path) -> App:
+    cfg_dir = tmp_path / "cfg"
+    cfg_dir.mkdir()
+    (cfg_dir / "vhpi_cfg.yaml").write_text("")
+
+    return App(
+        version="0.0.0",
+        home_dir=str(tmp_path),
+        root_dir=str(tmp_path),
+        cfg_dir=str(cfg_dir),
+        cfg_file=str(cfg_dir / "vhpi_cfg.yaml"),
+        log_dir=str(tmp_path / "log"),
+        timestamp_file_name=".backup_timestamps",
+        state_dir_name=".vhpi",
+        timestamp_format="%Y-%m-%d %H:%M:%S",
+    )
+
+
+def make_plan(**kwargs) -> JobPlan:
+    settings = {
+        "name": "job",
+        "login_token": None,
+        "source_ip": "127.0.0.1",
+        "backup_src": os.path.join(MOCK_DIR, "src_local_to_local"),
+        "backup_root": "/nonexistent/backup_root",
+        "rsync_options": ("-aAHSvX",),
+        "excludes": (),
+        "exclude_file": None,
+        "incremental": False,
+        "full_sync_every": 0,
+        "rsync_shards": 1,
+        "hardlink_engine": "native",
+        "share_snapshots": False,
+        "snapshot_rotation": "shift",
+        "snapshot_aliases": False,
+        "snapshots": {"hourly": 2, "daily": 2},
+    }
+    settings.update(kwargs)
+
+    return JobPlan(**settings)
+
+
+def make_cfg(*plans: JobPlan, **app_cfg) -> Config:
+    return Config(
+        app_cfg=app_cfg,
+        intervals={"hourly": 3600, "daily": 86400},
+        jobs=plans,
+    )
@@ -0,0 +1,130 @@
+import os
+import shutil
+import threading
+import time
+
+from vhpi import config
+
+
+def test_filter_file_is_named_after_its_content(tmp_path):
+    filter_dir = str(tmp_path / "filters")
+
+    first = config._get_filter_file(filter_dir, ("*.tmp", "/cache/"))
+    same = config._get_filter_file(filter_dir, ("/cache/", "*.tmp"))
+    other = config._get_filter_file(filter_dir, ("*.tmp",))
+
+    assert first == same
+    assert first != other
+    assert os.path.basename(first).startswith("excludes-")
+
+    with open(first) as f:
+        assert f.read() == "- *.tmp\n- /cache/\n"
+
+
+def test_no_filter_file_without_excludes(tmp_path):
+    assert config._get_filter_file(str(tmp_path), ()) is None
+
+
+def test_parse_plans(app):
+    user_cfg = {
+        "app_cfg": {
+            "intervals": {"hourly": 3600},
+            "exclude_lib": {"common": ["*.tmp"]},
+        },
+        "jobs": [
+            {
+                "name": "docs",
+                "rsync_src": "/home/my\\ docs/",
+                "rsync_dst": "/media/backup/docs",
+                "excludes": ["/cache/", "*.tmp"],
+                "exclude_lists": ["common"],
+                "snapshots": {"hourly": 2},
+            },
+            # Invalid, left out.
+            {"rsync_src": "/home", "rsync_dst": None},
+        ],
+    }
+
+    cfg = config.parse(app, user_cfg)
+
+    assert len(cfg.jobs) == 1
+    plan = cfg.jobs[0]
+    assert plan.backup_src == "/home/my docs/"
+    assert plan.login_token is None
+    assert plan.excludes == ("/cache/", "*.tmp")
+    assert plan.exclude_file.startswith(config.get_filter_dir(app))
+
+
+def test_sharding_requires_trailing_slash(app):
+    user_cfg = {
+        "app_cfg": {"intervals": {"hourly": 3600}},
+        "jobs": [
+            {
+                "rsync_src": src,
+                "rsync_dst": "/media/backup",
+                "rsync_shards": 4,
+                "snapshots": {"hourly": 2},
+            }
+            for src in ("/home/", "/home")
+        ],
+    }
+
+    cfg = config.parse(app, user_cfg)
+
+    assert [plan.rsync_shards for plan in cfg.jobs] == [4, 1]
+
+
+def test_reload_leaves_out_new_remote_sources(app, monkeypatch):
+    def write_login(src):
+        raise AssertionError("The password must not be requested.")
+
+    monkeypatch.setattr(config.lib, "write_login", write_login)
+    user_cfg = {
+        "app_cfg": {"intervals": {"hourly": 3600}},
+        "jobs": [
+            {
+                "name": name,
+                "rsync_src": f"user@{name}:/home/",
+                "rsync_dst": f"/media/backup/{name}",
+                "snapshots": {"hourly": 2},
+            }
+            for name in ("known", "new")
+        ],
+    }
+
+    cfg = config.parse(app, user_cfg, {"user@known:/home/": b"token"}, False)
+
+    assert [plan.name for plan in cfg.jobs] == ["known"]
+    assert cfg.jobs[0].login_token == b"token"
+
+
+def test_watcher_survives_removed_config_dir(tmp_path):
+    cfg_dir = tmp_path / "cfg"
+    cfg_dir.mkdir()
+    cfg_file = cfg_dir / "vhpi_cfg.yaml"
+    cfg_file.write_text("a")
+    changed = threading.Event()
+
+    watcher = config.CfgWatcher(
+        str(cfg_file), changed.set, poll_interval=0.05, settle_time=0.05
+    )
+    watcher.start()
+    # Let the watcher record the current state first.
+    time.sleep(0.3)
+
+    try:
+        # Removing the watched dir removes the inotify watch as well.
+        shutil.rmtree(cfg_dir)
+        cfg_dir.mkdir()
+        cfg_file.write_text("changed")
+
+        assert changed.wait(5)
+        assert watcher._thread.is_alive()
+
+        changed.clear()
+        cfg_file.write_text("changed again")
+
+        assert changed.wait(5)
+
+    finally:
+        watcher.stop()
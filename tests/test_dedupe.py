@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+from vhpi import dedupe, lib
+
+
+def _make_roots(tmp_path, content=b"x" * 2048):
+    roots = {}
+
+    for name in ("a", "b"):
+        backup_root = tmp_path / name
+        (backup_root / "backup.latest").mkdir(parents=True)
+        path = backup_root / "backup.latest" / "file.bin"
+        path.write_bytes(content)
+        os.utime(path, ns=(0, 0))
+        roots[str(backup_root)] = str(backup_root / ".vhpi")
+
+    return roots
+
+
+def _inodes(roots):
+    return {
+        os.stat(f"{backup_root}/backup.latest/file.bin").st_ino for backup_root in roots
+    }
+
+
+def test_identical_files_are_linked(tmp_path):
+    roots = _make_roots(tmp_path)
+
+    stats = dedupe.run(roots, min_size=1)
+
+    assert stats.duplicates == 1
+    assert stats.saved_bytes == 2048
+    assert len(_inodes(roots)) == 1
+
+
+def _make_tmp_link(tmp_path):
+    latest = tmp_path / "a" / "backup.latest"
+    tmp_link = latest / ".file.bin.0123456789abcdef.vhpi-dedupe"
+    os.link(latest / "file.bin", tmp_link)
+
+    return tmp_link
+
+
+def test_dry_run_changes_nothing(tmp_path):
+    roots = _make_roots(tmp_path)
+    tmp_link = _make_tmp_link(tmp_path)
+
+    stats = dedupe.run(roots, min_size=1, dry_run=True)
+
+    assert stats.duplicates == 1
+    assert len(_inodes(roots)) == 2
+    assert tmp_link.exists()
+    assert not os.path.exists(dedupe._get_index_file(roots[str(tmp_path / "a")]))
+
+
+def test_only_temporary_links_are_removed(tmp_path):
+    roots = _make_roots(tmp_path)
+    tmp_link = _make_tmp_link(tmp_path)
+    user_file = tmp_path / "a" / "backup.latest" / "notes.vhpi-dedupe"
+    user_file.write_bytes(b"user data")
+
+    dedupe.run(roots, min_size=1)
+
+    assert not tmp_link.exists()
+    assert user_file.exists()
+
+
+def test_index_is_json(tmp_path):
+    roots = _make_roots(tmp_path)
+    dedupe.run(roots, min_size=1)
+
+    index = {}
+
+    for state_dir in roots.values():
+        index.update(dedupe._load_index(state_dir))
+
+    # Both inodes were hashed, small files completely by the partial hash.
+    assert len(index) == 2
+
+    for size, _, partial, full in index.values():
+        assert size == 2048
+        assert partial == full
+
+
+def test_different_xattrs_are_not_linked(tmp_path):
+    roots = _make_roots(tmp_path)
+    path = tmp_path / "a" / "backup.latest" / "file.bin"
+
+    try:
+        os.setxattr(path, "user.vhpi_test", b"1")
+    except OSError:
+        pytest.skip("The filesystem does not support user xattrs.")
+
+    stats = dedupe.run(roots, min_size=1)
+
+    assert stats.duplicates == 0
+    assert len(_inodes(roots)) == 2
+
+
+def test_busy_backup_root_is_skipped(tmp_path):
+    roots = _make_roots(tmp_path)
+    state_dir = roots[str(tmp_path / "a")]
+    os.makedirs(state_dir)
+
+    with lib.lock_file(f"{state_dir}/lock") as locked:
+        assert locked
+        stats = dedupe.run(roots, min_size=1)
+
+    assert stats.files == 1
+    assert len(_inodes(roots)) == 2
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+from conftest import make_cfg, make_plan
+
+from vhpi import executor, lib
+
+
+class FakeJobs:
+    """
+    Replace job.run and record how many jobs ran at the same time.
+    """
+
+    def __init__(self, duration: float = 0.05):
+        self.duration = duration
+        self.running = 0
+        self.max_running = 0
+        self.done: list[str] = []
+        self._lock = threading.Lock()
+
+    def run(self, app, plan, cfg):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        time.sleep(self.duration)
+
+        with self._lock:
+            self.running -= 1
+            self.done.append(plan.name)
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    fake_jobs = FakeJobs()
+    monkeypatch.setattr(executor.job, "run", fake_jobs.run)
+
+    return fake_jobs
+
+
+def _make_plans(tmp_path, amount, shared_root=False):
+    plans = []
+
+    for i in range(amount):
+        # A shared destination is spelled differently by each job.
+        backup_root = tmp_path / ("backup" if shared_root else f"backup{i}")
+        backup_root.mkdir(exist_ok=True)
+        plans.append(make_plan(name=str(i), backup_root=f"{backup_root}{'/' * i}"))
+
+    return plans
+
+
+def _run_all(app, pool, plans):
+    cfg = make_cfg(*plans)
+    futures = [pool.submit(app, plan, cfg) for plan in plans]
+    pool.shutdown()
+
+    for future in futures:
+        future.result()
+
+
+def test_jobs_with_same_destination_never_overlap(app, tmp_path, jobs):
+    plans = _make_plans(tmp_path, 4, shared_root=True)
+
+    _run_all(app, executor.JobExecutor(max_workers=4), plans)
+
+    assert jobs.max_running == 1
+    assert sorted(jobs.done) == ["0", "1", "2", "3"]
+
+
+def test_disk_limit_is_respected(app, tmp_path, jobs):
+    plans = _make_plans(tmp_path, 6)
+    pool = executor.JobExecutor(max_workers=6, max_workers_per_disk=2)
+
+    _run_all(app, pool, plans)
+
+    assert jobs.max_running == 2
+    assert len(jobs.done) == 6
+
+
+def test_disk_limit_per_mount_point(app, tmp_path, jobs):
+    plans = _make_plans(tmp_path, 4)
+    pool = executor.JobExecutor(max_workers=4, max_workers_per_disk={str(tmp_path): 1})
+
+    _run_all(app, pool, plans)
+
+    assert jobs.max_running == 1
+
+
+def test_running_job_holds_lock_of_backup_root(app, tmp_path, monkeypatch):
+    backup_root = tmp_path / "backup"
+    backup_root.mkdir()
+    locked = []
+
+    def run(app, plan, cfg):
+        with lib.lock_file(f"{backup_root}/.vhpi/lock", blocking=False) as free:
+            locked.append(not free)
+
+    monkeypatch.setattr(executor.job, "run", run)
+
+    _run_all(
+        app,
+        executor.JobExecutor(max_workers=2),
+        [make_plan(backup_root=str(backup_root))],
+    )
+
+    assert locked == [True]
+
+
+def test_shutdown_waits_for_running_jobs(app, tmp_path, jobs):
+    jobs.duration = 0.2
+    pool = executor.JobExecutor(max_workers=2)
+    plan = make_plan(backup_root=str(tmp_path / "backup"))
+    future = pool.submit(app, plan, make_cfg(plan))
+
+    pool.shutdown()
+
+    assert future.done()
+    assert jobs.done == ["job"]
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from vhpi import hardlink
+
+
+def _make_src(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "a.txt").write_text("abc")
+    (src / "sub" / "b.txt").write_text("de")
+    os.symlink("a.txt", src / "link")
+    os.chmod(src / "sub", 0o750)
+    os.utime(src / "sub", (1000000000, 1000000000))
+
+    return src
+
+
+def test_link_tree_links_all_destinations(tmp_path):
+    src = _make_src(tmp_path)
+    dsts = [str(tmp_path / "dst1"), str(tmp_path / "dst2")]
+
+    stats = hardlink.link_tree(str(src), dsts)
+
+    assert stats.errors == 0
+    assert stats.dirs == 2
+    # Files and symlinks of the source are counted once.
+    assert stats.files == 3
+
+    for dst in dsts:
+        assert os.stat(f"{dst}/a.txt").st_ino == os.stat(src / "a.txt").st_ino
+        assert (
+            os.stat(f"{dst}/sub/b.txt").st_ino == os.stat(src / "sub" / "b.txt").st_ino
+        )
+        assert os.readlink(f"{dst}/link") == "a.txt"
+
+
+def test_link_tree_copies_dir_metadata(tmp_path):
+    src = _make_src(tmp_path)
+    dst = str(tmp_path / "dst")
+
+    hardlink.link_tree(str(src), [dst])
+
+    st = os.stat(f"{dst}/sub")
+
+    assert st.st_mode & 0o777 == 0o750
+    assert st.st_mtime == 1000000000
+    assert os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns
+
+
+def test_link_tree_refuses_existing_destination(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / "dst"
+    dst.mkdir()
+
+    with pytest.raises(FileExistsError):
+        hardlink.link_tree(str(src), [str(dst)])
+
+
+def test_resume_completes_partial_copy(tmp_path):
+    src = _make_src(tmp_path)
+    dst = tmp_path / "dst"
+    (dst / "sub").mkdir(parents=True)
+    os.link(src / "a.txt", dst / "a.txt")
+    # An interrupted run did not copy the mtime of the dir yet.
+    os.utime(dst, (0, 0))
+
+    stats = hardlink.link_tree(str(src), [str(dst)], resume=True)
+
+    assert stats.errors == 0
+    assert sorted(os.listdir(dst)) == ["a.txt", "link", "sub"]
+    assert os.listdir(dst / "sub") == ["b.txt"]
+    assert os.stat(dst / "sub").st_mtime == 1000000000
+
+
+def test_resume_skips_completed_dirs(tmp_path):
+    src = _make_src(tmp_path)
+    dst = str(tmp_path / "dst")
+    hardlink.link_tree(str(src), [dst])
+
+    stats = hardlink.link_tree(str(src), [dst], resume=True)
+
+    assert stats.dirs == 0
+    assert stats.files == 0
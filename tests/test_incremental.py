@@ -0,0 +1,98 @@
+import os
+
+from conftest import make_cfg, make_plan
+
+from vhpi import incremental
+from vhpi.job import get_job
+
+
+def _make_job(app, tmp_path, **kwargs):
+    src = tmp_path / "src"
+    backup_root = tmp_path / "backup"
+    (backup_root / "backup.latest").mkdir(parents=True, exist_ok=True)
+    plan = make_plan(
+        backup_src=f"{src}/",
+        backup_root=str(backup_root),
+        incremental=True,
+        full_sync_every=10,
+        **kwargs,
+    )
+
+    return get_job(app, plan, make_cfg(plan))
+
+
+def _make_src(tmp_path):
+    src = tmp_path / "src"
+    (src / "docs").mkdir(parents=True)
+    (src / "docs" / "a.txt").write_text("a")
+    (src / "cache dir").mkdir()
+    (src / "cache dir" / "b.tmp").write_text("b")
+
+    return src
+
+
+def _read_files_from(run):
+    with open(run.files_from) as f:
+        return sorted(path for path in f.read().split("\0") if path)
+
+
+def test_scan_does_not_apply_excludes(tmp_path):
+    src = _make_src(tmp_path)
+
+    index = incremental.scan(str(src))
+
+    assert set(index) == {"docs", "docs/a.txt", "cache dir", "cache dir/b.tmp"}
+    assert index["docs/a.txt"][0] == 1
+
+
+def test_first_run_is_full(app, tmp_path):
+    _make_src(tmp_path)
+    job = _make_job(app, tmp_path, excludes=("*.tmp",))
+
+    run = incremental.prepare(job)
+
+    assert run is not None
+    assert run.files_from == ""
+    assert incremental.get_rsync_options(job, run) == job.rsync_options
+
+
+def test_changed_paths_are_passed_unfiltered(app, tmp_path):
+    src = _make_src(tmp_path)
+    job = _make_job(app, tmp_path, excludes=("*.tmp",))
+    incremental.commit(job, incremental.prepare(job))
+
+    (src / "cache dir" / "b.tmp").write_text("changed")
+    (src / "docs" / "new.txt").write_text("new")
+    os.unlink(src / "docs" / "a.txt")
+
+    run = incremental.prepare(job)
+
+    # rsync applies the filter file of the job to these paths.
+    assert _read_files_from(run) == ["cache dir/b.tmp", "docs", "docs/new.txt"]
+    assert run.deleted == ["docs/a.txt"]
+    assert run.cycle == 1
+    assert f"--files-from={run.files_from}" in incremental.get_rsync_options(job, run)
+
+
+def test_index_is_json(app, tmp_path):
+    _make_src(tmp_path)
+    job = _make_job(app, tmp_path)
+    run = incremental.prepare(job)
+    incremental.commit(job, run)
+
+    latest_ino, cycle, index = incremental._load_index(job)
+
+    assert latest_ino == os.stat(job.backup_latest).st_ino
+    assert cycle == 0
+    assert index == run.index
+
+
+def test_broken_index_results_in_full_run(app, tmp_path):
+    _make_src(tmp_path)
+    job = _make_job(app, tmp_path)
+    incremental.commit(job, incremental.prepare(job))
+
+    with open(incremental._get_index_file(job), "w") as f:
+        f.write("{")
+
+    assert incremental.prepare(job).files_from == ""
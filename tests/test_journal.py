@@ -0,0 +1,200 @@
+import itertools
+import json
+import os
+from datetime import datetime
+from unittest import mock
+
+import pytest
+
+from vhpi import config, hardlink, journal, snapshot, trash
+from vhpi.job import get_job
+from vhpi.snapshot_index import SnapshotIndex
+
+# The functions of a snapshot run, that are made to crash on their n-th call.
+CRASH_TARGETS = [
+    (snapshot, "_apply"),
+    (snapshot, "_update_timestamps"),
+    (hardlink, "_link_dir"),
+    (hardlink, "_copy_dir_metadata"),
+    (journal.Journal, "record"),
+    (journal.Journal, "done"),
+]
+
+SNAPSHOTS = {"hourly": 1, "daily": 3}
+
+
+class Crash(Exception):
+    pass
+
+
+def _crash_on_call(func, n: int):
+    counter = itertools.count(1)
+
+    def wrapper(*args, **kwargs):
+        if next(counter) == n:
+            raise Crash()
+
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+@pytest.fixture(autouse=True)
+def no_trash_pause(monkeypatch):
+    monkeypatch.setattr(trash.reclaimer, "pause", 0)
+
+
+class BackupRoot:
+    def __init__(self, app, root, share: bool, rotation: str):
+        self.app = app
+        self.root = str(root)
+        self.user_cfg = {
+            "app_cfg": {
+                "intervals": {"hourly": 3600, "daily": 86400},
+                "share_snapshots": share,
+                "snapshot_rotation": rotation,
+            },
+            "jobs": [
+                {
+                    "rsync_src": "/nonexistent/src/",
+                    "rsync_dst": self.root,
+                    "login_token": None,
+                    "snapshots": SNAPSHOTS,
+                }
+            ],
+        }
+
+    def setup(self) -> None:
+        for d in range(3):
+            os.makedirs(f"{self.root}/backup.latest/d{d}/e")
+
+            for f in range(3):
+                with open(f"{self.root}/backup.latest/d{d}/e/f{f}", "w") as fh:
+                    fh.write("x" * f)
+
+        open(f"{self.root}/.backup_timestamps", "w").close()
+
+    def get_job(self):
+        cfg = config.parse(self.app, self.user_cfg)
+
+        return get_job(self.app, cfg.jobs[0], cfg)
+
+    def run(self, minute: int) -> None:
+        job = self.get_job()
+        snapshots = [
+            snapshot.get_snapshot(self.app, job, name, keep_amount, 0)
+            for name, keep_amount in SNAPSHOTS.items()
+        ]
+
+        with mock.patch.object(snapshot, "datetime") as dt:
+            dt.fromtimestamp.return_value = datetime(2020, 1, 1, 10, minute, 0)
+            snapshot.run(self.app, job, snapshots)
+
+    def state(self):
+        dirs = []
+
+        for dir_ in sorted(os.listdir(self.root)):
+            path = f"{self.root}/{dir_}"
+
+            if dir_.startswith("."):
+                continue
+
+            if os.path.islink(path):
+                dirs.append((dir_, "->", os.readlink(path)))
+            else:
+                files = sum(len(names) for _, _, names in os.walk(path))
+                dirs.append((dir_, files))
+
+        with SnapshotIndex(self.root, f"{self.root}/.vhpi") as index:
+            entries = [(e.dir, e.seq, e.target) for e in index.get_all()]
+
+        with open(f"{self.root}/.vhpi/timestamps") as f:
+            timestamps = sorted(json.load(f))
+
+        return dirs, entries, timestamps
+
+
+@pytest.mark.parametrize(
+    "share, rotation",
+    [(False, "shift"), (True, "shift"), (False, "stable")],
+)
+def test_interrupted_runs_are_rolled_forward(app, tmp_path, share, rotation):
+    """
+    Crash a snapshot run at every step and check that recover() results in
+    the same backup root as an uninterrupted run.
+    """
+    reference = BackupRoot(app, tmp_path / "reference", share, rotation)
+    reference.setup()
+
+    for minute in range(4):
+        reference.run(minute)
+
+    expected = reference.state()
+    crash_points = 0
+
+    for (module, name), n in itertools.product(CRASH_TARGETS, range(1, 25)):
+        backup = BackupRoot(app, tmp_path / f"{name}_{n}", share, rotation)
+        backup.setup()
+
+        for minute in range(3):
+            backup.run(minute)
+
+        crashing = _crash_on_call(getattr(module, name), n)
+
+        with mock.patch.object(module, name, crashing):
+            try:
+                backup.run(3)
+            except Crash:
+                pass
+            else:
+                continue
+
+        crash_points += 1
+        job = backup.get_job()
+
+        assert snapshot.recover(app, job), (name, n)
+        assert not snapshot.recover(app, job), (name, n)
+        assert backup.state() == expected, (name, n)
+
+    assert crash_points > 20
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    j = journal.Journal(str(tmp_path))
+    j.begin({"jobs": 1})
+    j.record("hardlink", {"dst": "x"})
+    j.done("hardlink")
+    j.record("place:daily", {"ops": []})
+    j._f.write('{"type": "done", "st')
+    j._f.close()
+
+    state = j.load()
+
+    assert state.plan == {"jobs": 1}
+    assert set(state.recorded) == {"hardlink", "place:daily"}
+    assert state.done == {"hardlink"}
+
+
+def test_write_without_open_journal_raises(tmp_path):
+    with pytest.raises(RuntimeError):
+        journal.Journal(str(tmp_path)).done("hardlink")
+
+
+def test_run_keeps_index_up_to_date(app, tmp_path):
+    backup = BackupRoot(app, tmp_path / "backup", False, "stable")
+    backup.user_cfg["app_cfg"]["snapshot_aliases"] = True
+    backup.setup()
+    backup.run(0)
+    # A leftover of an interrupted run before the journal was started.
+    os.makedirs(f"{backup.root}/daily.tmp/x")
+
+    backup.run(1)
+
+    assert os.readlink(f"{backup.root}/daily.0").endswith("__daily")
+    assert not os.path.exists(f"{backup.root}/daily.tmp")
+
+    with mock.patch.object(SnapshotIndex, "rescan") as rescan:
+        with SnapshotIndex(backup.root, f"{backup.root}/.vhpi"):
+            pass
+
+    rescan.assert_not_called()
@@ -0,0 +1,182 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from vhpi.logging import JsonFormatter, LogWriter, log
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.lines: list[str] = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+@pytest.fixture
+def writer():
+    """
+    Let the global log write to a list through a log writer.
+    """
+    handler = ListHandler()
+    writer = LogWriter([handler], maxsize=100, section_buffer_size=50)
+    writer.handler = handler
+    log.logger.addHandler(writer.queue_handler)
+    log._writer = writer
+    writer.start()
+
+    yield writer
+
+    log.close()
+
+
+def test_json_formatter():
+    record = logging.makeLogRecord(
+        {
+            "msg": "  Job finished  ",
+            "levelno": logging.INFO,
+            "levelname": "INFO",
+            "context": {"job": "Laptop", "run_id": "abc"},
+            "fields": {"files": 3},
+        }
+    )
+
+    data = json.loads(JsonFormatter().format(record))
+
+    assert data["level"] == "info"
+    assert data["job"] == "Laptop"
+    assert data["run_id"] == "abc"
+    assert data["msg"] == "Job finished"
+    assert data["files"] == 3
+    assert list(data)[:2] == ["ts", "level"]
+
+
+def test_sections_are_written_as_blocks(writer):
+    start = threading.Barrier(2)
+
+    def run_job(name):
+        with log.job_section(), log.context(job=name):
+            start.wait()
+
+            for i in range(10):
+                log.info(f"{name} {i}")
+
+    threads = [threading.Thread(target=run_job, args=(n,)) for n in "ab"]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    log.close()
+    lines = writer.handler.lines
+
+    assert sorted(lines) == sorted(f"{n} {i}" for n in "ab" for i in range(10))
+    assert lines in (
+        [f"a {i}" for i in range(10)] + [f"b {i}" for i in range(10)],
+        [f"b {i}" for i in range(10)] + [f"a {i}" for i in range(10)],
+    )
+
+
+def test_sections_keep_their_context(writer):
+    """
+    The context of records in a job section must survive when parallel jobs
+    (max_workers > 1) log in JSON, also for records of shard threads.
+    """
+    writer.handler.setFormatter(JsonFormatter())
+
+    def run_job(name):
+        with log.job_section(), log.context(job=name, run_id=f"id-{name}"):
+            log.info("Job started")
+            section, context = log.get_section(), log.get_context()
+
+            def run_shard():
+                with log.use_section(section), log.context(**context, shard="s"):
+                    log.info("Shard finished")
+
+            shard_thread = threading.Thread(target=run_shard)
+            shard_thread.start()
+            shard_thread.join()
+
+    threads = [threading.Thread(target=run_job, args=(n,)) for n in "ab"]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    log.close()
+    records = [json.loads(line) for line in writer.handler.lines]
+
+    assert len(records) == 4
+
+    for record in records:
+        assert record["run_id"] == f"id-{record['job']}"
+
+    assert {r["job"] for r in records if r.get("shard") == "s"} == {"a", "b"}
+
+
+def test_section_buffer_is_bounded(writer):
+    with log.job_section():
+        for i in range(60):
+            log.warning(f"{i}")
+
+        # The writer may not hold back more than 50 records, so it writes the
+        # section early.
+        deadline = time.monotonic() + 5
+
+        while len(writer.handler.lines) < 51 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert writer.handler.lines == [f"{i}" for i in range(51)]
+
+    log.close()
+
+    assert writer.handler.lines == [f"{i}" for i in range(60)]
+    assert writer._held == 0
+
+
+def test_debug_records_are_dropped_when_queue_is_full():
+    handler = ListHandler()
+    writer = LogWriter([handler], maxsize=5)
+    logger = logging.getLogger("vhpi-test-drop")
+    logger.propagate = False
+    logger.addHandler(writer.queue_handler)
+
+    try:
+        for i in range(10):
+            logger.debug(f"debug {i}")
+
+        # The writer isn't started, so the queue stays full.
+        assert writer.queue.qsize() == 5
+        assert writer.queue_handler.dropped == 5
+
+        writer.start()
+        writer.stop()
+
+    finally:
+        logger.removeHandler(writer.queue_handler)
+
+    assert handler.lines[:5] == [f"debug {i}" for i in range(5)]
+    assert "dropped 5 debug records" in handler.lines[-1]
+
+
+def test_records_are_formatted_by_the_writer(writer):
+    writer.handler.setFormatter(JsonFormatter())
+
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        log.logger.error("Failed: %s", "job", exc_info=True)
+
+    log.close()
+    data = json.loads(writer.handler.lines[0])
+
+    assert data["msg"] == "Failed: job"
+    assert "ValueError: boom" in data["exc"]
@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from vhpi import metrics
+from vhpi.metrics import Registry
+
+
+def test_render_text_format():
+    registry = Registry()
+    registry.inc("vhpi_job_runs_total", job="Laptop", result="completed")
+    registry.inc("vhpi_job_runs_total", job="Laptop", result="completed")
+    registry.set("vhpi_job_duration_seconds", 1.5, job='My "NAS"')
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE vhpi_job_runs_total counter" in lines
+    assert 'vhpi_job_runs_total{job="Laptop",result="completed"} 2' in lines
+    assert "# TYPE vhpi_job_duration_seconds gauge" in lines
+    assert 'vhpi_job_duration_seconds{job="My \\"NAS\\""} 1.5' in lines
+    # Metrics without samples are left out.
+    assert not any(line.startswith("# HELP vhpi_snapshots ") for line in lines)
+
+
+def test_ages_are_computed_on_render():
+    registry = Registry()
+    labels = {"job": "a", "snapshot": "daily"}
+    registry.set("vhpi_snapshot_last_timestamp_seconds", time.time() - 60, **labels)
+    registry.set("vhpi_snapshot_last_timestamp_seconds", 0, job="a", snapshot="weekly")
+
+    ages = [
+        line
+        for line in registry.render().splitlines()
+        if line.startswith("vhpi_snapshot_age_seconds{")
+    ]
+
+    # Intervals without a snapshot have no age.
+    assert len(ages) == 1
+    assert 59 <= float(ages[0].split()[-1]) < 70
+
+
+def test_unknown_metric_raises():
+    with pytest.raises(KeyError):
+        Registry().inc("vhpi_unknown_total")
+
+
+def test_parse_address():
+    assert metrics._parse_address("9101") == ("127.0.0.1", 9101)
+    assert metrics._parse_address("0.0.0.0:9101") == ("0.0.0.0", 9101)
+    assert metrics._parse_address("[::1]:9101") == ("::1", 9101)
+
+
+def test_write_textfile(tmp_path):
+    exporter = metrics.MetricsExporter()
+    exporter.textfile = str(tmp_path / "vhpi.prom")
+
+    exporter.write_textfile()
+
+    assert (tmp_path / "vhpi.prom").read_text() == metrics.registry.render()
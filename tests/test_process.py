@@ -0,0 +1,85 @@
+import os
+import subprocess as sp
+import sys
+
+import pytest
+
+from vhpi import lib, process
+
+SECRET = "s3cret pass"
+
+
+@pytest.fixture
+def fake_sshpass(tmp_path, monkeypatch):
+    """
+    An 'sshpass' that writes the password it reads from the fd of '-d' to a
+    file and runs the wrapped command.
+    """
+    out = tmp_path / "password"
+    script = tmp_path / "sshpass"
+    script.write_text(
+        f"#!{sys.executable}\n"
+        "import os, sys\n"
+        "password = os.read(int(sys.argv[2]), 1024).decode().rstrip('\\n')\n"
+        f"open({str(out)!r}, 'w').write(password)\n"
+        "os.execv(sys.argv[3], sys.argv[3:])\n"
+    )
+    script.chmod(0o755)
+    monkeypatch.setitem(process._paths, "sshpass", str(script))
+
+    return out
+
+
+def test_command_without_login_is_resolved():
+    with process._with_login(["sh", "-c", "true"], None) as (command, pass_fds):
+        assert command == [process.which("sh"), "-c", "true"]
+        assert pass_fds == ()
+
+
+def test_password_is_passed_via_fd(monkeypatch):
+    monkeypatch.setitem(process._paths, "sshpass", "/usr/bin/sshpass")
+    token = lib._encrypt(SECRET.encode())
+
+    with process._with_login(["rsync", "-a"], token) as (command, pass_fds):
+        read_fd = pass_fds[0]
+
+        assert command[:3] == ["/usr/bin/sshpass", "-d", str(read_fd)]
+        assert not any(SECRET in arg for arg in command)
+        assert os.read(read_fd, 100) == f"{SECRET}\n".encode()
+
+    # The pipe is closed after the process was started.
+    with pytest.raises(OSError):
+        os.fstat(read_fd)
+
+
+def test_run_with_login(fake_sshpass):
+    token = lib._encrypt(SECRET.encode())
+
+    p = process.run(["echo", "done"], token, stdout=sp.PIPE, check=True)
+
+    assert p.stdout == b"done\n"
+    assert fake_sshpass.read_text() == SECRET
+
+
+def test_popen_with_login(fake_sshpass):
+    token = lib._encrypt(SECRET.encode())
+
+    p = process.popen(["echo", "done"], token, stdout=sp.PIPE)
+    stdout, _ = p.communicate()
+
+    assert stdout == b"done\n"
+    assert fake_sshpass.read_text() == SECRET
+
+
+def test_unknown_executable_raises():
+    with pytest.raises(FileNotFoundError):
+        process.run(["vhpi-no-such-command"])
+
+
+def test_arguments_are_not_interpreted_by_a_shell(tmp_path):
+    name = "a file; touch injected"
+
+    p = process.run(["echo", name], stdout=sp.PIPE, cwd=tmp_path)
+
+    assert p.stdout.decode().strip() == name
+    assert not (tmp_path / "injected").exists()
@@ -0,0 +1,144 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from vhpi import reachability
+
+
+@pytest.fixture
+def listening_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        s.listen()
+        yield s.getsockname()[1]
+
+
+@pytest.fixture
+def closed_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    return port
+
+
+def test_probe_tcp_open_port(listening_port):
+    assert reachability.probe_tcp("127.0.0.1", listening_port, timeout=1)
+
+
+def test_probe_tcp_refused_port_means_online(closed_port):
+    assert reachability.probe_tcp("127.0.0.1", closed_port, timeout=1)
+
+
+def test_probe_tcp_unknown_host(monkeypatch):
+    def getaddrinfo(*args, **kwargs):
+        raise socket.gaierror()
+
+    monkeypatch.setattr(reachability.socket, "getaddrinfo", getaddrinfo)
+
+    assert not reachability.probe_tcp("unknown.invalid", 22, timeout=1)
+
+
+def test_probe_icmp_localhost():
+    online = reachability.probe_icmp("127.0.0.1", timeout=1)
+
+    if online is None:
+        pytest.skip("Unprivileged icmp sockets are not permitted.")
+
+    assert online
+
+
+def test_probe_icmp_is_ipv4_only():
+    assert reachability.probe_icmp("::1", timeout=1) is None
+
+
+def test_checksum_of_packet_with_checksum_is_zero():
+    header = struct.pack("!BBHHH", 8, 0, 0, 0, 1)
+    checksum = reachability._checksum(header + b"vhpi")
+    packet = struct.pack("!BBHHH", 8, 0, checksum, 0, 1) + b"vhpi"
+
+    assert reachability._checksum(packet) == 0
+
+
+class CountingProbe:
+    def __init__(self, online: bool = True, duration: float = 0):
+        self.online = online
+        self.duration = duration
+        self.calls: list[str] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, host, port, timeout):
+        with self._lock:
+            self.calls.append(host)
+
+        time.sleep(self.duration)
+
+        return self.online
+
+
+@pytest.fixture
+def checker():
+    checker = reachability.ReachabilityChecker()
+    checker.configure(method="tcp", ttl=60)
+
+    return checker
+
+
+def test_results_are_cached_for_ttl(checker, monkeypatch):
+    probe = CountingProbe()
+    monkeypatch.setattr(reachability, "probe_tcp", probe)
+
+    assert checker.is_online("laptop")
+    assert checker.is_online("laptop")
+    assert probe.calls == ["laptop"]
+
+    assert checker.is_online("laptop", max_age=0)
+    assert len(probe.calls) == 2
+
+    checker.configure(method="tcp", ttl=60)
+    checker.is_online("laptop")
+    assert len(probe.calls) == 3
+
+
+def test_concurrent_checks_share_one_probe(checker, monkeypatch):
+    probe = CountingProbe(online=False, duration=0.2)
+    monkeypatch.setattr(reachability, "probe_tcp", probe)
+    results = []
+
+    threads = [
+        threading.Thread(target=lambda: results.append(checker.is_online("laptop")))
+        for _ in range(8)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert probe.calls == ["laptop"]
+    assert results == [False] * 8
+
+
+def test_check_all_probes_each_host_once(checker, monkeypatch):
+    probe = CountingProbe()
+    monkeypatch.setattr(reachability, "probe_tcp", probe)
+
+    result = checker.check_all(["a", "b", "a"])
+
+    assert result == {"a": True, "b": True}
+    assert sorted(probe.calls) == ["a", "b"]
+
+
+def test_icmp_falls_back_to_tcp(checker, monkeypatch):
+    probe = CountingProbe()
+    monkeypatch.setattr(reachability, "probe_tcp", probe)
+    monkeypatch.setattr(reachability, "probe_icmp", lambda host, timeout: None)
+    checker.configure(method="icmp")
+
+    assert checker.is_online("laptop")
+    assert probe.calls == ["laptop"]
+    assert checker.method == "tcp"
@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+
+from vhpi import resources
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def limiter():
+    return resources.ResourceLimiter()
+
+
+def _hold_slot(limiter, phase, path, host=None):
+    """
+    Take a slot in a thread. Returns an event that releases the slot and one
+    that is set as soon as the slot was taken.
+    """
+    release = threading.Event()
+    acquired = threading.Event()
+
+    def hold():
+        with limiter.acquire(phase, path, host):
+            acquired.set()
+            release.wait(5)
+
+    threading.Thread(target=hold, daemon=True).start()
+
+    return release, acquired
+
+
+def test_bwlimit_is_split_between_rsync_processes(limiter, tmp_path):
+    limiter.configure(bwlimit=1000)
+
+    with limiter.acquire("rsync", str(tmp_path)) as first:
+        with limiter.acquire("rsync", str(tmp_path)) as second:
+            assert first.bwlimit == 1000
+            assert second.bwlimit == 500
+
+        with limiter.acquire("hardlink", str(tmp_path)) as hardlink:
+            assert hardlink.bwlimit == 0
+
+
+def test_auto_bwlimit_uses_measured_throughput(limiter, tmp_path):
+    limiter.configure(bwlimit="auto")
+
+    with limiter.acquire("rsync", str(tmp_path)) as slot:
+        # Nothing was measured yet, and a single process is never throttled.
+        assert slot.bwlimit == 0
+
+    limiter.record_throughput(slot, size=100 * MIB, duration=10)
+
+    with limiter.acquire("rsync", str(tmp_path)) as first:
+        assert first.bwlimit == 0
+
+        with limiter.acquire("rsync", str(tmp_path)) as second:
+            assert second.bwlimit == 10 * 1024 // 2
+
+
+def test_throughput_ignores_throttled_and_small_runs(limiter, tmp_path):
+    device = resources.get_device(str(tmp_path))
+
+    limiter.record_throughput(resources.Slot("rsync", device, 100), 100 * MIB, 10)
+    limiter.record_throughput(resources.Slot("rsync", device), MIB, 1)
+
+    assert limiter._throughput == {}
+
+
+def test_disk_slots_are_limited(limiter, tmp_path):
+    limiter.configure(disk_slots=1)
+    release, acquired = _hold_slot(limiter, "hardlink", str(tmp_path))
+    assert acquired.wait(5)
+
+    waited = []
+
+    def take_slot():
+        start = time.monotonic()
+
+        with limiter.acquire("delete", str(tmp_path)):
+            waited.append(time.monotonic() - start)
+
+    thread = threading.Thread(target=take_slot)
+    thread.start()
+    time.sleep(0.2)
+    release.set()
+    thread.join(5)
+
+    assert waited and waited[0] >= 0.2
+
+
+def test_host_slots_only_limit_rsync(limiter, tmp_path):
+    limiter.configure(host_slots=1)
+    (tmp_path / "a").mkdir()
+    release, acquired = _hold_slot(limiter, "rsync", str(tmp_path / "a"), "laptop")
+    assert acquired.wait(5)
+
+    assert not limiter._is_free(resources.get_device(str(tmp_path)), "laptop")
+
+    with limiter.acquire("rsync", str(tmp_path), "desktop"):
+        pass
+
+    with limiter.acquire("hardlink", str(tmp_path), "laptop"):
+        pass
+
+    release.set()
+
+
+def test_higher_limits_wake_waiting_phases(limiter, tmp_path):
+    limiter.configure(disk_slots=1)
+    release, acquired = _hold_slot(limiter, "rsync", str(tmp_path))
+    assert acquired.wait(5)
+
+    _, second_acquired = _hold_slot(limiter, "rsync", str(tmp_path))
+    assert not second_acquired.wait(0.2)
+
+    limiter.configure(disk_slots=2)
+
+    assert second_acquired.wait(5)
+    release.set()
+
+
+def test_ionice_per_phase(limiter, tmp_path, monkeypatch):
+    monkeypatch.setitem(resources.process._paths, "ionice", "/usr/bin/ionice")
+    limiter.configure(ionice={"delete": "idle", "rsync": "best-effort"})
+
+    with limiter.acquire("delete", str(tmp_path)) as slot:
+        assert slot.ionice == ["/usr/bin/ionice", "-c3"]
+
+    with limiter.acquire("rsync", str(tmp_path)) as slot:
+        assert slot.ionice == ["/usr/bin/ionice", "-c2"]
+
+    with limiter.acquire("hardlink", str(tmp_path)) as slot:
+        assert slot.ionice == []
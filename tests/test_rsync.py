@@ -0,0 +1,98 @@
+import os
+
+import pytest
+from conftest import make_cfg, make_plan
+
+from vhpi import resources, rsync
+from vhpi.job import get_job
+from vhpi.types import RsyncStats
+
+
+@pytest.mark.parametrize(
+    "result",
+    ["aborted", "source_offline", "permission_denied", "not_started", "no_dst", 20],
+)
+def test_failed_results(result):
+    assert rsync._handle_rsync_result(result, init_time=0) is False
+
+
+@pytest.mark.parametrize("result", [0, 23, 24])
+def test_accepted_results(result):
+    assert rsync._handle_rsync_result(result, init_time=0) is True
+
+
+@pytest.mark.parametrize(
+    "results, expected",
+    [
+        ([0, 0], 0),
+        ([0, 23, 24], 24),
+        ([0, "aborted", "source_offline"], "source_offline"),
+        ([0, "aborted", 20], 20),
+        ([0, "aborted", 23], "aborted"),
+        ([0, "aborted"], "aborted"),
+    ],
+)
+def test_aggregate_results(results, expected):
+    assert rsync._aggregate_results(results) == expected
+
+
+def test_slot_settings_are_added_to_command():
+    slot = resources.Slot("rsync", 0, bwlimit=500, ionice=["ionice", "-c2"])
+
+    assert rsync._apply_slot(["rsync", "-a", "/src/", "/dst/"], slot) == [
+        "ionice",
+        "-c2",
+        "rsync",
+        "--bwlimit=500",
+        "-a",
+        "/src/",
+        "/dst/",
+    ]
+
+
+def test_bwlimit_of_job_takes_precedence():
+    slot = resources.Slot("rsync", 0, bwlimit=500)
+    command = ["rsync", "--bwlimit=100", "/src/", "/dst/"]
+
+    assert rsync._apply_slot(command, slot) == command
+
+
+@pytest.fixture
+def sharded_job(app, tmp_path, monkeypatch):
+    """
+    A sharded job whose rsync processes are replaced. The exit codes of the
+    processes are taken from the returned dict by source path.
+    """
+    plan = make_plan(
+        backup_src=f"{tmp_path}/src/",
+        backup_root=str(tmp_path / "backup"),
+        rsync_shards=2,
+    )
+    job = get_job(app, plan, make_cfg(plan))
+    results: dict[str, int] = {}
+
+    def run_with_stats(job_, command, on_line=None, abort=None):
+        return results.get(command[-2], 0), RsyncStats()
+
+    monkeypatch.setattr(rsync, "_list_shards", lambda job_, src_dir: ["a", "b"])
+    monkeypatch.setattr(rsync, "_run_with_stats", run_with_stats)
+
+    return job, results
+
+
+def test_sharded_run_creates_destination(sharded_job):
+    job, _ = sharded_job
+
+    assert rsync._run_sharded(job) == 0
+    assert os.path.isdir(job.backup_latest)
+
+
+@pytest.mark.parametrize("failed_shard", ["", "a"])
+def test_failed_shard_fails_run(sharded_job, failed_shard):
+    job, results = sharded_job
+    results[job.backup_src + failed_shard] = 23
+
+    result = rsync._run_sharded(job)
+
+    assert result == "incomplete"
+    assert rsync._handle_rsync_result(result, init_time=0) is False
@@ -0,0 +1,142 @@
+import time
+from concurrent.futures import Future
+
+import pytest
+from conftest import make_cfg, make_plan
+
+from vhpi import reachability
+from vhpi.scheduler import Scheduler
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.submitted: list[tuple[str, Future]] = []
+
+    def submit(self, app, plan, cfg) -> Future:
+        future: Future = Future()
+        self.submitted.append((plan.name, future))
+        return future
+
+
+@pytest.fixture
+def online(monkeypatch) -> dict:
+    hosts: dict[str, bool] = {}
+
+    def check_all(hosts_, max_age=None):
+        return {host: hosts.get(host, True) for host in hosts_}
+
+    def is_online(host, max_age=None):
+        return hosts.get(host, True)
+
+    monkeypatch.setattr(reachability.checker, "check_all", check_all)
+    monkeypatch.setattr(reachability.checker, "is_online", is_online)
+
+    return hosts
+
+
+def _make_scheduler(app, *plans, **app_cfg):
+    cfg = make_cfg(*plans, **app_cfg)
+    executor = FakeExecutor()
+    scheduler = Scheduler(app, executor, cfg, lambda: None)
+    scheduler._swap_cfg(cfg)
+
+    return scheduler, executor
+
+
+def test_heap_is_ordered_by_due_time(app, online):
+    scheduler, _ = _make_scheduler(app, make_plan(name="a"), make_plan(name="b"))
+
+    due_times = [entry[0] for entry in sorted(scheduler._heap)]
+
+    assert scheduler._heap[0][0] == min(due_times)
+    # One entry per job and interval.
+    assert len(scheduler._heap) == 4
+
+
+def test_due_job_is_dispatched_once(app, online):
+    scheduler, executor = _make_scheduler(app, make_plan(name="a"))
+
+    scheduler._dispatch_due_jobs()
+    scheduler._dispatch_due_jobs()
+
+    assert [name for name, _ in executor.submitted] == ["a"]
+    # The remaining intervals are planned when the job has finished.
+    assert scheduler._heap == []
+    assert scheduler._get_timeout() is None
+
+
+def test_crashed_job_is_logged_and_retried(app, online):
+    scheduler, executor = _make_scheduler(app, make_plan(name="a"), retry_interval=30)
+    scheduler._dispatch_due_jobs()
+
+    _, future = executor.submitted[0]
+    future.set_exception(RuntimeError("boom"))
+
+    scheduler._handle_finished_jobs()
+
+    assert scheduler._in_flight == set()
+    assert len(scheduler._heap) == 2
+    assert all(entry[0] > time.time() + 20 for entry in scheduler._heap)
+
+
+def test_running_job_survives_config_swap(app, online):
+    scheduler, executor = _make_scheduler(app, make_plan(name="a"))
+    scheduler._dispatch_due_jobs()
+
+    scheduler._swap_cfg(make_cfg(make_plan(name="a"), make_plan(name="b")))
+    scheduler._dispatch_due_jobs()
+
+    # 'a' is still running and must not be started a second time.
+    assert [name for name, _ in executor.submitted] == ["a", "b"]
+    assert scheduler._in_flight == {"a", "b"}
+
+    _, future = executor.submitted[0]
+    future.set_result(None)
+    scheduler._handle_finished_jobs()
+
+    # Planned again with the new config.
+    assert {entry[3] for entry in scheduler._heap} == {0}
+
+
+def test_offline_source_wakes_scheduler_when_back(app, online):
+    scheduler, executor = _make_scheduler(
+        app, make_plan(name="a", source_ip="laptop"), retry_interval=3600
+    )
+    scheduler._dispatch_due_jobs()
+
+    online["laptop"] = False
+    _, future = executor.submitted[0]
+    future.set_result(None)
+    scheduler._handle_finished_jobs()
+
+    assert scheduler._offline == {0: "laptop"}
+    assert scheduler._get_timeout() == scheduler.offline_poll_interval
+
+    scheduler._check_offline_sources()
+    scheduler._dispatch_due_jobs()
+    assert len(executor.submitted) == 1
+
+    online["laptop"] = True
+    scheduler._check_offline_sources()
+    scheduler._dispatch_due_jobs()
+
+    assert len(executor.submitted) == 2
+    assert scheduler._offline == {}
+
+
+def test_new_cfg_is_applied_when_swapped_in(app, online):
+    applied = []
+    new_cfg = make_cfg(make_plan(name="b"), max_workers=2)
+    scheduler = Scheduler(
+        app, FakeExecutor(), make_cfg(), lambda: new_cfg, apply_cfg=applied.append
+    )
+
+    scheduler._on_cfg_change()
+
+    # The watcher thread only hands over the config.
+    assert applied == []
+
+    scheduler._swap_new_cfg()
+
+    assert applied == [new_cfg]
+    assert scheduler.cfg is new_cfg
@@ -0,0 +1,36 @@
+from vhpi import shard
+
+LISTING = (
+    "drwxr-xr-x          4,096 2020/01/02 10:00:00 .\n"
+    "drwxr-xr-x          4,096 2020/01/02 10:00:00 Music\n"
+    "drwxr-xr-x          4,096 2020/01/02 10:00:00 My  Photos\n"
+    "drwxr-xr-x          4,096 2020/01/02 10:00:00  leading space\n"
+    "drwxr-xr-x          4,096 2020/01/02 10:00:00 new\\#012line\n"
+    "drwxr-xr-x  1,234,567,890 2020/01/02 10:00:00 Videos\n"
+    "-rw-r--r--             12 2020/01/02 10:00:00 notes dir.txt\n"
+    "lrwxrwxrwx              5 2020/01/02 10:00:00 link -> Music\n"
+)
+
+
+def test_parse_dir_listing_keeps_spaces():
+    assert shard.parse_dir_listing(LISTING) == [
+        "Music",
+        "My  Photos",
+        " leading space",
+        "new\nline",
+        "Videos",
+    ]
+
+
+def test_parse_total_size():
+    line = "total size is 1,234,567  speedup is 1.00"
+
+    assert shard.parse_total_size(line) == 1234567
+    assert shard.parse_total_size("sent 12 bytes") is None
+
+
+def test_order_by_size():
+    sizes = {"a": 10, "b": 30}
+
+    # 'c' has no estimate and counts as average (20).
+    assert shard.order_by_size(["a", "b", "c"], sizes) == ["b", "c", "a"]
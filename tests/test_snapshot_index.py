@@ -0,0 +1,93 @@
+import pytest
+
+from vhpi.snapshot_index import SnapshotIndex, parse_snapshot_dir
+from vhpi.types import SnapshotEntry
+
+
+@pytest.fixture
+def backup_root(tmp_path):
+    for dir_ in (
+        "2020-01-02__10:00:00__hourly.0",
+        "2020-01-02__09:00:00__hourly.1",
+        "2020-01-01__10:00:00__daily",
+        "backup.latest",
+    ):
+        (tmp_path / dir_).mkdir()
+
+    return tmp_path
+
+
+def test_parse_snapshot_dir():
+    assert parse_snapshot_dir("2020-01-02__10:00:00__hourly.3") == (
+        "2020-01-02__10:00:00",
+        "hourly",
+        3,
+    )
+    assert parse_snapshot_dir("2020-01-02__10:00:00__daily")[2] is None
+    assert parse_snapshot_dir("backup.latest") is None
+
+
+def test_rescan_reads_dir_listing(backup_root):
+    with SnapshotIndex(str(backup_root), str(backup_root / ".vhpi")) as index:
+        entries = index.get_snapshots("hourly")
+
+        assert [entry.seq for entry in entries] == [0, 1]
+        assert index.get_snapshots("daily")[0].seq is None
+
+
+def test_changes_persist(backup_root):
+    root, state_dir = str(backup_root), str(backup_root / ".vhpi")
+    old_dir = "2020-01-02__09:00:00__hourly.1"
+    new_dir = "2020-01-02__09:00:00__hourly.2"
+
+    with SnapshotIndex(root, state_dir) as index, index.transaction():
+        (backup_root / old_dir).rename(backup_root / new_dir)
+        index.rename(old_dir, new_dir)
+        index.add(
+            SnapshotEntry(
+                dir=old_dir, name="hourly", seq=1, created_at="x", files=3, size=9
+            )
+        )
+        (backup_root / old_dir).mkdir()
+
+    with SnapshotIndex(root, state_dir) as index:
+        entries = {entry.dir: entry for entry in index.get_snapshots("hourly")}
+
+    assert entries[new_dir].seq == 2
+    assert entries[old_dir].files == 3
+
+
+def test_closed_index_raises(backup_root):
+    index = SnapshotIndex(str(backup_root), str(backup_root / ".vhpi"))
+
+    with pytest.raises(RuntimeError):
+        index.get_all()
+
+    with index:
+        with pytest.raises(ValueError):
+            index.rename("2020-01-02__10:00:00__hourly.0", "backup.latest")
+
+
+def test_stable_rotation_orders_by_creation_time(tmp_path):
+    # Numbered dirs of the 'shift' mode and stable dirs mixed, as they are
+    # after switching an existing backup root to the 'stable' mode.
+    for dir_ in (
+        "2020-01-01__10:00:00__daily.1",
+        "2020-01-02__10:00:00__daily.0",
+        "2020-01-04__10:00:00__daily",
+        "2020-01-03__10:00:00__daily",
+        "2020-01-03__10:00:00__hourly",
+    ):
+        (tmp_path / dir_).mkdir()
+
+    with SnapshotIndex(str(tmp_path), str(tmp_path / ".vhpi")) as index:
+        newest_first = [entry.dir for entry in index.get_snapshots("daily")]
+        expired = [entry.dir for entry in index.get_expired("daily", 2)]
+
+    assert newest_first == [
+        "2020-01-04__10:00:00__daily",
+        "2020-01-03__10:00:00__daily",
+        "2020-01-02__10:00:00__daily.0",
+        "2020-01-01__10:00:00__daily.1",
+    ]
+    assert expired == newest_first[2:]
@@ -0,0 +1,130 @@
+import subprocess as sp
+
+import pytest
+from conftest import make_cfg, make_plan
+
+from vhpi import ssh
+from vhpi.job import get_job
+
+
+class FakeSSH:
+    """
+    Replace process.run and keep track of the master connections that ssh
+    would have started.
+    """
+
+    def __init__(self):
+        self.masters: set[str] = set()
+        self.started: list[str] = []
+        self.can_connect = True
+
+    def run(self, cmd, login_token=None, **kwargs):
+        host = cmd[-1]
+        returncode = 0
+
+        if "-M" in cmd:
+            self.started.append(host)
+
+            if self.can_connect:
+                self.masters.add(host)
+
+        elif cmd[cmd.index("-O") + 1] == "check":
+            returncode = 0 if host in self.masters else 255
+
+        else:
+            self.masters.discard(host)
+
+        return sp.CompletedProcess(cmd, returncode)
+
+
+@pytest.fixture
+def fake_ssh(monkeypatch):
+    fake = FakeSSH()
+    monkeypatch.setattr(ssh.process, "run", fake.run)
+
+    return fake
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ssh.SSHPool()
+    pool.configure(control_dir=str(tmp_path / "ssh"), enabled=True, persist=60)
+
+    return pool
+
+
+def _make_job(app, **kwargs):
+    plan = make_plan(**kwargs)
+
+    return get_job(app, plan, make_cfg(plan))
+
+
+@pytest.mark.parametrize(
+    "backup_src, host",
+    [
+        ("user@host:/home/", "user@host"),
+        ("/home/", None),
+        ("host::module/", None),
+    ],
+)
+def test_get_ssh_host(app, backup_src, host):
+    assert ssh.get_ssh_host(_make_job(app, backup_src=backup_src)) == host
+
+
+def test_master_is_shared(app, fake_ssh, pool):
+    job = _make_job(app, backup_src="user@host:/home/")
+
+    first = pool.get_rsh_option(job)
+    second = pool.get_rsh_option(job)
+
+    assert fake_ssh.started == ["user@host"]
+    assert first == second
+    assert first[0] == "-e"
+    assert f"ControlPath={pool.control_dir}/%C" in first[1]
+    assert "ControlMaster=no" in first[1]
+
+
+def test_expired_master_is_started_again(app, fake_ssh, pool):
+    job = _make_job(app, backup_src="user@host:/home/")
+    pool.get_rsh_option(job)
+
+    # The master exited after 'persist' seconds without use.
+    fake_ssh.masters.clear()
+    pool.get_rsh_option(job)
+
+    assert fake_ssh.started == ["user@host", "user@host"]
+
+
+def test_failed_master_lets_ssh_connect_on_its_own(app, fake_ssh, pool):
+    fake_ssh.can_connect = False
+
+    assert pool.get_rsh_option(_make_job(app, backup_src="user@host:/home/")) == []
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"backup_src": "/home/"},
+        {"backup_src": "user@host:/home/", "rsync_options": ("-a", "-e", "ssh")},
+    ],
+)
+def test_no_master_for_local_sources_and_custom_rsh(app, fake_ssh, pool, kwargs):
+    assert pool.get_rsh_option(_make_job(app, **kwargs)) == []
+    assert fake_ssh.started == []
+
+
+def test_disabled_pool(app, fake_ssh, tmp_path):
+    pool = ssh.SSHPool()
+    pool.configure(control_dir=str(tmp_path / "ssh"), enabled=False, persist=60)
+
+    assert pool.get_rsh_option(_make_job(app, backup_src="user@host:/home/")) == []
+    assert fake_ssh.started == []
+
+
+def test_close_all_stops_masters(app, fake_ssh, pool):
+    pool.get_rsh_option(_make_job(app, backup_src="user@a:/home/"))
+    pool.get_rsh_option(_make_job(app, backup_src="user@b:/home/"))
+
+    pool.close_all()
+
+    assert fake_ssh.masters == set()
@@ -0,0 +1,90 @@
+import os
+
+from conftest import make_cfg, make_plan
+
+from vhpi import stats
+from vhpi.job import get_job
+from vhpi.types import RsyncStats
+
+# The '--stats' output of rsync 3.2.
+STATS_OUTPUT = """
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 12 (reg: 10, dir: 2)
+Number of deleted files: 3 (reg: 3)
+Number of regular files transferred: 15
+Total file size: 123,456,789 bytes
+Total transferred file size: 1,048,576 bytes
+Literal data: 524,288 bytes
+Matched data: 524,288 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 530,000
+Total bytes received: 4,000
+
+sent 530,000 bytes  received 4,000 bytes  1,068,000.00 bytes/sec
+total size is 123,456,789  speedup is 231.19
+"""
+
+
+def _parse(output: str) -> RsyncStats:
+    parser = stats.RsyncStatsParser()
+
+    for line in output.splitlines():
+        parser.feed(line)
+
+    return parser.stats
+
+
+def test_parse_stats_output():
+    assert _parse(STATS_OUTPUT) == RsyncStats(
+        files=1234,
+        files_created=12,
+        files_deleted=3,
+        files_transferred=15,
+        total_size=123456789,
+        transferred_size=1048576,
+        literal_data=524288,
+        matched_data=524288,
+        bytes_sent=530000,
+        bytes_received=4000,
+        speedup=231.19,
+    )
+
+
+def test_file_lines_are_ignored():
+    assert _parse("docs/Number of files: 3.txt\nsending incremental file list") == (
+        RsyncStats()
+    )
+
+
+def test_with_stats_option():
+    assert stats.with_stats_option(("-a",)) == ("-a", "--stats")
+    assert stats.with_stats_option(("-a", "--stats")) == ("-a", "--stats")
+
+
+def test_merge():
+    merged = stats.merge(
+        [
+            RsyncStats(files=2, total_size=100, bytes_sent=10, duration=1),
+            RsyncStats(files=3, total_size=300, bytes_received=10, duration=2),
+        ]
+    )
+
+    assert merged.files == 5
+    assert merged.total_size == 400
+    assert merged.speedup == 20
+    assert merged.duration == 2
+
+
+def test_history_keeps_the_last_runs(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(stats, "_HISTORY_SIZE", 3)
+    plan = make_plan(backup_root=str(tmp_path))
+    job = get_job(app, plan, make_cfg(plan))
+
+    for i in range(5):
+        job.stats.run_id = str(i)
+        stats.append_history(job)
+
+    assert [r["run_id"] for r in stats.load_history(job)] == ["2", "3", "4"]
+    assert os.listdir(job.state_dir) == ["history.jsonl"]
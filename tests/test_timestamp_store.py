@@ -0,0 +1,54 @@
+import json
+import time
+from datetime import datetime
+
+from vhpi import timestamp_store
+from vhpi.timestamp_store import TimestampStore
+
+
+def _unix_time(value: str) -> int:
+    return int(time.mktime(datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timetuple()))
+
+
+def test_legacy_file_is_read(app, tmp_path):
+    (tmp_path / ".backup_timestamps").write_text(
+        'hourly: "2020-01-02 10:00:00"\ndaily: "2020-01-01 09:30:00"\nweekly: "-"\n'
+    )
+
+    timestamps = TimestampStore().load(app, str(tmp_path))
+
+    assert timestamps == {
+        "hourly": _unix_time("2020-01-02 10:00:00"),
+        "daily": _unix_time("2020-01-01 09:30:00"),
+    }
+
+
+def test_update_migrates_legacy_file(app, tmp_path):
+    legacy_file = tmp_path / ".backup_timestamps"
+    legacy_file.write_text('daily: "2020-01-01 09:30:00"\n')
+    store = TimestampStore()
+
+    store.update(app, str(tmp_path), {"hourly": 1577959200})
+
+    assert not legacy_file.exists()
+
+    with open(timestamp_store.get_timestamps_file(app, str(tmp_path))) as f:
+        assert json.load(f) == {
+            "daily": _unix_time("2020-01-01 09:30:00"),
+            "hourly": 1577959200,
+        }
+
+
+def test_external_changes_are_read(app, tmp_path):
+    store = TimestampStore()
+    store.update(app, str(tmp_path), {"hourly": 1})
+    file = timestamp_store.get_timestamps_file(app, str(tmp_path))
+
+    assert store.load(app, str(tmp_path)) == {"hourly": 1}
+
+    time.sleep(0.01)
+
+    with open(file, "w") as f:
+        json.dump({"hourly": 2}, f)
+
+    assert store.load(app, str(tmp_path)) == {"hourly": 2}
@@ -0,0 +1,104 @@
+import os
+import time
+
+import pytest
+
+from vhpi import trash
+
+
+def _wait_until(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+
+    return False
+
+
+@pytest.fixture
+def reclaimer():
+    reclaimer = trash.Reclaimer()
+    reclaimer.pause = 0
+
+    return reclaimer
+
+
+def _make_snapshot(path):
+    (path / "sub").mkdir(parents=True)
+    (path / "sub" / "file").write_text("x")
+
+    return path
+
+
+def test_move_to_trash_deletes_in_background(tmp_path, reclaimer):
+    snapshot = _make_snapshot(tmp_path / "backup" / "daily.1")
+    state_dir = str(tmp_path / "backup" / ".vhpi")
+
+    item = reclaimer.move_to_trash(state_dir, str(snapshot))
+
+    assert not snapshot.exists()
+    assert item.startswith(trash.get_trash_dir(state_dir))
+    assert _wait_until(lambda: not os.path.lexists(item))
+
+
+def test_trashed_dirs_with_the_same_name_are_kept_apart(tmp_path, reclaimer):
+    state_dir = str(tmp_path / ".vhpi")
+    os.makedirs(trash.get_trash_dir(state_dir))
+    # An item that was left in the trash and is not deleted yet.
+    os.mkdir(f"{trash.get_trash_dir(state_dir)}/daily.1")
+
+    item = reclaimer.move_to_trash(state_dir, str(_make_snapshot(tmp_path / "daily.1")))
+
+    assert item != f"{trash.get_trash_dir(state_dir)}/daily.1"
+    assert _wait_until(lambda: not os.path.lexists(item))
+
+
+def test_recover_deletes_left_over_items(tmp_path, reclaimer):
+    state_dir = str(tmp_path / ".vhpi")
+    trash_dir = trash.get_trash_dir(state_dir)
+
+    for name in ("a", "b"):
+        _make_snapshot(tmp_path / ".vhpi" / "trash" / name)
+
+    reclaimer.recover(state_dir)
+
+    assert _wait_until(lambda: os.listdir(trash_dir) == [])
+
+
+def test_recover_without_trash_dir(tmp_path, reclaimer):
+    reclaimer.recover(str(tmp_path / ".vhpi"))
+
+    assert reclaimer._thread is None
+
+
+def test_batches_skip_duplicates_and_deleted_items(tmp_path, reclaimer):
+    items = [str(_make_snapshot(tmp_path / name)) for name in ("a", "b")]
+
+    for path in [items[0], items[0], str(tmp_path / "gone"), items[1]]:
+        reclaimer._queue.put(path)
+
+    assert reclaimer._get_batch() == items
+
+
+def test_worker_pauses_between_batches(tmp_path, reclaimer, monkeypatch):
+    reclaimer.pause = 0.3
+    calls = []
+    run = trash.process.run
+
+    def record_run(cmd, *args, **kwargs):
+        # Workers of other tests may still be running.
+        if any(arg.startswith(str(tmp_path)) for arg in cmd):
+            calls.append(time.monotonic())
+        return run(cmd, *args, **kwargs)
+
+    monkeypatch.setattr(trash.process, "run", record_run)
+    state_dir = str(tmp_path / ".vhpi")
+
+    reclaimer.move_to_trash(state_dir, str(_make_snapshot(tmp_path / "a")))
+    assert _wait_until(lambda: len(calls) == 1)
+    reclaimer.move_to_trash(state_dir, str(_make_snapshot(tmp_path / "b")))
+    assert _wait_until(lambda: len(calls) == 2)
+
+    assert calls[1] - calls[0] >= 0.3
@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from vhpi import dedupe, usage
+
+SNAPSHOTS = ("2020-01-02__10:00:00__daily.0", "2020-01-01__10:00:00__daily.1")
+
+
+@pytest.fixture
+def backup_root(tmp_path):
+    root = tmp_path / "backup"
+    latest = root / "backup.latest"
+    latest.mkdir(parents=True)
+    (latest / "shared.bin").write_bytes(b"s" * 8192)
+    (latest / "changed.bin").write_bytes(b"c" * 8192)
+
+    for dir_ in SNAPSHOTS:
+        (root / dir_).mkdir()
+        os.link(latest / "shared.bin", root / dir_ / "shared.bin")
+        # A copy with the same content, which dedupe can link.
+        (root / dir_ / "changed.bin").write_bytes(b"c" * 8192)
+        os.utime(root / dir_ / "changed.bin", ns=(0, 0))
+
+    os.utime(latest / "changed.bin", ns=(0, 0))
+
+    return root
+
+
+def _get_usage(root):
+    result = usage.get_usage(str(root), str(root / ".vhpi"))
+
+    return result, {tree.dir: tree for tree in result.trees}
+
+
+def test_intra_tree_links_are_exclusive(backup_root):
+    os.link(
+        backup_root / SNAPSHOTS[1] / "changed.bin",
+        backup_root / SNAPSHOTS[1] / "changed_link.bin",
+    )
+
+    result, trees = _get_usage(backup_root)
+
+    assert result.scanned == 3
+    assert set(trees) == {"backup.latest", *SNAPSHOTS}
+    assert trees[SNAPSHOTS[1]].files == 3
+    assert trees[SNAPSHOTS[1]].shared == 8192
+    assert trees[SNAPSHOTS[1]].exclusive >= 8192
+    # Each inode is counted once.
+    dirs = sum(os.stat(backup_root / tree).st_blocks * 512 for tree in trees)
+    assert abs(result.total - dirs - 4 * 8192) <= 1
+
+
+def test_snapshots_are_cached(backup_root):
+    _get_usage(backup_root)
+
+    result, trees = _get_usage(backup_root)
+
+    # Only 'backup.latest' is walked again.
+    assert result.scanned == 1
+    assert trees[SNAPSHOTS[0]].shared == 8192
+    assert trees[SNAPSHOTS[0]].exclusive >= 8192
+
+    with open(backup_root / ".vhpi" / "usage_cache.json") as f:
+        assert len(json.load(f)["trees"]) == 2
+
+
+def test_cache_is_dropped_when_a_snapshot_is_removed(backup_root):
+    _get_usage(backup_root)
+    shutil.rmtree(backup_root / SNAPSHOTS[1])
+
+    result, trees = _get_usage(backup_root)
+
+    assert result.scanned == 2
+    assert set(trees) == {"backup.latest", SNAPSHOTS[0]}
+
+
+def test_dedupe_invalidates_changed_trees(backup_root):
+    state_dir = str(backup_root / ".vhpi")
+    _get_usage(backup_root)
+
+    stats = dedupe.run({str(backup_root): state_dir}, min_size=1)
+
+    assert stats.duplicates == 2
+
+    result, trees = _get_usage(backup_root)
+
+    assert result.scanned == 3
+    # All files are linked in every tree now.
+    assert trees[SNAPSHOTS[0]].exclusive < trees[SNAPSHOTS[0]].shared
+
+
+def test_dedupe_dry_run_keeps_cache(backup_root):
+    state_dir = str(backup_root / ".vhpi")
+    _get_usage(backup_root)
+
+    stats = dedupe.run({str(backup_root): state_dir}, min_size=1, dry_run=True)
+
+    assert stats.duplicates == 2
+    assert _get_usage(backup_root)[0].scanned == 1
+
+
+def test_invalidate_ignores_missing_trees(backup_root):
+    state_dir = str(backup_root / ".vhpi")
+    _get_usage(backup_root)
+
+    usage.invalidate(str(backup_root), state_dir, ["missing", SNAPSHOTS[1]])
+
+    assert _get_usage(backup_root)[0].scanned == 2
@@ -21,11 +21,16 @@
 
 Usage:
     vhpi run [options]
+    vhpi dedupe [--dry-run] [--min-size BYTES] [options]
+    vhpi status [options]
+    vhpi usage [options]
     vhpi -h | --help
     vhpi --version
 
 Options:
     -c, --config-dir PATH             Set a custom config dir.
+        --dry-run                     Only report duplicate files.
+        --min-size BYTES              Ignore smaller files [default: 1048576].
     -h, --help                        Show this screen.
         --version                     Show version.
 """
@@ -34,7 +39,8 @@ import fcntl
 import os
 import sys
 import time
-from typing import Any
+from functools import partial
+from typing import Any, Optional
 
 import oyaml as yaml
 from docopt import docopt
@@ -45,9 +51,25 @@ from pkg_resources import (
     resource_filename,
 )
 
-from . import job, lib
+from . import (
+    config,
+    dedupe,
+    job,
+    lib,
+    metrics,
+    reachability,
+    resources,
+    snapshot,
+    ssh,
+    timestamp_store,
+    trash,
+    usage,
+)
+from .executor import JobExecutor
+from .scheduler import Scheduler
+from .snapshot_index import SnapshotIndex
 from .logging import log
-from .types import App
+from .types import App, Config
 
 
 def _load_user_cfg(user_cfg_file):
@@ -112,6 +134,7 @@ def get_app(args: dict[str, Any]) -> App:
         cfg_file=cfg_file,
         log_dir=log_dir,
         timestamp_file_name=".backup_timestamps",
+        state_dir_name=".vhpi",
         timestamp_format="%Y-%m-%d %H:%M:%S",
     )
 
@@ -144,24 +167,210 @@ def _handle_lock(lockfile: str, func, **kwargs):
         sys.exit(0)
 
 
+def _configure(cfg: Config) -> None:
+    """
+    Apply the app settings that may change with a reloaded config.
+    """
+    trash.reclaimer.pause = cfg.app_cfg.get("trash_pause", 1)
+
+    log.configure(
+        rsync_debug_sample=cfg.app_cfg.get("log_rsync_sample", 1),
+        log_format=cfg.app_cfg.get("log_format", "text"),
+    )
+
+    metrics.exporter.configure(
+        listen=str(cfg.app_cfg.get("metrics_listen") or ""),
+        textfile=cfg.app_cfg.get("metrics_textfile") or "",
+    )
+
+    resources.limiter.configure(
+        disk_slots=cfg.app_cfg.get("io_slots_per_disk", 0),
+        host_slots=cfg.app_cfg.get("rsync_slots_per_host", 0),
+        bwlimit=cfg.app_cfg.get("bwlimit_per_disk", 0),
+        ionice=cfg.app_cfg.get("ionice"),
+    )
+
+    reachability.checker.configure(
+        method=cfg.app_cfg.get("reachability_probe", "tcp"),
+        port=cfg.app_cfg.get("reachability_port", 22),
+        timeout=cfg.app_cfg.get("reachability_timeout", 2),
+        ttl=cfg.app_cfg.get("reachability_ttl", 10),
+    )
+
+
+def _reload_cfg(app: App, login_tokens: dict[str, bytes]) -> Optional[Config]:
+    """
+    Parse the changed config file. This runs in the watcher thread without a
+    terminal, so jobs with new remote sources are left out. The settings are
+    applied by the scheduler, see _configure().
+    """
+    user_cfg_raw = config.read(app.cfg_file)
+
+    if user_cfg_raw is None:
+        return None
+
+    return config.parse(app, user_cfg_raw, login_tokens, request_logins=False)
+
+
 def run_backups(app: App):
 
-    user_cfg_raw = _load_user_cfg(app.cfg_file)
+    login_tokens: dict[str, bytes] = {}
+    cfg = config.parse(app, _load_user_cfg(app.cfg_file), login_tokens)
+
+    _configure(cfg)
+
+    # Resume the deletion of snapshots that were trashed before a restart and
+    # finish snapshot runs that were interrupted.
+    for plan in cfg.jobs:
+        trash.reclaimer.recover(f"{plan.backup_root}/{app.state_dir_name}")
+
+        if os.path.isdir(plan.backup_root):
+            job_ = job.get_job(app, plan, cfg)
+            snapshot.recover(app, job_)
+            metrics.record_snapshots(
+                plan.name,
+                job_.backup_root,
+                job_.state_dir,
+                plan.snapshots,
+                timestamp_store.store.load(app, plan.backup_root),
+            )
+
+    ssh.pool.configure(
+        control_dir=f"{app.cfg_dir}/ssh",
+        enabled=cfg.app_cfg.get("ssh_multiplexing", True),
+        persist=cfg.app_cfg.get("ssh_persist", 600),
+    )
+
+    executor = JobExecutor(
+        max_workers=cfg.app_cfg.get("max_workers", 1),
+        max_workers_per_disk=cfg.app_cfg.get("max_workers_per_disk", 0),
+    )
+
+    scheduler = Scheduler(
+        app,
+        executor,
+        cfg=cfg,
+        load_cfg=partial(_reload_cfg, app, login_tokens),
+        apply_cfg=_configure,
+    )
+
+    try:
+        scheduler.run()
+
+    finally:
+        scheduler.stop()
+        executor.shutdown()
+        ssh.pool.close_all()
+        metrics.exporter.close()
+
+
+def run_dedupe(app: App, dry_run: bool, min_size: int):
+    """
+    Replace identical files in the backup roots of all jobs with hardlinks.
+    """
+    cfg = config.parse(app, _load_user_cfg(app.cfg_file))
+    backup_roots = {}
+
+    for plan in cfg.jobs:
+        if os.path.isdir(plan.backup_root):
+            backup_root = os.path.normpath(plan.backup_root)
+            backup_roots[backup_root] = f"{backup_root}/{app.state_dir_name}"
+
+    stats = dedupe.run(backup_roots, min_size=min_size, dry_run=dry_run)
+
+    log.info(
+        log.lvl0_ts_msg(
+            f"[Dedupe] {'Found' if dry_run else 'Linked'} {stats.duplicates} "
+            f"duplicates ({stats.linked} paths) of {stats.files} files, "
+            f"{'can save' if dry_run else 'saved'} {stats.saved_bytes} bytes. "
+            f"Hashed {stats.hashed_bytes} bytes in {stats.duration}s, "
+            f"{stats.errors} errors."
+        )
+    )
+
+
+def _format_size(size: Optional[int]) -> str:
+    if size is None:
+        return "-"
+
+    value = float(size)
+
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if value < 1024:
+            return f"{value:.0f} {unit}"
+        value /= 1024
+
+    return f"{value:.1f} TiB"
+
+
+def run_status(app: App):
+    """
+    Print the snapshots of each job, as they are recorded in the snapshot
+    index of its backup root.
+    """
+    cfg = config.parse(app, _load_user_cfg(app.cfg_file))
+
+    for plan in cfg.jobs:
+        if not os.path.isdir(plan.backup_root):
+            print(f"\n{plan.backup_root}: Backup destination does not exist.")
+            continue
+
+        backup_root = os.path.normpath(plan.backup_root)
+        timestamps = timestamp_store.store.load(app, backup_root)
+
+        print(f"\n{backup_root} ({plan.backup_src})")
+
+        state_dir = f"{backup_root}/{app.state_dir_name}"
 
-    for job_raw in user_cfg_raw["jobs"]:
-        rsync_src = job_raw.get("rsync_src", "")
+        with SnapshotIndex(backup_root, state_dir) as index:
+            entries = index.get_all()
 
-        if ":" in rsync_src:
-            job_raw["login_token"] = lib.write_login(rsync_src)
-        else:
-            job_raw["login_token"] = None
+        for name, keep_amount in plan.snapshots.items():
+            snapshots = [entry for entry in entries if entry.name == name]
+            newest = snapshots[0] if snapshots else None
+            files = newest.files if newest else None
+            timestamp = timestamps.get(name)
+            last = "never"
 
-    while True:
+            if timestamp:
+                last = time.strftime(app.timestamp_format, time.localtime(timestamp))
 
-        for job_raw in user_cfg_raw["jobs"]:
-            job.run(app, job_raw, user_cfg_raw)
+            print(
+                f"    {name:<12} {len(snapshots):>3}/{keep_amount:<3} "
+                f"last: {last:<19}  "
+                f"files: {'-' if files is None else files:<9} "
+                f"size: {_format_size(newest.size if newest else None)}"
+            )
+
+
+def run_usage(app: App):
+    """
+    Print the disk space that each snapshot of each job uses by itself and
+    shares with other snapshots.
+    """
+    cfg = config.parse(app, _load_user_cfg(app.cfg_file))
+
+    for plan in cfg.jobs:
+        if not os.path.isdir(plan.backup_root):
+            print(f"\n{plan.backup_root}: Backup destination does not exist.")
+            continue
+
+        backup_root = os.path.normpath(plan.backup_root)
+        root_usage = usage.get_usage(backup_root, f"{backup_root}/{app.state_dir_name}")
+
+        print(f"\n{backup_root} ({plan.backup_src})")
+        print(f"    {'':<40} {'files':>9} {'exclusive':>11} {'shared':>11}")
 
-        time.sleep(10)
+        for tree in root_usage.trees:
+            print(
+                f"    {tree.dir:<40} {tree.files:>9} "
+                f"{_format_size(tree.exclusive):>11} {_format_size(tree.shared):>11}"
+            )
+
+        print(
+            f"    Total: {_format_size(root_usage.total)} "
+            f"(scanned {root_usage.scanned} trees in {root_usage.duration}s)"
+        )
 
 
 def startup() -> None:
@@ -174,7 +383,23 @@ def startup() -> None:
     log.update(app)
 
     if args.get("run"):
-        _handle_exceptions(_handle_lock(f"{app.cfg_dir}/lock", run_backups, app=app))
+        _handle_exceptions(
+            partial(_handle_lock, f"{app.cfg_dir}/lock", run_backups), app=app
+        )
+
+    elif args.get("status"):
+        _handle_exceptions(run_status, app=app)
+
+    elif args.get("usage"):
+        _handle_exceptions(run_usage, app=app)
+
+    elif args.get("dedupe"):
+        _handle_exceptions(
+            partial(_handle_lock, f"{app.cfg_dir}/dedupe.lock", run_dedupe),
+            app=app,
+            dry_run=args["--dry-run"],
+            min_size=int(args["--min-size"]),
+        )
 
 
 if __name__ == "__main__":
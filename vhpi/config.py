@@ -0,0 +1,454 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import select
+import shlex
+import struct
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import oyaml as yaml
+
+from . import lib
+from .logging import log
+from .types import App, Config, JobPlan, SnapshotIntervals
+
+# (st_ino, st_size, st_mtime_ns) of the config file, None if it is missing.
+CfgSignature = Optional[tuple[int, int, int]]
+
+# inotify events of the config dir, that may change the config file. The dir
+# is watched instead of the file, because editors often replace the file.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+# struct inotify_event: wd, mask, cookie, len, followed by 'len' bytes of name.
+_IN_EVENT = struct.Struct("iIII")
+
+# Filter files that are no longer used by the config are removed after this
+# many seconds, so that jobs of the previous config can still use them.
+_FILTER_FILE_MAX_AGE = 7 * 86400
+
+
+def read(cfg_file: str) -> Optional[dict[str, Any]]:
+    """
+    Read the config file. Returns None if it can't be read or parsed.
+    """
+    try:
+        with open(cfg_file, "r") as f:
+            return yaml.safe_load(f) or {}
+
+    except (OSError, yaml.YAMLError) as e:
+        log.error(log.lvl0_ts_msg(f"[Error] Could not read config file: {e}"))
+        return None
+
+
+def _validate_src_and_dst(backup_src, backup_root) -> bool:
+
+    if not isinstance(backup_src, str):
+        log.lvl0_cfg_type_error("rsync_src", "string")
+        return False
+
+    if not isinstance(backup_root, str):
+        log.lvl0_cfg_type_error("rsync_dst", "string")
+        return False
+
+    if backup_src == "":
+        log.lvl0_cfg_empty_item("rsync_src")
+        return False
+
+    if backup_root == "":
+        log.lvl0_cfg_empty_item("rsync_dst")
+        return False
+
+    if backup_src.split(":")[-1][0] != "/":
+        log.lvl0_cfg_no_absolute_path_error("rsync_src")
+        return False
+
+    if ":" in backup_root:
+        log.lvl0_cfg_backup_dst_must_be_local()
+        return False
+
+    if backup_root[0] != "/":
+        log.lvl0_cfg_no_absolute_path_error("rsync_dst")
+        return False
+
+    return True
+
+
+def _unescape_path(path: str) -> str:
+    """
+    Paths are passed to rsync as separate arguments, spaces that were escaped
+    for the shell are plain spaces now.
+    """
+    return path.replace("\\ ", " ")
+
+
+def _get_excludes(
+    job_raw: dict[str, Any],
+    exclude_lib: dict[str, list[str]],
+) -> Optional[tuple[str, ...]]:
+    excludes = list(job_raw.get("excludes") or [])
+
+    for list_name in job_raw.get("exclude_lists") or []:
+        if list_name not in exclude_lib:
+            log.lvl0_cfg_unknown_item("exclude_lib", list_name)
+            return None
+
+        excludes.extend(exclude_lib[list_name] or [])
+
+    return tuple(dict.fromkeys(str(item) for item in excludes))
+
+
+def get_filter_dir(app: App) -> str:
+    return f"{app.cfg_dir}/filters"
+
+
+def _get_filter_file(filter_dir: str, excludes: tuple[str, ...]) -> Optional[str]:
+    """
+    Write the excludes to an rsync filter file, which is named after the hash
+    of its content. Jobs with the same excludes share the file and it is only
+    written again if the excludes change.
+    """
+    if not excludes:
+        return None
+
+    # All rules are excludes, so their order does not matter.
+    content = "".join(f"- {item}\n" for item in sorted(excludes)).encode()
+    digest = hashlib.sha256(content).hexdigest()[:16]
+    filter_file = f"{filter_dir}/excludes-{digest}.rules"
+
+    if os.path.isfile(filter_file):
+        # Mark the file as used, see _remove_unused_filter_files().
+        os.utime(filter_file)
+        return filter_file
+
+    os.makedirs(filter_dir, exist_ok=True)
+
+    with open(f"{filter_file}.tmp", "wb") as f:
+        f.write(content)
+
+    os.replace(f"{filter_file}.tmp", filter_file)
+
+    return filter_file
+
+
+def _remove_unused_filter_files(filter_dir: str, used: set[str]) -> None:
+
+    if not os.path.isdir(filter_dir):
+        return
+
+    expired_at = time.time() - _FILTER_FILE_MAX_AGE
+
+    for entry in os.scandir(filter_dir):
+        try:
+            if entry.path not in used and entry.stat().st_mtime < expired_at:
+                os.unlink(entry.path)
+        except OSError:
+            continue
+
+
+def _get_plan(
+    job_raw: dict[str, Any],
+    app_cfg: dict[str, Any],
+    intervals: SnapshotIntervals,
+    login_token: Optional[bytes],
+    filter_dir: str,
+) -> Optional[JobPlan]:
+
+    backup_src = job_raw.get("rsync_src")
+    backup_root = job_raw.get("rsync_dst")
+
+    if not _validate_src_and_dst(backup_src, backup_root):
+        return None
+
+    snapshots = job_raw.get("snapshots") or {}
+
+    if not isinstance(snapshots, dict):
+        log.lvl0_cfg_type_error("snapshots", "mapping")
+        return None
+
+    for name in snapshots:
+        if name not in intervals:
+            log.lvl0_cfg_unknown_item("intervals", name)
+            return None
+
+    excludes = _get_excludes(job_raw, app_cfg.get("exclude_lib") or {})
+
+    if excludes is None:
+        return None
+
+    rsync_shards = job_raw.get("rsync_shards", 1)
+
+    # Without a trailing slash the source dir itself is synced. Its sub dirs
+    # would be synced one level deeper, where anchored excludes don't match.
+    if rsync_shards > 1 and not str(backup_src).endswith("/"):
+        log.warning(
+            log.lvl0_ts_msg(
+                f'[Warning] "rsync_shards" requires an "rsync_src" with a '
+                f"trailing slash, syncing with one process: {backup_src}"
+            )
+        )
+        rsync_shards = 1
+
+    return JobPlan(
+        name=job_raw.get("name", "job-with-no-name"),
+        login_token=login_token,
+        source_ip=job_raw.get("source_ip", "no-ip-given"),
+        # Both were validated to be strings.
+        backup_src=_unescape_path(str(backup_src)),
+        backup_root=_unescape_path(str(backup_root)),
+        rsync_options=tuple(shlex.split(job_raw.get("rsync_options", ""))),
+        excludes=excludes,
+        exclude_file=_get_filter_file(filter_dir, excludes),
+        incremental=job_raw.get("incremental", False),
+        full_sync_every=job_raw.get("full_sync_every", 24),
+        rsync_shards=rsync_shards,
+        hardlink_engine=app_cfg.get("hardlink_engine", "native"),
+        share_snapshots=app_cfg.get("share_snapshots", False),
+        snapshot_rotation=app_cfg.get("snapshot_rotation", "shift"),
+        snapshot_aliases=app_cfg.get("snapshot_aliases", False),
+        snapshots=dict(snapshots),
+    )
+
+
+def parse(
+    app: App,
+    user_cfg_raw: dict[str, Any],
+    login_tokens: Optional[dict[str, bytes]] = None,
+    request_logins: bool = True,
+) -> Config:
+    """
+    Validate the config and compute the plans of all jobs. Invalid jobs are
+    reported and left out. The excludes of the jobs are written to filter
+    files in the config dir.
+    @login_tokens: Tokens of remote sources, missing ones are requested from
+    the user. Without it no logins are attached to the plans.
+    @request_logins: If False, jobs whose remote source has no token yet are
+    reported and left out instead.
+    """
+    app_cfg = user_cfg_raw.get("app_cfg") or {}
+    intervals = app_cfg.get("intervals") or {}
+    filter_dir = get_filter_dir(app)
+    plans = []
+
+    for job_raw in user_cfg_raw.get("jobs") or []:
+        rsync_src = job_raw.get("rsync_src", "")
+        login_token = None
+
+        if login_tokens is not None and ":" in str(rsync_src):
+            if rsync_src not in login_tokens:
+                if not request_logins:
+                    log.error(
+                        log.lvl0_ts_msg(
+                            f"[Error] No password was entered for the new source "
+                            f'"{rsync_src}". Restart vhpi to add the job.'
+                        )
+                    )
+                    continue
+
+                login_tokens[rsync_src] = lib.write_login(rsync_src)
+
+            login_token = login_tokens[rsync_src]
+
+        plan = _get_plan(job_raw, app_cfg, intervals, login_token, filter_dir)
+
+        if plan:
+            plans.append(plan)
+
+    _remove_unused_filter_files(
+        filter_dir, {plan.exclude_file for plan in plans if plan.exclude_file}
+    )
+
+    return Config(app_cfg=app_cfg, intervals=intervals, jobs=tuple(plans))
+
+
+def _get_signature(cfg_file: str) -> CfgSignature:
+    try:
+        stat = os.stat(cfg_file)
+    except OSError:
+        return None
+
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _init_inotify(path: str) -> Optional[int]:
+    """
+    Watch a dir with inotify. Returns None if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(path), _IN_MASK) < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _read_events(fd: int) -> list[tuple[int, bytes]]:
+    """
+    Read all pending inotify events as (mask, name) pairs.
+    """
+    events: list[tuple[int, bytes]] = []
+
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return events
+
+        offset = 0
+
+        while offset < len(data):
+            _, mask, _, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            events.append((mask, data[offset : offset + length].rstrip(b"\0")))
+            offset += length
+
+
+class CfgWatcher:
+    """
+    Call 'on_change' in a background thread, when the content of the config
+    file was changed. The config dir is watched with inotify, without inotify
+    the config file is polled every 'poll_interval' seconds.
+
+    Editors often save a file in several steps, so changes are only reported
+    after 'settle_time' seconds without further events and only if the file
+    exists.
+    """
+
+    def __init__(
+        self,
+        cfg_file: str,
+        on_change: Callable[[], None],
+        poll_interval: float = 5,
+        settle_time: float = 0.5,
+    ):
+        self.cfg_file = os.path.realpath(cfg_file)
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+
+        self._name = os.fsencode(os.path.basename(self.cfg_file))
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _wait_for_event(self, fd: int) -> Optional[bool]:
+        """
+        Wait up to a second for events of the config file.
+        Returns None if the watch was removed, e.g. with the config dir.
+        """
+        if not select.select([fd], [], [], 1)[0]:
+            return False
+
+        matched = False
+
+        for mask, name in _read_events(fd):
+            if mask & _IN_IGNORED:
+                return None
+
+            if mask & _IN_Q_OVERFLOW or name == self._name:
+                matched = True
+
+        return matched
+
+    def _settle(self, fd: int) -> bool:
+        """
+        Wait until the editor is done, i.e. for 'settle_time' seconds without
+        events. Returns False if the watch was removed in the meantime.
+        """
+        while not self._stop.wait(self.settle_time):
+            events = _read_events(fd)
+
+            if not events:
+                break
+
+            if any(mask & _IN_IGNORED for mask, _ in events):
+                return False
+
+        return True
+
+    def _watch(self) -> None:
+        cfg_dir = os.path.dirname(self.cfg_file)
+        fd = _init_inotify(cfg_dir)
+        use_inotify = fd is not None
+        last_signature = _get_signature(self.cfg_file)
+
+        if fd is None:
+            log.debug(log.lvl1_ts_msg("inotify not available, poll config file."))
+
+        try:
+            while not self._stop.is_set():
+
+                if fd is None:
+                    self._stop.wait(self.poll_interval)
+
+                    # Watch the config dir again, once it was re-created.
+                    if use_inotify:
+                        fd = _init_inotify(cfg_dir)
+
+                else:
+                    event = self._wait_for_event(fd)
+
+                    if event is False:
+                        continue
+
+                    if event is None or not self._settle(fd):
+                        # The config dir was removed or replaced. Poll until
+                        # it can be watched again.
+                        log.debug(
+                            log.lvl1_ts_msg(
+                                f"Lost the watch of the config dir: {cfg_dir}"
+                            )
+                        )
+                        os.close(fd)
+                        fd = None
+
+                signature = _get_signature(self.cfg_file)
+
+                if signature and signature != last_signature:
+                    last_signature = signature
+                    self.on_change()
+
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._watch, name="vhpi-cfg-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
@@ -0,0 +1,492 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import json
+import os
+import re
+import secrets
+import stat
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from typing import Optional
+
+from . import lib, usage
+from .logging import log
+from .types import BackupRoot, StateDir
+
+Inode = int
+Device = int
+
+# Files can only be replaced by each other, if these attributes are equal:
+# (size, mode, uid, gid, mtime_ns), as well as their content and their extended
+# attributes (which include ACLs).
+FileMeta = tuple[int, int, int, int, int]
+
+# The sorted (name, value) pairs of the extended attributes of a file.
+Xattrs = tuple[tuple[str, bytes], ...]
+
+# The cached hashes of an inode: (size, mtime_ns, partial_hash, full_hash)
+HashEntry = tuple[int, int, bytes, Optional[bytes]]
+HashIndex = dict[Inode, HashEntry]
+
+# The amount of bytes at the start of a file, which are hashed first.
+_PARTIAL_SIZE = 64 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+
+# The names of the temporary links of an interrupted run:
+# '.<name>.<16 random hex digits>.vhpi-dedupe'
+_TMP_PATTERN = re.compile(r"\..+\.[0-9a-f]{16}\.vhpi-dedupe", re.DOTALL)
+
+
+@dataclass
+class DedupeStats:
+    files: int = 0
+    candidates: int = 0
+    hashed_bytes: int = 0
+    duplicates: int = 0
+    linked: int = 0
+    saved_bytes: int = 0
+    errors: int = 0
+    duration: float = 0
+
+
+@dataclass
+class _InodeInfo:
+    meta: FileMeta
+    nlink: int
+    # The state dir of the backup root, in which the inode was found first.
+    state_dir: StateDir
+    paths: list[str] = field(default_factory=list)
+
+
+def _get_index_file(state_dir: StateDir) -> str:
+    return f"{state_dir}/dedupe_index.json"
+
+
+def _load_index(state_dir: StateDir) -> HashIndex:
+    """
+    Load the index, which is stored as '{inode: [size, mtime_ns, partial_hash,
+    full_hash]}' with hex encoded hashes.
+    """
+    try:
+        with open(_get_index_file(state_dir)) as f:
+            data = json.load(f)
+
+        return {
+            int(ino): (
+                size,
+                mtime_ns,
+                bytes.fromhex(partial),
+                None if full is None else bytes.fromhex(full),
+            )
+            for ino, (size, mtime_ns, partial, full) in data.items()
+        }
+
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def _save_index(state_dir: StateDir, index: HashIndex) -> None:
+    os.makedirs(state_dir, exist_ok=True)
+    index_file = _get_index_file(state_dir)
+    data = {
+        ino: [size, mtime_ns, partial.hex(), None if full is None else full.hex()]
+        for ino, (size, mtime_ns, partial, full) in index.items()
+    }
+
+    with open(f"{index_file}.tmp", "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+
+    os.replace(f"{index_file}.tmp", index_file)
+
+
+def _scan(
+    backup_root: BackupRoot,
+    state_dir: StateDir,
+    min_size: int,
+    inodes: dict[tuple[Device, Inode], _InodeInfo],
+    dry_run: bool,
+    stats: DedupeStats,
+) -> None:
+    """
+    Walk a backup root once and collect all regular files of at least
+    'min_size' bytes, grouped by inode. State dirs and other filesystems are
+    not entered. Temporary links of an interrupted run are removed, unless
+    this is a dry run.
+    """
+    root_dev = os.stat(backup_root).st_dev
+    stack = [backup_root]
+
+    while stack:
+        dir_ = stack.pop()
+
+        try:
+            entries = list(os.scandir(dir_))
+        except OSError as e:
+            log.warning(f"    Warning: Could not scan dir: {dir_}: {e}")
+            continue
+
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if st.st_dev != root_dev:
+                continue
+
+            if stat.S_ISDIR(st.st_mode):
+                if entry.path != state_dir:
+                    stack.append(entry.path)
+                continue
+
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            # A temporary link is always a second link of a file.
+            if st.st_nlink > 1 and _TMP_PATTERN.fullmatch(entry.name):
+                if not dry_run:
+                    os.unlink(entry.path)
+                continue
+
+            stats.files += 1
+
+            if st.st_size < min_size:
+                continue
+
+            key = (st.st_dev, st.st_ino)
+            info = inodes.get(key)
+
+            if info is None:
+                meta = (st.st_size, st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns)
+                info = inodes[key] = _InodeInfo(meta, st.st_nlink, state_dir)
+
+            info.paths.append(entry.path)
+
+
+def _hash_file(path: str, limit: Optional[int] = None) -> bytes:
+    h = hashlib.blake2b(digest_size=20)
+    remaining = limit
+
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            size = _CHUNK_SIZE if remaining is None else min(_CHUNK_SIZE, remaining)
+            chunk = f.read(size)
+
+            if not chunk:
+                break
+
+            h.update(chunk)
+
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    return h.digest()
+
+
+def _get_hash(
+    ino: Inode,
+    info: _InodeInfo,
+    index: HashIndex,
+    full: bool,
+    stats: DedupeStats,
+) -> bytes:
+    """
+    Get the partial or full hash of an inode. Hashes are taken from the index
+    as long as size and mtime of the inode did not change.
+    """
+    size, _, _, _, mtime_ns = info.meta
+    entry = index.get(ino)
+
+    if entry is None or entry[:2] != (size, mtime_ns):
+        partial = _hash_file(info.paths[0], _PARTIAL_SIZE)
+        stats.hashed_bytes += min(size, _PARTIAL_SIZE)
+
+        # The partial hash covers small files completely.
+        entry = (size, mtime_ns, partial, partial if size <= _PARTIAL_SIZE else None)
+        index[ino] = entry
+
+    if not full:
+        return entry[2]
+
+    full_hash = entry[3]
+
+    if full_hash is None:
+        full_hash = _hash_file(info.paths[0])
+        stats.hashed_bytes += size
+        index[ino] = (*entry[:3], full_hash)
+
+    return full_hash
+
+
+def _group_by_hash(
+    inos: list[Inode],
+    inodes: dict[Inode, _InodeInfo],
+    index: HashIndex,
+    full: bool,
+    stats: DedupeStats,
+) -> list[list[Inode]]:
+    groups: dict[bytes, list[Inode]] = defaultdict(list)
+
+    for ino in inos:
+        try:
+            groups[_get_hash(ino, inodes[ino], index, full, stats)].append(ino)
+        except OSError as e:
+            log.debug(f"    Could not hash: {inodes[ino].paths[0]}: {e}")
+            stats.errors += 1
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _get_xattrs(path: str) -> Xattrs:
+    """
+    Get the extended attributes of a file. ACLs are stored as extended
+    attributes, so they are compared as well.
+    """
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            return ()
+        raise
+
+    return tuple(
+        sorted((name, os.getxattr(path, name, follow_symlinks=False)) for name in names)
+    )
+
+
+def _group_by_xattrs(
+    inos: list[Inode],
+    inodes: dict[Inode, _InodeInfo],
+    stats: DedupeStats,
+) -> list[list[Inode]]:
+    groups: dict[Xattrs, list[Inode]] = defaultdict(list)
+
+    for ino in inos:
+        try:
+            groups[_get_xattrs(inodes[ino].paths[0])].append(ino)
+        except OSError as e:
+            log.debug(f"    Could not read xattrs: {inodes[ino].paths[0]}: {e}")
+            stats.errors += 1
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _replace_with_link(target: str, path: str, expected_ino: Inode) -> None:
+    """
+    Atomically replace 'path' with a hardlink to 'target'. The mtime of the
+    parent dir is kept, so that snapshots stay unchanged.
+    """
+    parent = os.path.dirname(path)
+    tmp = f"{parent}/.{os.path.basename(path)}.{secrets.token_hex(8)}.vhpi-dedupe"
+    parent_st = os.stat(parent)
+
+    os.link(target, tmp, follow_symlinks=False)
+
+    try:
+        if os.lstat(path).st_ino != expected_ino:
+            raise FileNotFoundError(f"File changed during dedupe: {path}")
+
+        os.replace(tmp, path)
+
+    finally:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+
+    os.utime(parent, ns=(parent_st.st_atime_ns, parent_st.st_mtime_ns))
+
+
+def _link_duplicates(
+    group: list[Inode],
+    inodes: dict[Inode, _InodeInfo],
+    dry_run: bool,
+    stats: DedupeStats,
+    changed: set[str],
+) -> None:
+    """
+    Keep the inode with the most links and point all paths of the other
+    inodes of the group to it.
+    @changed: Collects the paths whose inode or link count changed. Nothing
+    is added in a dry run.
+    """
+    keep = max(group, key=lambda ino: (inodes[ino].nlink, -ino))
+    target = inodes[keep].paths[0]
+
+    for ino in group:
+
+        if ino == keep:
+            continue
+
+        info = inodes[ino]
+        stats.duplicates += 1
+        replaced = 0
+
+        for path in info.paths:
+            log.debug(log.lvl1_ts_msg(f"[Dedupe] {path} -> {target}"))
+
+            if dry_run:
+                replaced += 1
+                continue
+
+            try:
+                if os.lstat(target).st_ino != keep:
+                    raise FileNotFoundError(f"File changed during dedupe: {target}")
+
+                _replace_with_link(target, path, ino)
+                replaced += 1
+
+            except OSError as e:
+                log.warning(f"    Warning: Could not dedupe: {path}: {e}")
+                stats.errors += 1
+
+        stats.linked += replaced
+
+        # The paths that were not replaced lost links as well.
+        if replaced and not dry_run:
+            changed.update(info.paths)
+            changed.update(inodes[keep].paths)
+
+        # The space of an inode is only freed, if all its links are replaced.
+        if replaced == info.nlink:
+            stats.saved_bytes += info.meta[0]
+
+
+def _dedupe(
+    backup_roots: dict[BackupRoot, StateDir],
+    min_size: int,
+    dry_run: bool,
+    stats: DedupeStats,
+    changed: set[str],
+) -> None:
+    inodes: dict[tuple[Device, Inode], _InodeInfo] = {}
+
+    for backup_root, state_dir in backup_roots.items():
+        log.info(log.lvl0_ts_msg(f"[Dedupe] Scan: {backup_root}"))
+        _scan(backup_root, state_dir, min_size, inodes, dry_run, stats)
+
+    # Hardlinks cannot span filesystems, so each device is deduplicated
+    # separately.
+    by_device: dict[Device, dict[Inode, _InodeInfo]] = defaultdict(dict)
+
+    for (dev, ino), info in inodes.items():
+        by_device[dev][ino] = info
+
+    for dev_inodes in by_device.values():
+        index: HashIndex = {}
+
+        for state_dir in {info.state_dir for info in dev_inodes.values()}:
+            index.update(_load_index(state_dir))
+
+        by_meta: dict[FileMeta, list[Inode]] = defaultdict(list)
+
+        for ino, info in dev_inodes.items():
+            by_meta[info.meta].append(ino)
+
+        for same_meta in by_meta.values():
+
+            if len(same_meta) < 2:
+                continue
+
+            stats.candidates += len(same_meta)
+
+            for same_start in _group_by_hash(
+                same_meta, dev_inodes, index, False, stats
+            ):
+                for same_content in _group_by_hash(
+                    same_start, dev_inodes, index, True, stats
+                ):
+                    for same_xattrs in _group_by_xattrs(
+                        same_content, dev_inodes, stats
+                    ):
+                        _link_duplicates(
+                            same_xattrs, dev_inodes, dry_run, stats, changed
+                        )
+
+        if dry_run:
+            continue
+
+        # Each backup root keeps the hashes of the inodes found in it.
+        for state_dir in {info.state_dir for info in dev_inodes.values()}:
+            _save_index(
+                state_dir,
+                {
+                    ino: index[ino]
+                    for ino, info in dev_inodes.items()
+                    if info.state_dir == state_dir and ino in index
+                },
+            )
+
+
+def run(
+    backup_roots: dict[BackupRoot, StateDir],
+    min_size: int = 1024 * 1024,
+    dry_run: bool = False,
+) -> DedupeStats:
+    """
+    Replace identical files across backup roots and snapshots with hardlinks.
+
+    Candidates are grouped by size and metadata in a single pass over all
+    backup roots. Only groups with several inodes are hashed, first the
+    start of each file, then the full content of those that still collide.
+    Hashes are kept in an inode-keyed index per backup root, so that later
+    runs only hash new inodes.
+
+    Backup roots that a job is writing to are skipped. The lock of each
+    backup root is held until the end, so that jobs wait for the dedupe run.
+    """
+    stats = DedupeStats()
+    start = time.monotonic()
+    locked_roots: dict[BackupRoot, StateDir] = {}
+
+    with ExitStack() as stack:
+        for backup_root, state_dir in backup_roots.items():
+            os.makedirs(state_dir, exist_ok=True)
+
+            if not stack.enter_context(
+                lib.lock_file(f"{state_dir}/lock", blocking=False)
+            ):
+                log.warning(
+                    log.lvl0_ts_msg(
+                        f"[Dedupe] Skip: {backup_root}: A backup job is running."
+                    )
+                )
+                continue
+
+            locked_roots[backup_root] = state_dir
+
+        changed: set[str] = set()
+        _dedupe(locked_roots, min_size, dry_run, stats, changed)
+
+        # The usage of the trees with replaced files must be scanned again.
+        for backup_root, state_dir in locked_roots.items():
+            trees = {
+                os.path.relpath(path, backup_root).split(os.sep)[0]
+                for path in changed
+                if path.startswith(f"{backup_root}/")
+            }
+
+            if trees:
+                usage.invalidate(backup_root, state_dir, trees)
+
+    stats.duration = round(time.monotonic() - start, 3)
+
+    return stats
@@ -0,0 +1,120 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Union
+
+from . import job, lib, resources
+from .logging import log
+from .types import App, BackupRoot, Config, JobPlan
+
+# Amount of jobs that may run at the same time, e.g. 4.
+MaxWorkers = int
+
+# Either one limit for every destination disk, e.g. 1, or a limit per
+# mount point, e.g. {'/media/usb1': 1, '/media/usb2': 2}.
+MaxWorkersPerDisk = Union[int, dict[str, int]]
+
+
+def _get_dst_key(backup_root: BackupRoot) -> str:
+    return lib.clean_path(f"{backup_root}/").rstrip("/") or "/"
+
+
+class JobExecutor:
+    """
+    Run backup jobs concurrently in a bounded pool of worker threads.
+
+    Jobs that share the same 'rsync_dst' never run at the same time and the
+    amount of jobs that write to the same destination disk can be limited via
+    'max_workers_per_disk'.
+    """
+
+    def __init__(
+        self,
+        max_workers: MaxWorkers = 1,
+        max_workers_per_disk: MaxWorkersPerDisk = 0,
+    ):
+        self.max_workers = max(1, int(max_workers))
+
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="vhpi-job",
+        )
+        self._lock = threading.Lock()
+        self._dst_locks: dict[str, threading.Lock] = {}
+        self._disk_semaphores: dict[int, threading.BoundedSemaphore] = {}
+        self._disk_limits: dict[int, int] = {}
+        self._default_disk_limit = self.max_workers
+
+        if isinstance(max_workers_per_disk, dict):
+            for mount_point, limit in max_workers_per_disk.items():
+                device = resources.get_device(mount_point)
+                self._disk_limits[device] = max(1, int(limit))
+
+        elif max_workers_per_disk:
+            self._default_disk_limit = max(1, int(max_workers_per_disk))
+
+    def _get_dst_lock(self, backup_root: BackupRoot) -> threading.Lock:
+        with self._lock:
+            return self._dst_locks.setdefault(
+                _get_dst_key(backup_root), threading.Lock()
+            )
+
+    def _get_disk_semaphore(self, backup_root: BackupRoot) -> threading.Semaphore:
+        device = resources.get_device(backup_root)
+
+        with self._lock:
+            if device not in self._disk_semaphores:
+                limit = self._disk_limits.get(device, self._default_disk_limit)
+                self._disk_semaphores[device] = threading.BoundedSemaphore(limit)
+
+            return self._disk_semaphores[device]
+
+    def _run_job(self, app: App, plan: JobPlan, cfg: Config) -> None:
+        backup_root = plan.backup_root
+
+        with ExitStack() as stack:
+            stack.enter_context(self._get_dst_lock(backup_root))
+            stack.enter_context(self._get_disk_semaphore(backup_root))
+
+            # Keep 'vhpi dedupe' out of the backup root while the job writes to
+            # it. A missing backup root is reported by the job.
+            if os.path.isdir(backup_root):
+                state_dir = f"{backup_root}/{app.state_dir_name}"
+                os.makedirs(state_dir, exist_ok=True)
+                stack.enter_context(lib.lock_file(f"{state_dir}/lock"))
+
+            if self.max_workers == 1:
+                job.run(app, plan, cfg)
+                return
+
+            # Collect the log records of this job and write them as one block,
+            # so that the output of parallel jobs does not interleave.
+            with log.job_section():
+                job.run(app, plan, cfg)
+
+    def submit(self, app: App, plan: JobPlan, cfg: Config) -> Future:
+        """
+        Schedule a single job for execution.
+        """
+        return self._pool.submit(self._run_job, app, plan, cfg)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True)
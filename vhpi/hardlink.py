@@ -0,0 +1,241 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import subprocess as sp
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from . import process
+from .logging import log
+
+
+@dataclass
+class LinkStats:
+    dirs: int = 0
+    files: int = 0
+    # The apparent size of all linked files. None if unknown.
+    size: Optional[int] = 0
+    errors: int = 0
+    duration: float = 0
+
+
+def _read_xattrs(path: str) -> list[tuple[str, bytes]]:
+    try:
+        return [
+            (name, os.getxattr(path, name, follow_symlinks=False))
+            for name in os.listxattr(path, follow_symlinks=False)
+        ]
+    except OSError:
+        return []
+
+
+def _copy_dir_metadata(src: str, dsts: list[str]) -> None:
+    """
+    Apply owner, mode, xattrs and timestamps of 'src' to each dir in 'dsts'.
+    Timestamps must be set last, after the dir was populated.
+    """
+    st = os.lstat(src)
+    xattrs = _read_xattrs(src)
+
+    for dst in dsts:
+        try:
+            os.chown(dst, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+
+        for name, value in xattrs:
+            try:
+                os.setxattr(dst, name, value)
+            except OSError:
+                pass
+
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _is_complete(src: str, dsts: list[str]) -> bool:
+    """
+    Check if the copies of a dir were completed by an interrupted run. The
+    mtime of a dir is copied after all of its sub dirs were completed.
+    """
+    try:
+        src_mtime = os.lstat(src).st_mtime_ns
+        return all(os.lstat(dst).st_mtime_ns == src_mtime for dst in dsts)
+
+    except OSError:
+        return False
+
+
+def _link_dir(
+    src: str,
+    dsts: list[str],
+    stats: LinkStats,
+    resume: bool = False,
+) -> list[str]:
+    """
+    Hardlink all non-dir entries of 'src' into each dir in 'dsts' and create
+    the sub dirs. Return the names of the sub dirs.
+    @resume: Keep entries that already exist.
+    """
+    sub_dirs: list[str] = []
+    src_fd = os.open(src, os.O_RDONLY | os.O_DIRECTORY)
+    dst_fds = [os.open(dst, os.O_RDONLY | os.O_DIRECTORY) for dst in dsts]
+
+    try:
+        with os.scandir(src_fd) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        for dst_fd in dst_fds:
+                            try:
+                                os.mkdir(entry.name, 0o700, dir_fd=dst_fd)
+                            except FileExistsError:
+                                if not resume:
+                                    raise
+                        sub_dirs.append(entry.name)
+                        continue
+
+                    for dst_fd in dst_fds:
+                        try:
+                            os.link(
+                                entry.name,
+                                entry.name,
+                                src_dir_fd=src_fd,
+                                dst_dir_fd=dst_fd,
+                                follow_symlinks=False,
+                            )
+                        except FileExistsError:
+                            if not resume:
+                                raise
+                    stats.files += 1
+
+                    if stats.size is not None:
+                        stats.size += entry.stat(follow_symlinks=False).st_size
+
+                except OSError as e:
+                    stats.errors += 1
+                    log.error(f"    Error: Could not link: {src}/{entry.name}: {e}")
+
+    finally:
+        os.close(src_fd)
+        for dst_fd in dst_fds:
+            os.close(dst_fd)
+
+    return sub_dirs
+
+
+def link_tree(
+    src: str,
+    dsts: list[str],
+    progress_interval: int = 100000,
+    resume: bool = False,
+) -> LinkStats:
+    """
+    Create a hardlink copy of 'src' at each path in 'dsts' (like 'cp -al').
+    The source tree is walked only once, no matter how many destinations are
+    given.
+    @resume: Complete the partial copies of an interrupted run. Completed sub
+    trees are skipped, existing entries are kept. The stats only cover the
+    entries that were visited.
+    """
+    stats = LinkStats()
+    start = time.time()
+    next_progress = progress_interval
+
+    for dst in dsts:
+        if not (resume and os.path.isdir(dst)):
+            os.mkdir(dst, 0o700)
+
+    # Each item is (relative path, is_post_visit). Dir metadata is applied in
+    # the post visit, after all children were created.
+    stack: list[tuple[str, bool]] = [("", False)]
+
+    while stack:
+        rel, is_post_visit = stack.pop()
+        src_dir = os.path.join(src, rel)
+        dst_dirs = [os.path.join(dst, rel) for dst in dsts]
+
+        if is_post_visit:
+            try:
+                _copy_dir_metadata(src_dir, dst_dirs)
+            except OSError as e:
+                stats.errors += 1
+                log.error(f"    Error: Could not copy dir metadata: {src_dir}: {e}")
+            continue
+
+        if resume and _is_complete(src_dir, dst_dirs):
+            continue
+
+        stats.dirs += 1
+        stack.append((rel, True))
+
+        try:
+            sub_dirs = _link_dir(src_dir, dst_dirs, stats, resume)
+        except OSError as e:
+            stats.errors += 1
+            log.error(f"    Error: Could not read dir: {src_dir}: {e}")
+            continue
+
+        stack.extend((os.path.join(rel, name), False) for name in sub_dirs)
+
+        if stats.files >= next_progress:
+            next_progress += progress_interval
+            log.debug(
+                log.lvl1_ts_msg(
+                    f"Progress: linked {stats.files} files in {stats.dirs} dirs."
+                )
+            )
+
+    stats.duration = time.time() - start
+
+    return stats
+
+
+def cp_link_tree(src: str, dsts: list[str], ionice: list[str]) -> LinkStats:
+    """
+    Create a hardlink copy of 'src' at each path in 'dsts' with 'cp -al'.
+    This walks the source tree once per destination.
+    @ionice: A command prefix that sets the io class of 'cp'.
+    """
+    stats = LinkStats(size=None)
+    start = time.time()
+
+    for dst in dsts:
+        cmd = ionice + ["cp", "-al", src, dst]
+
+        try:
+            p = process.run(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, check=False)
+        except OSError as e:
+            log.error(f"    Error: Could not run cp: {e}")
+            stats.errors += 1
+            continue
+
+        output = p.stdout.decode().strip()
+
+        if output:
+            log.debug("\n    " + output)
+
+        if p.returncode != 0:
+            stats.errors += 1
+
+    stats.duration = time.time() - start
+
+    return stats
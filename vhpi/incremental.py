@@ -0,0 +1,229 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .logging import log
+from .types import Job, RsyncOptions
+
+# The relative path of a file/dir in the backup source, e.g. 'docs/a.txt'
+RelPath = str
+
+# The state of a file/dir in the backup source: (size, mtime_ns, inode)
+FileState = tuple[int, int, int]
+FileIndex = dict[RelPath, FileState]
+
+
+@dataclass
+class IncrementalRun:
+    # The index of the source as it was scanned before this run.
+    index: FileIndex
+    # The number of incremental runs since the last full run.
+    cycle: int
+    # The file that lists the changed paths. Empty for full runs.
+    files_from: str = ""
+    # Paths that were removed from the source since the last run.
+    deleted: list[RelPath] = field(default_factory=list)
+
+
+def _get_index_file(job: Job) -> str:
+    return f"{job.state_dir}/file_index.json"
+
+
+def _get_files_from_file(job: Job) -> str:
+    return f"{job.state_dir}/files_from"
+
+
+def _get_prefix(backup_src: str) -> str:
+    """
+    Get the prefix that rsync puts in front of each path of the source.
+    'src/' syncs the content of 'src', while 'src' syncs the dir itself.
+    """
+    if backup_src.endswith("/"):
+        return ""
+
+    return os.path.basename(backup_src)
+
+
+def scan(src_dir: str) -> FileIndex:
+    """
+    Walk the source once and record size, mtime and inode of each entry.
+    The excludes of the job are not applied here. rsync applies its filter
+    rules to the paths of '--files-from' as well, which is the only way to get
+    rsync's matching semantics right.
+    """
+    index: FileIndex = {}
+    stack: list[RelPath] = [""]
+
+    while stack:
+        rel_dir = stack.pop()
+
+        try:
+            entries = list(os.scandir(os.path.join(src_dir, rel_dir)))
+        except OSError as e:
+            log.warning(f"    Warning: Could not scan dir: {rel_dir}: {e}")
+            continue
+
+        for entry in entries:
+            rel_path = os.path.join(rel_dir, entry.name)
+
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                st = entry.stat(follow_symlinks=False)
+
+            except OSError:
+                continue
+
+            if is_dir:
+                index[rel_path] = (0, st.st_mtime_ns, st.st_ino)
+                stack.append(rel_path)
+            else:
+                index[rel_path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    return index
+
+
+def _load_index(job: Job) -> Optional[tuple[int, int, FileIndex]]:
+    """
+    Load (latest_inode, cycle, index) of the last successful run.
+    """
+    try:
+        with open(_get_index_file(job)) as f:
+            data = json.load(f)
+
+        index = {path: tuple(state) for path, state in data["index"].items()}
+
+        return data["latest_ino"], data["cycle"], index
+
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _save_index(job: Job, cycle: int, index: FileIndex) -> None:
+    index_file = _get_index_file(job)
+    latest_ino = os.stat(job.backup_latest).st_ino
+    data = {"latest_ino": latest_ino, "cycle": cycle, "index": index}
+
+    with open(f"{index_file}.tmp", "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+
+    os.replace(f"{index_file}.tmp", index_file)
+
+
+def prepare(job: Job) -> Optional[IncrementalRun]:
+    """
+    Scan the source and decide if the next rsync run can be incremental.
+    Returns None if the incremental mode does not apply to the job.
+    """
+    if not job.incremental or ":" in job.backup_src:
+        return None
+
+    os.makedirs(job.state_dir, exist_ok=True)
+
+    prefix = _get_prefix(job.backup_src)
+    index = scan(job.backup_src)
+    last_run = _load_index(job)
+
+    try:
+        latest_ino = os.stat(job.backup_latest).st_ino
+    except OSError:
+        latest_ino = -1
+
+    if (
+        last_run is None
+        or last_run[0] != latest_ino
+        or last_run[1] + 1 >= job.full_sync_every
+    ):
+        log.debug(log.lvl1_ts_msg("Incremental mode: Full run."))
+        return IncrementalRun(index=index, cycle=0)
+
+    _, cycle, old_index = last_run
+
+    changed = [path for path, state in index.items() if old_index.get(path) != state]
+    deleted = [path for path in old_index if path not in index]
+
+    files_from = _get_files_from_file(job)
+
+    with open(files_from, "w") as f:
+        for path in changed:
+            f.write(os.path.join(prefix, path) + "\0")
+
+    log.debug(
+        log.lvl1_ts_msg(
+            f"Incremental mode: {len(changed)} changed and {len(deleted)} "
+            f"deleted entries (run {cycle + 1} of {job.full_sync_every})."
+        )
+    )
+
+    return IncrementalRun(
+        index=index,
+        cycle=cycle + 1,
+        files_from=files_from,
+        deleted=deleted,
+    )
+
+
+def get_rsync_src(job: Job, run: Optional[IncrementalRun]) -> str:
+    """
+    Get the source arg for rsync. With '--files-from' the source is the base
+    dir of the listed paths.
+    """
+    if run is None or not run.files_from or job.backup_src.endswith("/"):
+        return job.backup_src
+
+    return os.path.dirname(job.backup_src) + "/"
+
+
+def get_rsync_options(job: Job, run: Optional[IncrementalRun]) -> RsyncOptions:
+    """
+    Get the rsync options for a run. Incremental runs pass the changed paths
+    via '--files-from'. The '--delete' options are removed, because rsync does
+    not allow them without recursion. Deletions are applied by commit().
+    """
+    if run is None or not run.files_from:
+        return job.rsync_options
+
+    options = [
+        option for option in job.rsync_options if not option.startswith("--delete")
+    ]
+    options += [f"--files-from={run.files_from}", "--from0"]
+
+    return tuple(options)
+
+
+def commit(job: Job, run: IncrementalRun) -> None:
+    """
+    Apply deletions and persist the index after a successful rsync run.
+    """
+    if run.files_from and any(
+        option.startswith("--delete") for option in job.rsync_options
+    ):
+        dst_dir = os.path.join(job.backup_latest, _get_prefix(job.backup_src))
+
+        for path in sorted(run.deleted, reverse=True):
+            dst_path = os.path.join(dst_dir, path)
+
+            if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                shutil.rmtree(dst_path, ignore_errors=True)
+            elif os.path.lexists(dst_path):
+                os.unlink(dst_path)
+
+    _save_index(job, run.cycle, run.index)
@@ -17,48 +17,21 @@
 
 import os
 import time
-from typing import Any
+import uuid
+from dataclasses import asdict
 
-from . import lib, rsync, snapshot
+from . import metrics, reachability, rsync, snapshot, stats, timestamp_store
 from .logging import log
-from .types import App, BackupRoot, Job, Snapshot, SnapshotIntervals, SnapshotTimestamps
-
-
-def _validate_src_and_dst(backup_src, backup_root) -> bool:
-
-    if not isinstance(backup_src, str):
-        log.lvl0_cfg_type_error("rsync_src", "string")
-        return False
-
-    if not isinstance(backup_root, str):
-        log.lvl0_cfg_type_error("rsync_dst", "string")
-        return False
-
-    if backup_src == "":
-        log.lvl0_cfg_empty_item("rsync_src")
-        return False
-
-    if backup_root == "":
-        log.lvl0_cfg_empty_item("rsync_dst")
-        return False
-
-    if backup_src.split(":")[-1][0] != "/":
-        log.lvl0_cfg_no_absolute_path_error("rsync_src")
-        return False
-
-    if ":" in backup_root:
-        log.lvl0_cfg_backup_dst_must_be_local()
-        return False
-
-    if backup_root[0] != "/":
-        log.lvl0_cfg_no_absolute_path_error("rsync_dst")
-        return False
-
-    if not os.path.isdir(backup_root):
-        log.lvl0_cfg_dst_not_exists_error(backup_root)
-        return False
-
-    return True
+from .types import (
+    App,
+    BackupRoot,
+    Config,
+    Job,
+    JobPlan,
+    Snapshot,
+    SnapshotIntervals,
+    SnapshotTimestamps,
+)
 
 
 def _load_snapshot_timestamps(
@@ -67,48 +40,40 @@ def _load_snapshot_timestamps(
     backup_root: BackupRoot,
 ) -> SnapshotTimestamps:
 
-    timestamp_file = lib.clean_path(f"{backup_root}/{app.timestamp_file_name}")
-
-    # Create empty timestamps file if necessary.
-    if not os.path.isfile(timestamp_file):
-        open(timestamp_file, "a").close()
-
-    timestamps: SnapshotTimestamps = lib.load_yaml(timestamp_file) or {}
+    timestamps = timestamp_store.store.load(app, backup_root)
 
+    # Intervals without a snapshot are due right away.
     for interval in snapshot_intervals:
-        if not timestamps.get(interval):
-            timestamps.update({interval: "1970-01-02 00:00:00"})
+        timestamps.setdefault(interval, 0)
 
     return timestamps
 
 
-def get_job(app: App, job_raw: dict[str, Any], user_cfg_raw: dict[str, Any]) -> Job:
-
-    user_app_cfg = user_cfg_raw.get("app_cfg", {})
-
-    snapshot_intervals: SnapshotIntervals = user_app_cfg.get("intervals", {})
-
-    backup_src = job_raw.get("rsync_src", "no-src-given")
-    backup_root = job_raw.get("rsync_dst", "no-dst-given")
-    snapshot_timestamps = _load_snapshot_timestamps(
-        app, snapshot_intervals, backup_root
-    )
+def get_job(app: App, plan: JobPlan, cfg: Config) -> Job:
 
     return Job(
-        name=job_raw.get("name", "job-with-no-name"),
-        login_token=job_raw["login_token"],
-        source_ip=job_raw.get("source_ip", "no-ip-given"),
-        backup_src=backup_src,
-        backup_root=backup_root,
-        backup_latest=f"{backup_root}/backup.latest",
-        rsync_options=job_raw.get("rsync_options", ""),
-        exclude_lib=user_app_cfg.get("exclude_lib", {}),
-        exclude_lists=job_raw.get("exclude_lists", []),
-        excludes=job_raw.get("excludes", []),
+        name=plan.name,
+        login_token=plan.login_token,
+        source_ip=plan.source_ip,
+        backup_src=plan.backup_src,
+        backup_root=plan.backup_root,
+        backup_latest=f"{plan.backup_root}/backup.latest",
+        state_dir=f"{plan.backup_root}/{app.state_dir_name}",
+        rsync_options=plan.rsync_options,
+        incremental=plan.incremental,
+        full_sync_every=plan.full_sync_every,
+        rsync_shards=plan.rsync_shards,
+        hardlink_engine=plan.hardlink_engine,
+        share_snapshots=plan.share_snapshots,
+        snapshot_rotation=plan.snapshot_rotation,
+        snapshot_aliases=plan.snapshot_aliases,
+        excludes=plan.excludes,
+        exclude_file=plan.exclude_file,
         init_time=time.time(),
-        snapshot_timestamps=snapshot_timestamps,
-        snapshot_intervals=snapshot_intervals,
-        jobs_raw=user_cfg_raw.get("jobs", []),
+        snapshot_timestamps=_load_snapshot_timestamps(
+            app, cfg.intervals, plan.backup_root
+        ),
+        snapshot_intervals=cfg.intervals,
     )
 
 
@@ -123,7 +88,8 @@ def _duty_check_routine(job: Job, due_snapshots: list[Snapshot]) -> bool:
         )
         return False
 
-    if not lib.is_machine_online(source_ip=job.source_ip):
+    if not reachability.checker.is_online(job.source_ip):
+        metrics.registry.inc("vhpi_job_skipped_total", job=job.name, reason="offline")
         log.lvl0_skip_info(
             online=False,
             due_jobs=due_snapshots,
@@ -135,12 +101,35 @@ def _duty_check_routine(job: Job, due_snapshots: list[Snapshot]) -> bool:
     return True
 
 
-def run(app: App, job_raw: dict[str, Any], user_cfg_raw: dict[str, Any]) -> None:
+def _record_result(job: Job, result: str) -> None:
+    """
+    Append the stats of a job run to its history and to the metrics.
+    """
+    job.stats.result = result
+    stats.append_history(job)
+    metrics.record_run(job)
+
+    log.event(
+        "Job finished",
+        result=result,
+        duration=round(time.time() - job.init_time, 3),
+        snapshots=job.stats.snapshots,
+        phases=job.stats.phases,
+        rsync=asdict(job.stats.rsync) if job.stats.rsync else None,
+    )
+
+
+def _run(app: App, plan: JobPlan, cfg: Config, run_id: str) -> None:
 
-    if not _validate_src_and_dst(job_raw["rsync_src"], job_raw["rsync_dst"]):
+    if not os.path.isdir(plan.backup_root):
+        log.lvl0_cfg_dst_not_exists_error(plan.backup_root)
         return
 
-    job = get_job(app, job_raw, user_cfg_raw)
+    job = get_job(app, plan, cfg)
+
+    # Finish an interrupted snapshot run before rsync changes 'backup.latest'.
+    if snapshot.recover(app, job):
+        job = get_job(app, plan, cfg)
 
     snapshots = [
         snapshot.get_snapshot(
@@ -150,7 +139,7 @@ def run(app: App, job_raw: dict[str, Any], user_cfg_raw: dict[str, Any]) -> None
             keep_amount,
             job.snapshot_timestamps[name],
         )
-        for name, keep_amount in job_raw["snapshots"].items()
+        for name, keep_amount in plan.snapshots.items()
     ]
 
     due_snapshots = [snapshot for snapshot in snapshots if snapshot.is_due]
@@ -160,13 +149,37 @@ def run(app: App, job_raw: dict[str, Any], user_cfg_raw: dict[str, Any]) -> None
 
     log.lvl0_job_start_info(job, due_snapshots)
 
+    job.stats.run_id = run_id
+    job.stats.started_at = job.init_time
+    job.stats.snapshots = [s.name for s in due_snapshots]
+
     if not rsync.run(app, job):
+        _record_result(job, "failed")
         return
 
-    for s in due_snapshots:
-        snapshot.run(app, job, s)
+    snapshot.run(app, job, due_snapshots)
+
+    _record_result(job, "completed")
+    metrics.record_snapshots(
+        job.name,
+        job.backup_root,
+        job.state_dir,
+        plan.snapshots,
+        timestamp_store.store.load(app, job.backup_root),
+    )
 
     log.lvl0_job_out_info(
         completed=True,
         init_time=job.init_time,
     )
+
+
+def run(app: App, plan: JobPlan, cfg: Config) -> None:
+    """
+    Run a job if any of its snapshots is due. All records that are logged
+    during the run carry the job name and a new run id.
+    """
+    run_id = uuid.uuid4().hex[:12]
+
+    with log.context(job=plan.name, run_id=run_id):
+        _run(app, plan, cfg, run_id)
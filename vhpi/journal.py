@@ -0,0 +1,137 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Any, Optional, TextIO
+
+from .types import StateDir
+
+# The key of a step of a snapshot run, e.g. 'hardlink' or 'place:daily'.
+StepKey = str
+
+# The data of a step, which is needed to repeat it.
+StepRecord = dict[str, Any]
+
+# An operation on the entries of a backup root, which can be repeated safely:
+# ['rename', src, dst], ['link', target, dir], ['unlink', dir], ['trash', dir]
+JournalOp = list[str]
+
+
+@dataclass
+class JournalState:
+    # The plan that was written when the run began.
+    plan: dict[str, Any]
+    # Steps that were recorded, whether they were completed or not.
+    recorded: dict[StepKey, StepRecord] = field(default_factory=dict)
+    # Steps that were completed.
+    done: set[StepKey] = field(default_factory=set)
+
+
+def fsync_dir(path: str) -> None:
+    """
+    Persist the entries of a dir, e.g. after a rename.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """
+    A write-ahead journal of a snapshot run, one JSON record per line.
+
+    Each step is recorded with everything that is needed to repeat it before
+    it is executed, and marked as done afterwards. Every record is fsynced.
+    The journal is removed when the run has completed, so an existing journal
+    means that a run was interrupted and must be rolled forward.
+    """
+
+    def __init__(self, state_dir: StateDir):
+        self.state_dir = state_dir
+        self.file = f"{state_dir}/journal"
+        self._f: Optional[TextIO] = None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.file)
+
+    def _write(self, record: dict[str, Any]) -> None:
+        if self._f is None:
+            raise RuntimeError(f"Journal is not open: {self.file}")
+
+        self._f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def begin(self, plan: dict[str, Any]) -> None:
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        self._f = open(self.file, "w")
+        self._write({"type": "begin", "plan": plan})
+        fsync_dir(self.state_dir)
+
+    def reopen(self) -> None:
+        """
+        Continue an interrupted journal.
+        """
+        self._f = open(self.file, "a")
+
+    def record(self, step: StepKey, data: StepRecord) -> None:
+        self._write({"type": "step", "step": step, "data": data})
+
+    def done(self, step: StepKey) -> None:
+        self._write({"type": "done", "step": step})
+
+    def commit(self) -> None:
+        if self._f:
+            self._f.close()
+            self._f = None
+
+        os.unlink(self.file)
+        fsync_dir(self.state_dir)
+
+    def load(self) -> Optional[JournalState]:
+        """
+        Read an interrupted journal. A torn last line is ignored, because it
+        was never completely written and its step was never started.
+        """
+        if not self.exists():
+            return None
+
+        state: Optional[JournalState] = None
+
+        with open(self.file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                if record["type"] == "begin":
+                    state = JournalState(plan=record["plan"])
+
+                elif state and record["type"] == "step":
+                    state.recorded[record["step"]] = record["data"]
+
+                elif state and record["type"] == "done":
+                    state.done.add(record["step"])
+
+        return state
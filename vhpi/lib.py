@@ -16,11 +16,12 @@
 # along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import fcntl
 import os
-import subprocess as sp
 import sys
+from contextlib import contextmanager
 from getpass import getpass
-from typing import Any
+from typing import Any, Iterator, Optional
 
 import oyaml as yaml
 from cryptography.fernet import Fernet
@@ -48,16 +49,6 @@ def read_login(token):
     return _decrypt(token).decode().strip()
 
 
-def is_machine_online(source_ip: str) -> bool:
-    """Check if a machine is running via 'ping'"""
-    try:
-        sp.check_output(["ping", "-c", "1", source_ip])
-        return True
-
-    except sp.CalledProcessError:
-        return False
-
-
 def clean_path(_path):
     """Remove double slashes"""
     return _path.replace("//", "/")
@@ -86,7 +77,7 @@ def load_yaml(file: str) -> dict:
         return yaml.safe_load(f)
 
 
-def save_yaml(data: Any, file: str, default_style: str = '"') -> None:
+def save_yaml(data: Any, file: str, default_style: Optional[str] = '"') -> None:
     """
     Save data to yaml file.
     """
@@ -94,6 +85,22 @@ def save_yaml(data: Any, file: str, default_style: str = '"') -> None:
         yaml.dump(data, yaml_file, default_style=default_style)
 
 
+@contextmanager
+def lock_file(file: str, blocking: bool = True) -> Iterator[bool]:
+    """
+    Hold an exclusive 'flock' on a file for the duration of the block.
+    Yields False if 'blocking' is False and another process holds the lock.
+    """
+    with open(file, "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+
+        yield True
+
+
 def eprint(*objects, sep=" ", end="\n", file=sys.stderr, flush=False) -> None:
     """
     Write to sdterr.
@@ -14,15 +14,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
+import copy
+import itertools
+import json
 import logging
 import logging.config
+import queue
 import sys
+import threading
 import time
-from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, RotatingFileHandler
 from math import ceil
+from typing import Any, Iterator, Optional, Union
 
 from .types import App, Job, Snapshot
 
+# Fields that describe where a record was logged, e.g.
+# {'job': 'Laptop', 'run_id': '3f2a...', 'phase': 'rsync'}. See Log.context().
+LogContext = dict[str, Any]
+
 
 def _fix_len(string: str, limit: int, filler: str = ".", rpl: str = "[...]") -> str:
     """
@@ -59,8 +71,105 @@ def _fix_len(string: str, limit: int, filler: str = ".", rpl: str = "[...]") ->
     return output
 
 
+# Records that may wait to be written. If the queue is full, debug records are
+# dropped and all other records wait for free space.
+_QUEUE_SIZE = 10000
+
+# Records that are written before the streams are flushed.
+_BATCH_SIZE = 500
+
+# Seconds between two warnings about dropped records.
+_DROP_REPORT_INTERVAL = 60
+
+# Records of unfinished job sections that the log writer holds back. If there
+# are more, the largest section is written early, see LogWriter.
+_SECTION_BUFFER_SIZE = 10000
+
+# The id of a job section, see Log.job_section().
+SectionId = int
+
+
+class TimestampCache:
+    """
+    Format the current time only once per second, instead of once per record.
+    """
+
+    def __init__(self, fmt: str):
+        self.fmt = fmt
+        # (second, formatted time)
+        self._cached: tuple[int, str] = (-1, "")
+
+    def format(self, now: float) -> str:
+        second = int(now)
+        cached = self._cached
+
+        if cached[0] != second:
+            cached = (second, time.strftime(self.fmt, time.localtime(second)))
+            self._cached = cached
+
+        return cached[1]
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as a single JSON line with the fields of its context (job,
+    run_id, phase, snapshot) and the fields passed with 'extra={"fields": ...}'.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._ts = TimestampCache("%Y-%m-%dT%H:%M:%S")
+        self._tz = TimestampCache("%z")
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": f"{self._ts.format(record.created)}.{int(record.msecs):03d}"
+            f"{self._tz.format(record.created)}",
+            "level": record.levelname.lower(),
+        }
+        data.update(getattr(record, "context", None) or {})
+        data["msg"] = record.getMessage().strip()
+        data.update(getattr(record, "fields", None) or {})
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            data["exc"] = record.exc_text
+
+        return json.dumps(data, default=str, separators=(",", ":"))
+
+
+def _is_not_blank(record: logging.LogRecord) -> bool:
+    """
+    Drop the empty records that separate blocks of the text log.
+    """
+    return bool(getattr(record, "fields", None) or record.getMessage().strip())
+
+
+class _BatchFlushMixin:
+    """
+    Skip the flush after each record, the log writer flushes the stream once
+    per batch.
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchedFileHandler(_BatchFlushMixin, RotatingFileHandler):
+    pass
+
+
+class BatchedStreamHandler(_BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
 def get_info_handler(app: App):
-    handler = RotatingFileHandler(
+    handler = BatchedFileHandler(
         filename=f"{app.log_dir}/info.log",
         maxBytes=1073741824,
         backupCount=1,
@@ -70,7 +179,7 @@ def get_info_handler(app: App):
 
 
 def get_debug_handler(app: App):
-    handler = RotatingFileHandler(
+    handler = BatchedFileHandler(
         filename=f"{app.log_dir}/debug.log",
         maxBytes=1073741824,
         backupCount=1,
@@ -81,15 +190,214 @@ def get_debug_handler(app: App):
 
 
 def get_console_debug_handler():
-    handler = logging.StreamHandler(stream=sys.stdout)
+    handler = BatchedStreamHandler(stream=sys.stdout)
     handler.setLevel(logging.DEBUG)
     return handler
 
 
+class _SectionEnd:
+    """
+    Put into the log queue when a job section ends.
+    """
+
+    def __init__(self, section: SectionId):
+        self.section = section
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Put records into the log queue. Debug records are dropped and counted if
+    the queue is full, so that a slow disk never blocks e.g. the rsync output
+    loop.
+    """
+
+    def __init__(self, queue_: queue.Queue):
+        super().__init__(queue_)
+        self._queue = queue_
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Only merge the args into the message. The record is formatted by the
+        handlers in the writer thread, which also format its exception.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+
+        if record.levelno > logging.DEBUG:
+            self._queue.put(record)
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+# An item of the log queue. None stops the writer.
+QueueItem = Union[logging.LogRecord, _SectionEnd, None]
+
+
+class LogWriter:
+    """
+    Write the records of the log queue to the handlers in a background thread.
+    Records are taken from the queue in batches and each stream is flushed
+    once per batch instead of once per record.
+
+    Records of a job section (see Log.job_section()) are held back until the
+    section ends and are then written as one block. At most
+    'section_buffer_size' records are held back, beyond that the largest
+    section is written early.
+    """
+
+    def __init__(
+        self,
+        handlers: list[logging.Handler],
+        maxsize: int = _QUEUE_SIZE,
+        section_buffer_size: int = _SECTION_BUFFER_SIZE,
+    ):
+        self.handlers = handlers
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.queue_handler = _DroppingQueueHandler(self.queue)
+        self.section_buffer_size = section_buffer_size
+
+        self._sections: dict[SectionId, list[logging.LogRecord]] = {}
+        self._held = 0
+        self._reported_drops = 0
+        self._reported_at = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def _get_batch(self) -> list[QueueItem]:
+        """
+        Wait for the next record and add whatever else is queued up right now.
+        """
+        batch = [self.queue.get()]
+
+        while len(batch) < _BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _emit(self, record: logging.LogRecord) -> None:
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _write_section(self, section: SectionId) -> None:
+        records = self._sections.pop(section, [])
+        self._held -= len(records)
+
+        for record in records:
+            self._emit(record)
+
+    def _handle(self, item: QueueItem) -> None:
+        if isinstance(item, _SectionEnd):
+            self._write_section(item.section)
+            return
+
+        if item is None:
+            return
+
+        section = getattr(item, "section", None)
+
+        if section is None:
+            self._emit(item)
+            return
+
+        self._sections.setdefault(section, []).append(item)
+        self._held += 1
+
+        if self._held > self.section_buffer_size:
+            self._write_section(
+                max(self._sections, key=lambda s: len(self._sections[s]))
+            )
+
+    def _report_drops(self, force: bool = False) -> None:
+        dropped = self.queue_handler.dropped - self._reported_drops
+
+        if dropped <= 0:
+            return
+
+        if not force and time.monotonic() - self._reported_at < _DROP_REPORT_INTERVAL:
+            return
+
+        self._reported_drops += dropped
+        self._reported_at = time.monotonic()
+        self._emit(
+            logging.makeLogRecord(
+                {
+                    "msg": f"    Warning: The log queue was full, dropped {dropped} "
+                    f"debug records.",
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                }
+            )
+        )
+
+    def _work(self) -> None:
+        while True:
+            batch = self._get_batch()
+
+            for item in batch:
+                self._handle(item)
+
+            # None is put into the queue by stop().
+            stopped = None in batch
+
+            if stopped:
+                for section in list(self._sections):
+                    self._write_section(section)
+
+            self._report_drops(force=stopped)
+
+            for handler in self.handlers:
+                getattr(handler, "flush_batch", handler.flush)()
+
+            if stopped:
+                return
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._work, name="vhpi-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Write all queued records and stop the thread.
+        """
+        if self._thread is None:
+            return
+
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+        for handler in self.handlers:
+            handler.close()
+
+
 class Log:
     def __init__(self):
 
         self.timestamp_format = ""
+        self._ts = TimestampCache(self.timestamp_format)
+
+        # Write JSON lines instead of text, see JsonFormatter.
+        self.structured = False
+
+        # Log every n-th line of the file list of rsync, 0 for none.
+        self.rsync_debug_sample = 1
 
         self.logger = logging.getLogger()
         self.logger.setLevel(logging.DEBUG)
@@ -100,13 +408,157 @@ class Log:
         self.error = self.logger.error
         self.critical = self.logger.critical
 
-    def update(self, app: App):
+        self._local = threading.local()
+        self._section_ids = itertools.count(1)
+        self.logger.addFilter(self._context_filter)
+
+        self._writer: Optional[LogWriter] = None
+        # The dropped records of closed writers.
+        self._dropped = 0
+
+    def _context_filter(self, record: logging.LogRecord) -> bool:
+        """
+        Attach the context and the job section of the current thread to a
+        record. The context dicts are never changed, so they don't have to be
+        copied.
+        """
+        record.context = getattr(self._local, "context", None)
+        record.section = getattr(self._local, "section", None)
+        return True
+
+    def get_context(self) -> Optional[LogContext]:
+        return getattr(self._local, "context", None)
+
+    @contextmanager
+    def context(self, **fields: Any) -> Iterator[None]:
+        """
+        Add fields to all records that the current thread logs inside this
+        context, e.g. log.context(job='Laptop', run_id='3f2a...').
+        """
+        previous = self.get_context()
+        self._local.context = {**(previous or {}), **fields}
+
+        try:
+            yield
+
+        finally:
+            self._local.context = previous
+
+    def event(self, msg: str, level: int = logging.INFO, **fields: Any) -> None:
+        """
+        Log a record with structured fields, e.g. durations and counters. Events
+        are only written in the JSON log format, the text log already has its
+        own messages for them.
+        """
+        if self.structured:
+            self.logger.log(level, msg, extra={"fields": fields})
+
+    @contextmanager
+    def job_section(self):
+        """
+        Write all records that the current thread logs inside this context as
+        one uninterrupted block, once the context is left. The records are
+        queued right away and grouped by the log writer.
+        """
+        section = next(self._section_ids)
+        self._local.section = section
+
+        try:
+            yield
+
+        finally:
+            self._local.section = None
+            writer = self._writer
+
+            if writer:
+                writer.queue.put(_SectionEnd(section))
+
+    def get_section(self) -> Optional[SectionId]:
+        """
+        Get the job section of the current thread, if there is one.
+        """
+        return getattr(self._local, "section", None)
 
+    @contextmanager
+    def use_section(self, section: Optional[SectionId]):
+        """
+        Let the current thread log into the job section of another thread.
+        """
+        self._local.section = section
+
+        try:
+            yield
+
+        finally:
+            self._local.section = None
+
+    def update(self, app: App):
+        """
+        Write the log to the log files and stdout. Records are handed over to
+        a background thread, see LogWriter.
+        """
         self.timestamp_format = app.timestamp_format
+        self._ts = TimestampCache(app.timestamp_format)
+
+        self._writer = LogWriter(
+            [
+                get_info_handler(app),
+                get_debug_handler(app),
+                get_console_debug_handler(),
+            ]
+        )
+        self.logger.addHandler(self._writer.queue_handler)
+        self._writer.start()
 
-        self.logger.addHandler(get_info_handler(app))
-        self.logger.addHandler(get_debug_handler(app))
-        self.logger.addHandler(get_console_debug_handler())
+        atexit.register(self.close)
+
+    def configure(self, rsync_debug_sample: int = 1, log_format: str = "text") -> None:
+        """
+        @log_format: 'text' or 'json' for JSON lines on all outputs.
+        """
+        self.rsync_debug_sample = max(0, int(rsync_debug_sample))
+        self.structured = log_format == "json"
+
+        if self._writer:
+            formatter = JsonFormatter() if self.structured else None
+
+            for handler in self._writer.handlers:
+                handler.setFormatter(formatter)
+
+                if self.structured:
+                    handler.addFilter(_is_not_blank)
+                else:
+                    handler.removeFilter(_is_not_blank)
+
+    def _get_ts(self) -> str:
+        """
+        Get the timestamp that precedes text messages. JSON lines have a
+        timestamp field instead.
+        """
+        return "" if self.structured else self._ts.format(time.time())
+
+    @property
+    def dropped(self) -> int:
+        """
+        The amount of debug records that were dropped, because the log queue
+        was full.
+        """
+        if self._writer is None:
+            return self._dropped
+
+        return self._dropped + self._writer.queue_handler.dropped
+
+    def close(self) -> None:
+        """
+        Write the remaining records and close the log files.
+        """
+        if self._writer is None:
+            return
+
+        self.logger.removeHandler(self._writer.queue_handler)
+        self._writer.stop()
+        self._dropped += self._writer.queue_handler.dropped
+        self._writer = None
 
     # LOG LEVEL 0
     # ===========
@@ -119,11 +571,14 @@ class Log:
         """
         Log message for starting a new backup job
         """
-        msg = time.strftime(self.timestamp_format)
+        due = [s.name for s in due_snapshots]
+        msg = self._get_ts()
         msg += " [Executing] " + job.source_ip + "\t" + job.backup_src + "\n"
-        msg += "\n    Due: " + ", ".join([s.name for s in due_snapshots])
+        msg += "\n    Due: " + ", ".join(due)
+
+        fields = {"source_ip": job.source_ip, "src": job.backup_src, "due": due}
 
-        self.logger.info(msg)
+        self.logger.info(msg, extra={"fields": fields})
 
     def lvl0_job_out_info(
         self,
@@ -140,20 +595,28 @@ class Log:
         seconds: float = time.time() - init_time
         duration: str = time.strftime("%H:%M:%S", time.gmtime(seconds))
         new_msg = ""
+        result = ""
 
         if completed:
             new_msg += f"[Completed] after: {duration} (h:m:s) {message}"
+            result = "completed"
 
         elif skipped:
             new_msg += f"[Skipped] {message}"
+            result = "skipped"
 
         elif failed:
             new_msg += f"[Failed] after: {duration} (h:m:s) {message}"
+            result = "failed"
 
         elif unknown:
             new_msg += f"[Job Result Unknown] after: {duration} (h:m:s) {message}"
+            result = "unknown"
 
-        return self.logger.info(f"\n{time.strftime(self.timestamp_format)} {new_msg}")
+        return self.logger.info(
+            f"\n{self._get_ts()} {new_msg}",
+            extra={"fields": {"result": result, "duration": round(seconds, 3)}},
+        )
 
     def lvl0_skip_info(
         self,
@@ -168,6 +631,12 @@ class Log:
         """
         state = "online" if online else "offline"
         due_jobs = due_jobs or []
+
+        if self.structured:
+            fields = {"source_ip": ip, "src": path, "state": state, "due": due_jobs}
+            self.logger.info("[Skipped]", extra={"fields": fields})
+            return ""
+
         ip_str = _fix_len(ip, 15, " ")
         path_str = _fix_len(path, 50, "·")
         state_str = _fix_len(state, 7, " ")
@@ -176,7 +645,7 @@ class Log:
 
         msg = f"[Skipped] [{ip_str}] [{path_str}] [Source {state_str}] [{due_str}]"
 
-        return self.logger.info(f"{time.strftime(self.timestamp_format)} {msg}") or ""
+        return self.logger.info(f"{self._get_ts()} {msg}") or ""
 
     def lvl0_cfg_type_error(
         self,
@@ -200,6 +669,11 @@ class Log:
             f'[Error] Invalid config. Please provide an absolute path for "{item}".'
         )
 
+    def lvl0_cfg_unknown_item(self, section: str, item: str):
+        self.logger.error(
+            f'[Error] Invalid config. "{item}" is not defined in "{section}".'
+        )
+
     def lvl0_cfg_dst_not_exists_error(self, item: str):
         self.logger.error(f'[Error] Backup destination does not exist: "{item}".')
 
@@ -207,9 +681,7 @@ class Log:
         """
         Create a message preceding a timestamp.
         """
-        ts = time.strftime(self.timestamp_format)
-
-        return f"{ts} {msg}"
+        return msg if self.structured else f"{self._get_ts()} {msg}"
 
     # LOG LEVEL 1
     # ===========
@@ -224,9 +696,7 @@ class Log:
         """
         Create a message preceding a timestamp.
         """
-        ts = time.strftime(self.timestamp_format)
-
-        return f"    {ts} {msg}"
+        return msg if self.structured else f"    {self._get_ts()} {msg}"
 
 
 log = Log()
@@ -0,0 +1,384 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Optional, Union
+
+from .logging import log
+from .snapshot_index import SnapshotIndex
+from .types import BackupRoot, Job, SnapshotName, SnapshotTimestamps, StateDir
+
+# The sorted (name, value) pairs of the labels of a sample, e.g.
+# (('job', 'Laptop'), ('phase', 'rsync')).
+Labels = tuple[tuple[str, str], ...]
+
+Value = Union[int, float]
+
+# The type and help text of each metric.
+_METRICS = {
+    "vhpi_job_runs_total": (
+        "counter",
+        "Job runs that reached rsync, by result ('completed' or 'failed').",
+    ),
+    "vhpi_job_skipped_total": (
+        "counter",
+        "Due job runs that were skipped, by reason.",
+    ),
+    "vhpi_job_duration_seconds": (
+        "gauge",
+        "Duration of the last run of a job.",
+    ),
+    "vhpi_job_last_run_timestamp_seconds": (
+        "gauge",
+        "Unix time of the end of the last run of a job.",
+    ),
+    "vhpi_job_last_success_timestamp_seconds": (
+        "gauge",
+        "Unix time of the end of the last completed run of a job.",
+    ),
+    "vhpi_phase_duration_seconds": (
+        "gauge",
+        "Duration of each phase in the last run of a job.",
+    ),
+    "vhpi_phase_seconds_total": (
+        "counter",
+        "Time spent in each phase of a job.",
+    ),
+    "vhpi_rsync_files_transferred_total": (
+        "counter",
+        "Regular files transferred by rsync.",
+    ),
+    "vhpi_rsync_transferred_bytes_total": (
+        "counter",
+        "Size of the files transferred by rsync.",
+    ),
+    "vhpi_rsync_sent_bytes_total": (
+        "counter",
+        "Bytes sent by rsync.",
+    ),
+    "vhpi_rsync_received_bytes_total": (
+        "counter",
+        "Bytes received by rsync.",
+    ),
+    "vhpi_rsync_failures_total": (
+        "counter",
+        "Failed rsync runs, by reason.",
+    ),
+    "vhpi_snapshots": (
+        "gauge",
+        "Snapshots of each interval in the backup root of a job.",
+    ),
+    "vhpi_snapshot_last_timestamp_seconds": (
+        "gauge",
+        "Unix time of the newest snapshot of each interval.",
+    ),
+    "vhpi_snapshot_age_seconds": (
+        "gauge",
+        "Age of the newest snapshot of each interval.",
+    ),
+    "vhpi_scheduler_lag_seconds": (
+        "gauge",
+        "Delay between the due time and the start of the last run of a job.",
+    ),
+    "vhpi_source_up": (
+        "gauge",
+        "Whether a source host answered the last reachability probe.",
+    ),
+    "vhpi_log_dropped_records_total": (
+        "counter",
+        "Debug log records that were dropped, because the log queue was full.",
+    ),
+}
+
+# Metrics that are computed from a timestamp metric, when they are rendered.
+_AGES = {"vhpi_snapshot_age_seconds": "vhpi_snapshot_last_timestamp_seconds"}
+
+# Seconds between two writes of the textfile.
+_TEXTFILE_INTERVAL = 15
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value: Value) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(round(value, 6))
+
+    return str(int(value))
+
+
+class Registry:
+    """
+    Keep the current value of each metric sample in memory. Updates are a
+    dict operation under a lock, so they are cheap enough for every phase of
+    a job. The samples are rendered in the Prometheus text format on demand.
+    """
+
+    def __init__(self):
+        self._values: dict[str, dict[Labels, Value]] = {}
+        self._lock = threading.Lock()
+
+    def _get_samples(self, name: str) -> dict[Labels, Value]:
+        if name not in _METRICS:
+            raise KeyError(f"Unknown metric: {name}")
+
+        return self._values.setdefault(name, {})
+
+    def inc(self, name: str, value: Value = 1, **labels: str) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+        with self._lock:
+            samples = self._get_samples(name)
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name: str, value: Value, **labels: str) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+        with self._lock:
+            self._get_samples(name)[key] = value
+
+    def render(self) -> str:
+        now = time.time()
+        lines = []
+
+        with self._lock:
+            values = {name: dict(samples) for name, samples in self._values.items()}
+
+        for name, source in _AGES.items():
+            values[name] = {
+                labels: max(0, now - value)
+                for labels, value in values.get(source, {}).items()
+                if value
+            }
+
+        values["vhpi_log_dropped_records_total"] = {(): log.dropped}
+
+        for name, (type_, help_) in _METRICS.items():
+            samples = values.get(name)
+
+            if not samples:
+                continue
+
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {type_}")
+
+            for labels, value in sorted(samples.items()):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def record_run(job: Job) -> None:
+    """
+    Record the result, phase durations and transfer stats of a job run.
+    """
+    now = time.time()
+    result = job.stats.result
+
+    registry.inc("vhpi_job_runs_total", job=job.name, result=result)
+    registry.set("vhpi_job_duration_seconds", now - job.init_time, job=job.name)
+    registry.set("vhpi_job_last_run_timestamp_seconds", now, job=job.name)
+
+    if result == "completed":
+        registry.set("vhpi_job_last_success_timestamp_seconds", now, job=job.name)
+
+    for phase, duration in job.stats.phases.items():
+        registry.set("vhpi_phase_duration_seconds", duration, job=job.name, phase=phase)
+        registry.inc("vhpi_phase_seconds_total", duration, job=job.name, phase=phase)
+
+    rsync_stats = job.stats.rsync
+
+    if rsync_stats:
+        for name, value in (
+            ("vhpi_rsync_files_transferred_total", rsync_stats.files_transferred),
+            ("vhpi_rsync_transferred_bytes_total", rsync_stats.transferred_size),
+            ("vhpi_rsync_sent_bytes_total", rsync_stats.bytes_sent),
+            ("vhpi_rsync_received_bytes_total", rsync_stats.bytes_received),
+        ):
+            registry.inc(name, value, job=job.name)
+
+    # Don't let the collector wait for the next interval.
+    exporter.write_textfile()
+
+
+def record_snapshots(
+    job_name: str,
+    backup_root: BackupRoot,
+    state_dir: StateDir,
+    names: Iterable[SnapshotName],
+    timestamps: SnapshotTimestamps,
+) -> None:
+    """
+    Record the amount of snapshots of each interval and the time of the
+    newest one, as they are recorded in the snapshot index.
+    """
+    with SnapshotIndex(backup_root, state_dir) as index:
+        counts = Counter(entry.name for entry in index.get_all())
+
+    for name in names:
+        registry.set("vhpi_snapshots", counts[name], job=job_name, snapshot=name)
+        registry.set(
+            "vhpi_snapshot_last_timestamp_seconds",
+            timestamps.get(name, 0),
+            job=job_name,
+            snapshot=name,
+        )
+
+
+def _parse_address(listen: str) -> tuple[str, int]:
+    """
+    Parse 'host:port' or a plain port, which listens on localhost only.
+    """
+    host, _, port = str(listen).rpartition(":")
+
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # Scrapes would flood the logs.
+        pass
+
+
+class MetricsExporter:
+    """
+    Expose the metrics of the registry to Prometheus, via a small HTTP server
+    ('listen') and/or by writing them to a file for the textfile collector of
+    the node exporter ('textfile'). Both are optional.
+    """
+
+    def __init__(self):
+        self.listen = ""
+        self.textfile = ""
+
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._writer: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _start_server(self, listen: str) -> None:
+        try:
+            self._server = ThreadingHTTPServer(_parse_address(listen), _Handler)
+        except (OSError, ValueError) as e:
+            log.error(log.lvl0_ts_msg(f"[Error] Could not serve metrics: {e}"))
+            return
+
+        self._server.daemon_threads = True
+
+        threading.Thread(
+            target=self._server.serve_forever, name="vhpi-metrics", daemon=True
+        ).start()
+
+        log.debug(log.lvl1_ts_msg(f"Serve metrics on: {listen}"))
+
+    def _stop_server(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def write_textfile(self) -> None:
+        """
+        Atomically replace the textfile, so that the collector never reads a
+        partial file.
+        """
+        textfile = self.textfile
+
+        if not textfile:
+            return
+
+        try:
+            with open(f"{textfile}.tmp", "w") as f:
+                f.write(registry.render())
+
+            os.replace(f"{textfile}.tmp", textfile)
+
+        except OSError as e:
+            log.error(log.lvl0_ts_msg(f"[Error] Could not write metrics: {e}"))
+
+    def _write_textfile_loop(self) -> None:
+        while True:
+            self.write_textfile()
+
+            if self._stop.wait(_TEXTFILE_INTERVAL):
+                return
+
+    def configure(self, listen: str = "", textfile: str = "") -> None:
+        """
+        @listen: 'host:port' or a port to serve the metrics on, '' for none.
+        @textfile: The file to write the metrics to, '' for none.
+        """
+        with self._lock:
+            if listen != self.listen:
+                self._stop_server()
+                self.listen = listen
+
+                if listen:
+                    self._start_server(listen)
+
+            self.textfile = textfile
+
+            if textfile and self._writer is None:
+                self._stop.clear()
+                self._writer = threading.Thread(
+                    target=self._write_textfile_loop,
+                    name="vhpi-metrics-textfile",
+                    daemon=True,
+                )
+                self._writer.start()
+
+    def close(self) -> None:
+        with self._lock:
+            self._stop_server()
+            self.listen = ""
+            self._stop.set()
+            self._writer = None
+
+        # Leave the final state for the collector.
+        self.write_textfile()
+
+
+exporter = MetricsExporter()
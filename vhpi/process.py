@@ -0,0 +1,116 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import subprocess as sp
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from . import lib
+
+# The arguments of a command, e.g. ['rsync', '-a', '/src/', '/dst/'].
+Command = list[str]
+
+# The encrypted password of a remote source, see lib.write_login().
+LoginToken = bytes
+
+# The full paths of executables, looked up in PATH once, e.g.
+# {'rsync': '/usr/bin/rsync'}.
+_paths: dict[str, Optional[str]] = {}
+_paths_lock = threading.Lock()
+
+
+def which(name: str) -> Optional[str]:
+    """
+    Get the full path of an executable, like shutil.which(), but only search
+    PATH once per name.
+    """
+    with _paths_lock:
+        if name not in _paths:
+            _paths[name] = shutil.which(name)
+
+        return _paths[name]
+
+
+def _resolve(command: Command) -> Command:
+    """
+    Replace the name of the executable with its full path. Unknown names are
+    kept, so that starting the process raises FileNotFoundError.
+    """
+    return [which(command[0]) or command[0], *command[1:]]
+
+
+@contextmanager
+def _with_login(
+    command: Command,
+    login_token: Optional[LoginToken],
+) -> Iterator[tuple[Command, tuple[int, ...]]]:
+    """
+    Wrap a command with 'sshpass -d', which reads the password from an
+    inherited pipe, so that it does not show up in the process list.
+    Yields the command and the fds that must be passed on.
+    """
+    if not login_token:
+        yield _resolve(command), ()
+        return
+
+    read_fd, write_fd = os.pipe()
+
+    try:
+        # A password fits into the pipe buffer, so this never blocks.
+        os.write(write_fd, lib.read_login(login_token).encode() + b"\n")
+        os.close(write_fd)
+        write_fd = -1
+
+        sshpass = ["sshpass", "-d", str(read_fd)]
+
+        yield _resolve(sshpass) + _resolve(command), (read_fd,)
+
+    finally:
+        os.close(read_fd)
+
+        if write_fd >= 0:
+            os.close(write_fd)
+
+
+def popen(
+    command: Command,
+    login_token: Optional[LoginToken] = None,
+    **kwargs,
+) -> sp.Popen:
+    """
+    Start a command without a shell, see subprocess.Popen() for the keyword
+    args.
+    @login_token: The password for ssh, if the command connects to a remote
+    source.
+    """
+    with _with_login(command, login_token) as (args, pass_fds):
+        return sp.Popen(args, pass_fds=pass_fds, **kwargs)
+
+
+def run(
+    command: Command,
+    login_token: Optional[LoginToken] = None,
+    **kwargs,
+) -> sp.CompletedProcess:
+    """
+    Run a command and wait for it, see subprocess.run() for the keyword args.
+    """
+    with _with_login(command, login_token) as (args, pass_fds):
+        return sp.run(args, pass_fds=pass_fds, **kwargs)
@@ -0,0 +1,248 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Iterable, Optional
+
+from . import metrics
+from .logging import log
+
+# The 'source_ip' of a job, an ip address or a host name.
+Host = str
+
+# (online, checked_at) of a host, 'checked_at' is a time.monotonic() value.
+ProbeResult = tuple[bool, float]
+
+# Errors of a tcp connect, which prove that the host itself is up.
+_HOST_UP_ERRORS = (errno.ECONNREFUSED, errno.ECONNRESET)
+
+_ICMP_ECHO_REQUEST = 8
+_ICMP_ECHO_REPLY = 0
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\x00"
+
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+
+    return ~total & 0xFFFF
+
+
+def _resolve(host: Host) -> Optional[tuple]:
+    try:
+        family, _, _, _, address = socket.getaddrinfo(
+            host, None, proto=socket.IPPROTO_TCP
+        )[0]
+        return family, address[0]
+
+    except (socket.gaierror, UnicodeError):
+        return None
+
+
+def probe_tcp(host: Host, port: int, timeout: float) -> bool:
+    """
+    Check if a host is up via a tcp connect. A refused connection counts as
+    online, because only a running machine can refuse it.
+    """
+    resolved = _resolve(host)
+
+    if not resolved:
+        return False
+
+    family, address = resolved
+
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+
+        try:
+            s.connect((address, port))
+            return True
+
+        except OSError as e:
+            return e.errno in _HOST_UP_ERRORS
+
+
+def probe_icmp(host: Host, timeout: float) -> Optional[bool]:
+    """
+    Send an echo request via an unprivileged icmp socket (see
+    'net.ipv4.ping_group_range'). Returns None if such sockets are not
+    permitted, so that the caller can fall back to another probe.
+    """
+    resolved = _resolve(host)
+
+    if not resolved:
+        return False
+
+    family, address = resolved
+
+    if family != socket.AF_INET:
+        return None
+
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except OSError:
+        return None
+
+    with s:
+        # The kernel replaces the identifier with the port of the socket.
+        seq = os.getpid() & 0xFFFF
+        header = struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0, 0, 0, seq)
+        payload = b"vhpi"
+        checksum = _checksum(header + payload)
+        packet = struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0, checksum, 0, seq)
+
+        try:
+            s.sendto(packet + payload, (address, 0))
+        except OSError:
+            return False
+
+        deadline = time.monotonic() + timeout
+
+        while True:
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0 or not select.select([s], [], [], remaining)[0]:
+                return False
+
+            data = s.recv(1024)
+
+            if len(data) >= 8:
+                type_, _, _, _, reply_seq = struct.unpack("!BBHHH", data[:8])
+
+                if type_ == _ICMP_ECHO_REPLY and reply_seq == seq:
+                    return True
+
+
+class ReachabilityChecker:
+    """
+    Check if source machines are online without spawning processes.
+
+    Results are cached per host for 'ttl' seconds, so that all jobs which
+    back up the same machine share a single probe. Hosts are probed with an
+    unprivileged icmp echo request if 'method' is 'icmp' (and the system
+    allows it), otherwise with a tcp connect to 'port'.
+    """
+
+    def __init__(self):
+        self.method = "tcp"
+        self.port = 22
+        self.timeout: float = 2
+        self.ttl: float = 10
+        self.max_workers = 16
+
+        self._cache: dict[Host, ProbeResult] = {}
+        self._locks: dict[Host, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def configure(
+        self,
+        method: str = "tcp",
+        port: int = 22,
+        timeout: float = 2,
+        ttl: float = 10,
+    ) -> None:
+        self.method = method
+        self.port = port
+        self.timeout = timeout
+        self.ttl = ttl
+
+        with self._lock:
+            self._cache.clear()
+
+    def _get_host_lock(self, host: Host) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(host, threading.Lock())
+
+    def _get_cached(self, host: Host, max_age: float) -> Optional[bool]:
+        result = self._cache.get(host)
+
+        if result and time.monotonic() - result[1] < max_age:
+            return result[0]
+
+        return None
+
+    def _probe(self, host: Host) -> bool:
+
+        if self.method == "icmp":
+            online = probe_icmp(host, self.timeout)
+
+            if online is not None:
+                return online
+
+            log.debug(
+                log.lvl1_ts_msg(
+                    "Icmp sockets are not permitted, fall back to tcp probes."
+                )
+            )
+            self.method = "tcp"
+
+        return probe_tcp(host, self.port, self.timeout)
+
+    def is_online(self, host: Host, max_age: Optional[float] = None) -> bool:
+        """
+        Get the cached state of a host, or probe it if the cached result is
+        older than 'max_age' (default: ttl) seconds. Concurrent calls for the
+        same host wait for a single probe.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        online = self._get_cached(host, max_age)
+
+        if online is not None:
+            return online
+
+        with self._get_host_lock(host):
+
+            # Another thread may have probed the host in the meantime.
+            online = self._get_cached(host, max_age)
+
+            if online is None:
+                online = self._probe(host)
+                self._cache[host] = (online, time.monotonic())
+                metrics.registry.set("vhpi_source_up", int(online), host=host)
+
+        return online
+
+    def check_all(
+        self, hosts: Iterable[Host], max_age: Optional[float] = None
+    ) -> dict[Host, bool]:
+        """
+        Probe several hosts concurrently and cache the results.
+        """
+        hosts = list(dict.fromkeys(hosts))
+
+        if not hosts:
+            return {}
+
+        workers = min(self.max_workers, len(hosts))
+        is_online = partial(self.is_online, max_age=max_age)
+
+        with ThreadPoolExecutor(workers, thread_name_prefix="vhpi-probe") as pool:
+            return dict(zip(hosts, pool.map(is_online, hosts)))
+
+
+checker = ReachabilityChecker()
@@ -0,0 +1,226 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, Optional, Union
+
+from . import process
+from .logging import log
+
+# A phase of a job with heavy disk io: 'rsync', 'hardlink' or 'delete'.
+Phase = str
+
+# The id of the device that holds a path, see get_device().
+Device = int
+
+# The 'source_ip' of a job.
+Host = str
+
+# A bandwidth limit for all rsync processes of a disk in KiB/s, 0 for none, or
+# 'auto' to use the throughput that was measured for single rsync processes.
+BwLimit = Union[int, str]
+
+_IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+
+# Weight of the latest measurement in the average throughput of a disk.
+_THROUGHPUT_WEIGHT = 0.3
+
+# Runs that transferred less data say little about the throughput of a disk.
+_MIN_MEASURED_SIZE = 64 * 1024 * 1024
+
+
+def get_device(path: str) -> Device:
+    """
+    Get the id of the device that holds the given path.
+    Unreachable paths are grouped under the id -1.
+    """
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return -1
+
+
+@dataclass
+class Slot:
+    """
+    The permission to run a phase, with the settings it should use.
+    """
+
+    phase: Phase
+    device: Device
+    # The rsync '--bwlimit' in KiB/s, 0 for no limit.
+    bwlimit: int = 0
+    # The command prefix that sets the io class, e.g. ['/usr/bin/ionice', '-c3'].
+    ionice: list[str] = field(default_factory=list)
+
+
+class ResourceLimiter:
+    """
+    Treat each destination disk and each source host as a resource with a
+    limited amount of slots. A phase with heavy io has to take a slot of its
+    disk (and the rsync phase also one of its source host) and waits while
+    all slots are taken, so that parallel jobs don't make a disk seek back and
+    forth between them.
+
+    The bandwidth limit of a disk is split between the rsync processes that
+    write to it at the same time.
+    """
+
+    def __init__(self):
+        self.disk_slots = 0
+        self.host_slots = 0
+        self.bwlimit: BwLimit = 0
+        self.ionice: dict[Phase, str] = {"delete": "idle"}
+
+        self._cond = threading.Condition()
+        self._disks: Counter = Counter()
+        self._hosts: Counter = Counter()
+        self._rsyncs: Counter = Counter()
+        # The average throughput of single rsync processes per disk in KiB/s.
+        self._throughput: dict[Device, float] = {}
+
+    def configure(
+        self,
+        disk_slots: int = 0,
+        host_slots: int = 0,
+        bwlimit: BwLimit = 0,
+        ionice: Optional[dict[Phase, str]] = None,
+    ) -> None:
+        """
+        @disk_slots: Phases per destination disk, 0 for no limit.
+        @host_slots: rsync processes per source host, 0 for no limit.
+        @ionice: The io class of each phase, e.g. {'delete': 'idle'}.
+        """
+        with self._cond:
+            self.disk_slots = max(0, int(disk_slots))
+            self.host_slots = max(0, int(host_slots))
+            self.bwlimit = bwlimit
+            self.ionice = {"delete": "idle"} if ionice is None else dict(ionice)
+
+            # Higher limits may let waiting phases start.
+            self._cond.notify_all()
+
+    def _is_free(self, device: Device, host: Optional[Host]) -> bool:
+
+        if self.disk_slots and self._disks[device] >= self.disk_slots:
+            return False
+
+        if host and self.host_slots and self._hosts[host] >= self.host_slots:
+            return False
+
+        return True
+
+    def _get_bwlimit(self, device: Device) -> int:
+        """
+        Get the share of the disk bandwidth for an rsync process, that starts
+        now. Called with the lock held and the process already counted.
+        """
+        if self.bwlimit == "auto":
+            if self._rsyncs[device] < 2 or device not in self._throughput:
+                return 0
+
+            total = self._throughput[device]
+        else:
+            total = int(self.bwlimit or 0)
+
+        if total <= 0:
+            return 0
+
+        return max(1, int(total / self._rsyncs[device]))
+
+    def _get_ionice(self, phase: Phase) -> list[str]:
+        io_class = _IONICE_CLASSES.get(self.ionice.get(phase, ""))
+        ionice = process.which("ionice")
+
+        if not io_class or not ionice:
+            return []
+
+        return [ionice, f"-c{io_class}"]
+
+    @contextmanager
+    def acquire(
+        self,
+        phase: Phase,
+        path: str,
+        host: Optional[Host] = None,
+    ) -> Iterator[Slot]:
+        """
+        Wait for a free slot on the disk of 'path' (and on 'host') and hold it
+        while the wrapped phase runs.
+        """
+        device = get_device(path)
+        host = host if phase == "rsync" else None
+
+        with self._cond:
+            if not self._is_free(device, host):
+                log.debug(log.lvl1_ts_msg(f"Wait for a free io slot ({phase})."))
+
+            self._cond.wait_for(lambda: self._is_free(device, host))
+
+            self._disks[device] += 1
+
+            if host:
+                self._hosts[host] += 1
+
+            if phase == "rsync":
+                self._rsyncs[device] += 1
+
+            slot = Slot(
+                phase=phase,
+                device=device,
+                bwlimit=self._get_bwlimit(device) if phase == "rsync" else 0,
+                ionice=self._get_ionice(phase),
+            )
+
+        try:
+            yield slot
+
+        finally:
+            with self._cond:
+                self._disks[device] -= 1
+
+                if host:
+                    self._hosts[host] -= 1
+
+                if phase == "rsync":
+                    self._rsyncs[device] -= 1
+
+                self._cond.notify_all()
+
+    def record_throughput(self, slot: Slot, size: int, duration: float) -> None:
+        """
+        Update the average throughput of a disk with a finished rsync process.
+        Only unthrottled processes are measured, throttled ones would only
+        confirm their own limit.
+        """
+        if slot.bwlimit or size < _MIN_MEASURED_SIZE or duration <= 0:
+            return
+
+        throughput = size / 1024 / duration
+
+        with self._cond:
+            average = self._throughput.get(slot.device, throughput)
+            self._throughput[slot.device] = (
+                _THROUGHPUT_WEIGHT * throughput + (1 - _THROUGHPUT_WEIGHT) * average
+            )
+
+
+limiter = ResourceLimiter()
@@ -16,48 +16,57 @@
 # along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
+import selectors
+import shlex
 import subprocess as sp
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from subprocess import Popen
-from typing import Optional, Union
-
-from . import lib
-from .logging import log
-from .types import App, BackupLatest, Job
-
-
-def _get_excludes(
-    excludes: list,
-    excl_lists: list,
-    excl_lib: dict,
-) -> list[str]:
-    for _list in excl_lists:
-        for item in excl_lib[_list]:
-            excludes.append(item)
-
-    return ['--exclude="' + item + '"' for item in excludes]
+from typing import Callable, Optional, Sequence, Union
+
+from . import (
+    incremental,
+    lib,
+    metrics,
+    process,
+    reachability,
+    resources,
+    shard,
+    ssh,
+    stats,
+)
+from .logging import LogContext, SectionId, log
+from .types import App, BackupLatest, Job, RsyncOptions, RsyncStats
 
 
 def _get_rsync_command(
-    rsync_options: str,
+    rsync_options: RsyncOptions,
     backup_src: str,
     backup_latest: BackupLatest,
-    excludes: list,
-    excl_lists: list,
-    excl_lib: dict,
-) -> str:
+    exclude_file: Optional[str],
+    rsh: list[str],
+) -> list[str]:
     """
-    Build rsync command from config data.
-    @rsync_options: from cfg, e.g.: "-aAHSvX --delete"
-    @excludes: from cfg, e.g.: ['downloads', 'tmp']
-    @excl_lists: from cfg, e.g.: ['standard_list']
-    @excl_lib: from cfg, e.g.: {'standard_list': ['downloads', 'tmp']}
+    Build the rsync args from the plan of a job.
+    @rsync_options: e.g.: ('-aAHSvX', '--delete')
+    @exclude_file: The filter file with the excludes of the job.
+    @rsh: remote shell option, e.g.: ['-e', 'ssh -o ControlPath=...']
+    @backup_latest: The destination, omitted if empty.
     """
-    exclude_flags = _get_excludes(excludes, excl_lists, excl_lib)
-    src = lib.clean_path(backup_src)
-    dst = lib.clean_path(backup_latest)
+    command = ["rsync", *rsh, *rsync_options]
+
+    if exclude_file:
+        command.append(f"--filter=merge {exclude_file}")
+
+    command.append(lib.clean_path(backup_src))
 
-    return f"rsync {rsync_options} {''.join(exclude_flags)} {src} {dst}"
+    if backup_latest:
+        command.append(lib.clean_path(backup_latest))
+
+    return command
 
 
 def _terminate_sub_process(p: Popen) -> None:
@@ -67,23 +76,46 @@ def _terminate_sub_process(p: Popen) -> None:
             p.kill()
 
 
-def _log_line(line: str) -> None:
+# Classify a line of rsync output with a single match. The alternatives are
+# tried in order, so that e.g. 'rsync: ... error: ...' is logged as error.
+_LINE_PATTERN = re.compile(
+    r"^(?:"
+    r"(?=.*Permission denied, please try again)(?P<permission_denied>)"
+    r"|(?=.*(?:error:|IO error))(?P<error>)"
+    r"|(?=.*(?:rsync:|warning:))(?P<warning>)"
+    r"|(?=.*(?:bytes/sec|total size is ))(?P<info>)"
+    r"|(?=.*\S)(?P<debug>)"
+    r")"
+)
+
+_LOG_FUNCS = {
+    "permission_denied": log.debug,
+    "error": log.error,
+    "warning": log.warning,
+    "info": log.info,
+    "debug": log.debug,
+}
+
+# Seconds between two checks of source and destination while rsync runs.
+_LIVENESS_CHECK_INTERVAL = 1
+
+
+def _log_line(line: str, skip_debug: bool = False) -> Optional[str]:
+    """
+    Log a line of rsync output with a fitting log level.
+    Returns the name of the matched class or None for empty lines.
+    @skip_debug: Only classify the line if it is a debug line.
+    """
     line = line.replace("\n", "")
+    match = _LINE_PATTERN.match(line)
 
-    if "error:" in line:
-        log.error(f"    {line}")
-    elif "IO error" in line:
-        log.error(f"    {line}")
-    elif "rsync:" in line:
-        log.warning(f"    {line}")
-    elif "warning:" in line:
-        log.warning(f"    {line}")
-    elif "bytes/sec" in line:
-        log.info(f"    {line}")
-    elif "total size is " in line:
-        log.info(f"    {line}")
-    elif line.strip():
-        log.debug(f"    {line}")
+    if not match or not match.lastgroup:
+        return None
+
+    if not (skip_debug and match.lastgroup == "debug"):
+        _LOG_FUNCS[match.lastgroup](f"    {line}")
+
+    return match.lastgroup
 
 
 def _log_job_out_rsync_failed(init_time: float) -> None:
@@ -106,6 +138,10 @@ def _handle_rsync_result(result: Union[str, int], init_time: float) -> bool:
         _log_job_out_rsync_failed(init_time)
         return False
 
+    elif result == "not_started":
+        _log_job_out_rsync_failed(init_time)
+        return False
+
     elif result == "no_dst":
         log.error(log.lvl1_ts_msg("Error: Backup Destination not available."))
         _log_job_out_rsync_failed(init_time)
@@ -116,81 +152,402 @@ def _handle_rsync_result(result: Union[str, int], init_time: float) -> bool:
         _log_job_out_rsync_failed(init_time)
         return False
 
+    elif result == "aborted":
+        log.error(log.lvl1_ts_msg("Error: Rsync was aborted."))
+        _log_job_out_rsync_failed(init_time)
+        return False
+
+    elif result == "incomplete":
+        log.error(log.lvl1_ts_msg("Error: Not all shards were synced."))
+        _log_job_out_rsync_failed(init_time)
+        return False
+
     return True
 
 
-# def _rsync_output(p: Popen) -> None:
-#     for line in p.stdout:
-#         _log_line(line)
+def _strip_delete_options(rsync_options: RsyncOptions) -> RsyncOptions:
+    return tuple(
+        option for option in rsync_options if not option.startswith("--delete")
+    )
 
 
-# def _async_log_subprocess_output(p: Popen) -> None:
-#     output_stream = threading.Thread(target=_rsync_output, args=(p,))
-#     output_stream.setDaemon(True)
-#     output_stream.start()
+def _check_liveness(job: Job) -> Optional[str]:
+    if not reachability.checker.is_online(job.source_ip):
+        return "source_offline"
 
+    if not os.path.isdir(job.backup_root):
+        return "no_dst"
 
-def _run_rsync_process(job: Job) -> Union[str, int]:
+    return None
 
-    rsync_command: str = _get_rsync_command(
-        rsync_options=job.rsync_options,
-        backup_src=job.backup_src,
-        backup_latest=job.backup_latest,
-        excludes=job.excludes,
-        excl_lists=job.exclude_lists,
-        excl_lib=job.exclude_lib,
-    )
 
-    log.debug("    Executing: " + rsync_command)
+def _run_rsync_process(
+    job: Job,
+    rsync_command: list[str],
+    on_line: Optional[Callable[[str], None]] = None,
+    abort: Optional[threading.Event] = None,
+) -> Union[str, int]:
+    """
+    Run an rsync command, log its output and watch source and destination.
+    Output is handled line by line as it arrives, the liveness checks run on
+    their own timer.
+    @on_line: Called with each line of output.
+    @abort: Terminate the process as soon as this event is set.
+    """
+    log.debug("    Executing: " + shlex.join(rsync_command))
     log.debug("")
 
-    if job.login_token:
-        rsync_command = (
-            'sshpass -p "' + lib.read_login(job.login_token) + '" ' + rsync_command
+    try:
+        p = process.popen(
+            rsync_command,
+            job.login_token,
+            stdin=sp.PIPE,
+            stdout=sp.PIPE,
+            stderr=sp.STDOUT,
         )
+    except OSError as e:
+        log.error(log.lvl1_ts_msg(f"Error: Could not start rsync: {e}"))
+        return "not_started"
 
-    p = Popen(
-        rsync_command,
-        shell=True,
-        stdin=sp.PIPE,
-        stdout=sp.PIPE,
-        stderr=sp.STDOUT,
-        close_fds=True,
-        universal_newlines=True,
-    )
+    assert p.stdout is not None
+
+    stdout_fd = p.stdout.fileno()
+    os.set_blocking(stdout_fd, False)
 
-    duration_seconds = 1
+    selector = selectors.DefaultSelector()
+    selector.register(stdout_fd, selectors.EVENT_READ)
 
-    while True:
+    pending = b""
+    next_check = time.monotonic() + _LIVENESS_CHECK_INTERVAL
 
-        return_code: Optional[int] = p.poll()
+    # The file list is logged as debug lines. Large transfers may log only
+    # every n-th of them, see Log.rsync_debug_sample.
+    sample = log.rsync_debug_sample
+    debug_lines = 0
+    skipped_lines = 0
 
-        # break if subprocess finished naturally.
-        if return_code is not None:
+    def handle_lines(data: bytes) -> Optional[str]:
+        nonlocal debug_lines, skipped_lines
 
-            # Log what is left in buffer.
-            if p.stdout:
-                _log_line(p.stdout.read())
+        for raw_line in data.split(b"\n"):
+            line = raw_line.decode(errors="replace").rstrip("\r")
+            skip_debug = sample != 1 and (sample == 0 or debug_lines % sample != 0)
+            line_class = _log_line(line, skip_debug)
 
-            return return_code
+            if line_class == "permission_denied":
+                return "permission_denied"
 
-        if p.stdout:
-            for line in p.stdout.readlines():
-                _log_line(line)
+            if line_class == "debug":
+                debug_lines += 1
 
-                if "Permission denied, please try again" in line:
+                if skip_debug:
+                    skipped_lines += 1
+
+            if on_line:
+                on_line(line)
+
+        return None
+
+    try:
+        while True:
+            timeout = max(0, next_check - time.monotonic())
+
+            for _ in selector.select(timeout):
+                try:
+                    chunk = os.read(stdout_fd, 65536)
+                except BlockingIOError:
+                    continue
+
+                # EOF: Log what is left in buffer and wait for the exit code.
+                if not chunk:
+                    if pending:
+                        handle_lines(pending)
+                    return p.wait()
+
+                lines, _, pending = (pending + chunk).rpartition(b"\n")
+
+                if lines and handle_lines(lines) == "permission_denied":
                     _terminate_sub_process(p)
                     return "permission_denied"
 
-        if not lib.is_machine_online(job.source_ip):
-            _terminate_sub_process(p)
-            return "source_offline"
+            if abort and abort.is_set():
+                _terminate_sub_process(p)
+                return "aborted"
+
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + _LIVENESS_CHECK_INTERVAL
+                reason = _check_liveness(job)
+
+                if reason:
+                    _terminate_sub_process(p)
+                    return reason
 
-        if not os.path.isdir(job.backup_root):
-            _terminate_sub_process(p)
-            return "no_dst"
+    finally:
+        selector.close()
+        p.stdout.close()
 
-        time.sleep(duration_seconds)
+        if skipped_lines:
+            log.debug(
+                f"    [{skipped_lines} of {debug_lines} debug lines were not "
+                f"logged, see log_rsync_sample]"
+            )
+
+
+def _apply_slot(rsync_command: list[str], slot: resources.Slot) -> list[str]:
+    """
+    Add the bandwidth limit and io class of a slot to an rsync command. A
+    '--bwlimit' of the job's rsync options takes precedence.
+    """
+    command = list(rsync_command)
+
+    if slot.bwlimit and not any(arg.startswith("--bwlimit") for arg in command):
+        command.insert(1, f"--bwlimit={slot.bwlimit}")
+
+    return slot.ionice + command
+
+
+def _run_with_stats(
+    job: Job,
+    rsync_command: list[str],
+    on_line: Optional[Callable[[str], None]] = None,
+    abort: Optional[threading.Event] = None,
+) -> tuple[Union[str, int], RsyncStats]:
+    """
+    Run an rsync command, once a slot for its destination disk and its source
+    host is free, and parse its '--stats' output.
+    """
+    parser = stats.RsyncStatsParser()
+
+    def feed(line: str) -> None:
+        parser.feed(line)
+
+        if on_line:
+            on_line(line)
+
+    with resources.limiter.acquire("rsync", job.backup_root, job.source_ip) as slot:
+        start = time.monotonic()
+        result = _run_rsync_process(job, _apply_slot(rsync_command, slot), feed, abort)
+        parser.stats.duration = round(time.monotonic() - start, 3)
+
+    if result == 0:
+        resources.limiter.record_throughput(
+            slot, parser.stats.transferred_size, parser.stats.duration
+        )
+
+    return result, parser.stats
+
+
+def _run_single(
+    job: Job,
+    incremental_run: Optional[incremental.IncrementalRun],
+) -> Union[str, int]:
+
+    rsync_command: list[str] = _get_rsync_command(
+        rsync_options=stats.with_stats_option(
+            incremental.get_rsync_options(job, incremental_run)
+        ),
+        backup_src=incremental.get_rsync_src(job, incremental_run),
+        backup_latest=job.backup_latest,
+        exclude_file=job.exclude_file,
+        rsh=ssh.pool.get_rsh_option(job),
+    )
+
+    result, job.stats.rsync = _run_with_stats(job, rsync_command)
+
+    return result
+
+
+def _list_shards(job: Job, src_dir: str) -> Optional[list[shard.ShardName]]:
+    """
+    List the top-level dirs of the source with 'rsync --list-only'.
+    This works for local and remote sources alike.
+    """
+    list_command = _get_rsync_command(
+        rsync_options=(
+            *_strip_delete_options(job.rsync_options),
+            "--list-only",
+            "--no-recursive",
+            "--dirs",
+        ),
+        backup_src=src_dir,
+        backup_latest="",
+        exclude_file=job.exclude_file,
+        rsh=ssh.pool.get_rsh_option(job),
+    )
+
+    try:
+        p = process.run(
+            list_command,
+            job.login_token,
+            stdout=sp.PIPE,
+            stderr=sp.DEVNULL,
+            universal_newlines=True,
+            check=False,
+        )
+    except OSError:
+        return None
+
+    if p.returncode != 0:
+        log.warning(log.lvl1_ts_msg("Warning: Could not list shards of the source."))
+        return None
+
+    return shard.parse_dir_listing(p.stdout)
+
+
+def _aggregate_results(results: Sequence[Union[str, int]]) -> Union[str, int]:
+    """
+    Reduce the results of several rsync processes to the most severe one.
+    """
+    # An aborted shard was not synced, but the shard that caused the abort
+    # reports the more useful reason.
+    for reason in (
+        "not_started",
+        "permission_denied",
+        "source_offline",
+        "no_dst",
+        20,
+        "aborted",
+    ):
+        if reason in results:
+            return reason
+
+    return max((r for r in results if isinstance(r, int)), default=0)
+
+
+def _run_shard(
+    job: Job,
+    src_dir: str,
+    dst_dir: str,
+    sizes: shard.ShardSizes,
+    abort: threading.Event,
+    section: Optional[SectionId],
+    context: Optional[LogContext],
+    name: shard.ShardName,
+) -> tuple[Union[str, int], RsyncStats]:
+
+    with log.use_section(section), log.context(**(context or {}), shard=name):
+
+        if abort.is_set():
+            return "aborted", RsyncStats()
+
+        def on_line(line: str) -> None:
+            size = shard.parse_total_size(line)
+
+            if size is not None:
+                sizes[name] = size
+
+        rsync_command: list[str] = _get_rsync_command(
+            rsync_options=stats.with_stats_option(job.rsync_options),
+            backup_src=src_dir + name,
+            backup_latest=dst_dir,
+            exclude_file=job.exclude_file,
+            rsh=ssh.pool.get_rsh_option(job),
+        )
+
+        result, rsync_stats = _run_with_stats(job, rsync_command, on_line, abort)
+
+        if isinstance(result, str) or result == 20:
+            abort.set()
+
+        elif result != 0:
+            log.error(log.lvl1_ts_msg(f"Error: Rsync exited with code {result}."))
+
+        return result, rsync_stats
+
+
+def _get_sharded_result(result: Union[str, int]) -> Union[str, int]:
+    """
+    Treat any exit code but 0 of a sharded run as failure, because the shards
+    together make up 'backup.latest'.
+    """
+    if isinstance(result, str) or result in (0, 20):
+        return result
+
+    return "incomplete"
+
+
+def _run_sharded(job: Job) -> Union[str, int]:
+    """
+    Sync each top-level dir of the source with its own rsync process and run
+    up to 'rsync_shards' of them in parallel. The top-level entries themselves
+    are synced first in a non-recursive pass, which also applies '--delete'
+    to removed top-level dirs. Only sources with a trailing slash are
+    sharded, see config.
+    """
+    src_dir, dst_dir = job.backup_src, f"{job.backup_latest}/"
+    names = _list_shards(job, src_dir)
+
+    if names is None:
+        return _run_single(job, None)
+
+    top_level_command = _get_rsync_command(
+        rsync_options=stats.with_stats_option(
+            (*job.rsync_options, "--no-recursive", "--dirs")
+        ),
+        backup_src=src_dir,
+        backup_latest=dst_dir,
+        exclude_file=job.exclude_file,
+        rsh=ssh.pool.get_rsh_option(job),
+    )
+
+    os.makedirs(dst_dir, exist_ok=True)
+    result, top_level_stats = _run_with_stats(job, top_level_command)
+    job.stats.rsync = top_level_stats
+
+    if result != 0:
+        return _get_sharded_result(result)
+
+    sizes = shard.load_sizes(job)
+    ordered_names = shard.order_by_size(names, sizes)
+    abort = threading.Event()
+
+    log.debug(
+        log.lvl1_ts_msg(
+            f"Sync {len(names)} shards with {job.rsync_shards} rsync processes."
+        )
+    )
+
+    with ThreadPoolExecutor(
+        max_workers=job.rsync_shards,
+        thread_name_prefix="vhpi-shard",
+    ) as pool:
+        shard_results = list(
+            pool.map(
+                partial(
+                    _run_shard,
+                    job,
+                    src_dir,
+                    dst_dir,
+                    sizes,
+                    abort,
+                    log.get_section(),
+                    log.get_context(),
+                ),
+                ordered_names,
+            )
+        )
+
+    shard.save_sizes(job, {name: sizes[name] for name in names if name in sizes})
+
+    job.stats.rsync = stats.merge(
+        [top_level_stats] + [rsync_stats for _, rsync_stats in shard_results]
+    )
+
+    return _get_sharded_result(
+        _aggregate_results([result, *(r for r, _ in shard_results)])
+    )
+
+
+def _run(
+    job: Job,
+) -> tuple[Union[str, int], Optional[incremental.IncrementalRun]]:
+
+    incremental_run = incremental.prepare(job)
+
+    if job.rsync_shards > 1 and not (incremental_run and incremental_run.files_from):
+        return _run_sharded(job), incremental_run
+
+    return _run_single(job, incremental_run), incremental_run
 
 
 def run(app: App, job: Job) -> bool:
@@ -200,16 +557,27 @@ def run(app: App, job: Job) -> bool:
     log.debug(log.lvl1_ts_msg("Start: rsync execution."))
 
     try:
-        result: Union[str, int] = _run_rsync_process(job)
+        with stats.phase(job.stats, "rsync"):
+            result, incremental_run = _run(job)
 
         if not _handle_rsync_result(result=result, init_time=job.init_time):
+            reason = result if isinstance(result, str) else f"exit_code_{result}"
+            metrics.registry.inc(
+                "vhpi_rsync_failures_total", job=job.name, reason=reason
+            )
             return False
 
+        if incremental_run and result == 0:
+            incremental.commit(job, incremental_run)
+
     except sp.SubprocessError as e:
         log.error(log.lvl1_ts_msg("Error: An error occurred in the rsync subprocess."))
 
         log.debug(e)
 
+        metrics.registry.inc(
+            "vhpi_rsync_failures_total", job=job.name, reason="subprocess_error"
+        )
         _log_job_out_rsync_failed(job.init_time)
 
         return False
@@ -0,0 +1,314 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Optional
+
+from . import metrics, reachability, snapshot, timestamp_store
+from .config import CfgWatcher
+from .executor import JobExecutor
+from .logging import log
+from .reachability import Host
+from .types import App, Config, SnapshotName
+
+# The index of a job plan in 'Config.jobs'.
+JobIndex = int
+
+# An entry of the schedule: (due_at, seq, cfg_generation, job_index, name)
+ScheduleEntry = tuple[float, int, int, JobIndex, SnapshotName]
+
+
+class Scheduler:
+    """
+    Keep the next due time of each (job, snapshot interval) pair in a heap and
+    sleep until the earliest one is reached.
+
+    The scheduler only wakes up early if the config file changed or a job
+    finished. Jobs that are due, but could not be completed, are retried
+    after 'retry_interval' seconds. If the source of such a job was offline,
+    the source is probed every 'offline_poll_interval' seconds and the job is
+    started as soon as it is back.
+
+    A changed config file is parsed by the watcher thread and swapped in
+    between two cycles. Running jobs finish with the plans they started with
+    and are planned again with the new config (by name) once they finished.
+    """
+
+    def __init__(
+        self,
+        app: App,
+        executor: JobExecutor,
+        cfg: Config,
+        load_cfg: Callable[[], Optional[Config]],
+        cfg_poll_interval: float = 5,
+        apply_cfg: Optional[Callable[[Config], None]] = None,
+    ):
+        """
+        @load_cfg: Parse the changed config file, called by the watcher thread.
+        @apply_cfg: Apply the app settings of a new config, called by the
+        scheduling loop when the config is swapped in.
+        """
+        self.app = app
+        self.executor = executor
+        self.cfg = cfg
+        self.load_cfg = load_cfg
+        self.apply_cfg = apply_cfg
+
+        self.retry_interval: float = 60
+        self.offline_poll_interval: float = 10
+
+        self._heap: list[ScheduleEntry] = []
+        self._seq = itertools.count()
+        self._cfg_generation = 0
+        # The names of the running jobs. Names stay valid across config
+        # generations, indexes don't.
+        self._in_flight: set[str] = set()
+        # Jobs that wait for their offline source to come back.
+        self._offline: dict[JobIndex, Host] = {}
+        # When each job was last planned. Intervals that are overdue at that
+        # time don't count as scheduler lag.
+        self._planned_at: dict[JobIndex, float] = {}
+        self._finished: queue.SimpleQueue = queue.SimpleQueue()
+
+        self._new_cfg: Optional[Config] = None
+        self._new_cfg_lock = threading.Lock()
+        self._watcher = CfgWatcher(
+            app.cfg_file, self._on_cfg_change, poll_interval=cfg_poll_interval
+        )
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def _on_cfg_change(self) -> None:
+        """
+        Parse the changed config file and hand it over to the scheduling loop.
+        """
+        log.info(log.lvl0_ts_msg("[Config] Reloading changed config file."))
+
+        cfg = self.load_cfg()
+
+        if cfg is None:
+            log.error(log.lvl0_ts_msg("[Config] Keeping the current config."))
+            return
+
+        with self._new_cfg_lock:
+            self._new_cfg = cfg
+
+        self._wake.set()
+
+    def _push(self, due_at: float, job_index: JobIndex, name: SnapshotName) -> None:
+        entry = (due_at, next(self._seq), self._cfg_generation, job_index, name)
+        heapq.heappush(self._heap, entry)
+
+    def _plan_job(self, job_index: JobIndex, retry: bool = False) -> bool:
+        """
+        Add the next due time of each snapshot interval of a job to the heap.
+        @retry: Postpone intervals that are still due after the job finished.
+        @return: True if an interval was postponed.
+        """
+        plan = self.cfg.jobs[job_index]
+        now = time.time()
+        self._planned_at[job_index] = now
+        postponed = False
+
+        if os.path.isdir(plan.backup_root):
+            timestamps = timestamp_store.store.load(self.app, plan.backup_root)
+        else:
+            timestamps = {}
+
+        for name in plan.snapshots:
+            due_at: float = snapshot.get_due_time(
+                timestamps.get(name, 0), self.cfg.intervals[name]
+            )
+
+            if retry and due_at <= now:
+                due_at = now + self.retry_interval
+                postponed = True
+
+            self._push(due_at, job_index, name)
+
+        return postponed
+
+    def _get_job_index(self, name: str) -> Optional[JobIndex]:
+        for job_index, plan in enumerate(self.cfg.jobs):
+            if plan.name == name:
+                return job_index
+
+        return None
+
+    def _swap_cfg(self, cfg: Config) -> None:
+        """
+        Use a new config and plan all jobs from scratch. Running jobs are
+        planned when they have finished.
+        """
+        self.cfg = cfg
+        self.retry_interval = float(cfg.app_cfg.get("retry_interval", 60))
+
+        self._cfg_generation += 1
+        self._heap = []
+        self._offline = {}
+        self._planned_at = {}
+
+        for job_index, plan in enumerate(cfg.jobs):
+            if plan.name not in self._in_flight:
+                self._plan_job(job_index)
+
+    def _swap_new_cfg(self) -> None:
+        """
+        Swap in the config that was loaded by the watcher thread, if any.
+        """
+        with self._new_cfg_lock:
+            new_cfg, self._new_cfg = self._new_cfg, None
+
+        if new_cfg is None:
+            return
+
+        self._swap_cfg(new_cfg)
+
+        if self.apply_cfg:
+            self.apply_cfg(new_cfg)
+
+    def _on_job_done(self, job_name: str, future: Future) -> None:
+        self._finished.put((job_name, future))
+        self._wake.set()
+
+    def _handle_finished_jobs(self) -> None:
+
+        while not self._finished.empty():
+            job_name, future = self._finished.get()
+            self._in_flight.discard(job_name)
+
+            try:
+                future.result()
+            except Exception as e:
+                # The due intervals are retried after 'retry_interval'.
+                log.error(log.lvl0_ts_msg(f"[Error] Job '{job_name}' crashed: {e!r}"))
+
+            # The job may have been removed from the config while it ran.
+            job_index = self._get_job_index(job_name)
+
+            if job_index is None:
+                continue
+
+            if not self._plan_job(job_index, retry=True):
+                continue
+
+            host = self.cfg.jobs[job_index].source_ip
+
+            # The job just probed the source, this is a cache lookup.
+            if not reachability.checker.is_online(host):
+                self._offline[job_index] = host
+
+    def _check_offline_sources(self) -> None:
+        """
+        Probe the sources of jobs that wait for them and make the jobs due
+        right away if their source is back.
+        """
+        if not self._offline:
+            return
+
+        online = reachability.checker.check_all(
+            self._offline.values(), max_age=self.offline_poll_interval
+        )
+
+        for job_index, host in list(self._offline.items()):
+            if online.get(host):
+                del self._offline[job_index]
+                plan = self.cfg.jobs[job_index]
+                self._push(time.time(), job_index, next(iter(plan.snapshots)))
+
+    def _dispatch_due_jobs(self) -> None:
+        now = time.time()
+        due_jobs: set[JobIndex] = set()
+        # The earliest due time of each job.
+        due_at: dict[JobIndex, float] = {}
+
+        while self._heap and self._heap[0][0] <= now:
+            entry_due_at, _, cfg_generation, job_index, _ = heapq.heappop(self._heap)
+
+            if cfg_generation == self._cfg_generation:
+                due_jobs.add(job_index)
+                due_at.setdefault(job_index, entry_due_at)
+
+        # A running job is planned again once it has finished.
+        due_jobs = {
+            job_index
+            for job_index in due_jobs
+            if self.cfg.jobs[job_index].name not in self._in_flight
+        }
+
+        # Probe the sources of all due jobs at once, the jobs use the cached
+        # results.
+        reachability.checker.check_all(
+            self.cfg.jobs[job_index].source_ip for job_index in due_jobs
+        )
+
+        for job_index in sorted(due_jobs):
+
+            plan = self.cfg.jobs[job_index]
+            self._in_flight.add(plan.name)
+            self._offline.pop(job_index, None)
+
+            # Drop the remaining entries of this job, they are re-planned
+            # when the job has finished.
+            self._heap = [e for e in self._heap if e[3] != job_index]
+            heapq.heapify(self._heap)
+
+            lag = now - max(due_at[job_index], self._planned_at.get(job_index, 0))
+            metrics.registry.set("vhpi_scheduler_lag_seconds", lag, job=plan.name)
+
+            future = self.executor.submit(self.app, plan, self.cfg)
+            future.add_done_callback(partial(self._on_job_done, plan.name))
+
+    def _get_timeout(self) -> Optional[float]:
+        timeout: Optional[float] = None
+
+        if self._heap:
+            timeout = max(0, self._heap[0][0] - time.time())
+
+        if self._offline and (timeout is None or timeout > self.offline_poll_interval):
+            timeout = self.offline_poll_interval
+
+        return timeout
+
+    def run(self) -> None:
+        """
+        Run the scheduling loop until stop() is called.
+        """
+        self._swap_cfg(self.cfg)
+        self._watcher.start()
+
+        while not self._stop.is_set():
+            self._wake.clear()
+            self._swap_new_cfg()
+            self._handle_finished_jobs()
+            self._check_offline_sources()
+            self._dispatch_due_jobs()
+
+            self._wake.wait(self._get_timeout())
+
+    def stop(self) -> None:
+        self._watcher.stop()
+        self._stop.set()
+        self._wake.set()
@@ -0,0 +1,105 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+from typing import Optional
+
+from . import lib
+from .types import Job
+
+# The name of a top-level dir of the backup source, e.g. 'Music'
+ShardName = str
+
+# The estimated size of a shard in bytes.
+ShardSizes = dict[ShardName, int]
+
+_TOTAL_SIZE_PATTERN = re.compile(r"total size is ([0-9,.]+)")
+
+# A line of 'rsync --list-only': permissions, size, date, time and the name.
+# The fields are separated by single spaces (the size is padded on the left),
+# so that the name is everything after the time, including any spaces.
+_LISTING_PATTERN = re.compile(
+    r"^(?P<perms>\S{10}) +[0-9,.]+ \d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} (?P<name>.+)$"
+)
+
+# rsync escapes unprintable characters of names as '\#ooo' (octal).
+_ESCAPE_PATTERN = re.compile(r"\\#([0-7]{3})")
+
+
+def _get_sizes_file(job: Job) -> str:
+    return f"{job.state_dir}/shard_sizes"
+
+
+def load_sizes(job: Job) -> ShardSizes:
+    sizes_file = _get_sizes_file(job)
+
+    if not os.path.isfile(sizes_file):
+        return {}
+
+    return lib.load_yaml(sizes_file) or {}
+
+
+def save_sizes(job: Job, sizes: ShardSizes) -> None:
+    os.makedirs(job.state_dir, exist_ok=True)
+    lib.save_yaml(sizes, _get_sizes_file(job), default_style=None)
+
+
+def parse_total_size(line: str) -> Optional[int]:
+    """
+    Get the size from the 'total size is 1,234,567  speedup is ...' line of
+    rsync.
+    """
+    match = _TOTAL_SIZE_PATTERN.search(line)
+
+    if not match:
+        return None
+
+    return int(re.sub(r"[,.]", "", match.group(1)))
+
+
+def parse_dir_listing(output: str) -> list[ShardName]:
+    """
+    Get the dir names from the output of 'rsync --list-only'. E.g.:
+    'drwxr-xr-x          4,096 2020/01/02 10:00:00 My Music'
+    """
+    names = []
+
+    for line in output.split("\n"):
+        match = _LISTING_PATTERN.match(line)
+
+        if not match or not match.group("perms").startswith("d"):
+            continue
+
+        name = _ESCAPE_PATTERN.sub(lambda m: chr(int(m.group(1), 8)), match["name"])
+
+        if name != ".":
+            names.append(name)
+
+    return names
+
+
+def order_by_size(names: list[ShardName], sizes: ShardSizes) -> list[ShardName]:
+    """
+    Order the shards largest first, so that a pool of workers that always takes
+    the next shard ends up with a balanced load. Shards without an estimate
+    are assumed to be of average size.
+    """
+    known = [sizes[name] for name in names if name in sizes]
+    default = sum(known) // len(known) if known else 0
+
+    return sorted(names, key=lambda name: sizes.get(name, default), reverse=True)
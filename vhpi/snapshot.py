@@ -16,28 +16,46 @@
 # along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import re
-import subprocess as sp
 import sys
 import time
+from dataclasses import asdict, replace
 from datetime import datetime
-from glob import glob
-from typing import Union
-
-from . import lib
+from typing import Callable, Optional, Union
+
+from . import hardlink, lib, resources, stats, timestamp_store, trash
+from .journal import (
+    Journal,
+    JournalOp,
+    JournalState,
+    StepKey,
+    StepRecord,
+    fsync_dir,
+)
 from .logging import log
+from .snapshot_index import SnapshotIndex
 from .types import (
     App,
     Job,
     Snapshot,
+    SnapshotEntry,
     SnapshotDir,
     SnapshotDirTmp,
+    SnapshotInterval,
     SnapshotKeepAmount,
     SnapshotName,
     SnapshotTimestamp,
+    SnapshotTimestamps,
 )
 
 
+def get_due_time(timestamp: SnapshotTimestamp, interval: SnapshotInterval) -> int:
+    """
+    Get the unix time at which a snapshot with the given timestamp and
+    interval becomes due.
+    """
+    return timestamp + interval
+
+
 def _is_due(
     app: App,
     job: Job,
@@ -45,19 +63,9 @@ def _is_due(
     timestamp: SnapshotTimestamp,
 ) -> bool:
 
-    if not timestamp or not isinstance(timestamp, str):
-        timestamp = "1970-01-02 00:00:00"
-
     interval: int = job.snapshot_intervals[name]
-    format_ = app.timestamp_format
-    timestamp_str = datetime.strptime(timestamp, format_).timetuple()
-    timestamp_int = int(time.mktime(timestamp_str))
-    time_now = time.time()
 
-    if time_now - timestamp_int >= interval:
-        return True
-    else:
-        return False
+    return time.time() >= get_due_time(timestamp, interval)
 
 
 def get_snapshot(
@@ -82,127 +90,401 @@ def get_snapshot(
         base_pattern=base_pattern,
         name=name,
         keep_amount=keep_amount,
-        last_completion_at="",
+        last_completion_at=timestamp,
         is_due=_is_due(app, job, name, timestamp),
     )
 
 
-def _create_hardlinks(job: Job, snapshot: Snapshot) -> None:
+def _create_hardlinks(
+    job: Job,
+    dsts: list[SnapshotDirTmp],
+    resume: bool = False,
+) -> hardlink.LinkStats:
     """
-    Create hard-links with unix cp tool.
-    This creates hardlinks from 'backup.latest' to the snapshot temp dir.
+    Create hard-links from 'backup.latest' to each temp dir in 'dsts'.
+    The 'native' engine walks 'backup.latest' once for all snapshots, the 'cp'
+    engine runs 'cp -al' for each snapshot. Partial trees of an interrupted
+    run are always completed by the native engine.
     """
     log.debug(
         log.lvl1_ts_msg(
-            f'Create hardlinks: {job.backup_latest.split("/")[-1]} '
-            f'-> {snapshot.dst_tmp.split("/")[-1]}'
+            f'{"Resume" if resume else "Create"} hardlinks: '
+            f'{job.backup_latest.split("/")[-1]} '
+            f'-> {", ".join(dst.split("/")[-1] for dst in dsts)}'
         )
     )
 
-    cmd = ["cp", "-al", job.backup_latest, snapshot.dst_tmp]
+    with resources.limiter.acquire("hardlink", job.backup_root) as slot:
+        if resume:
+            stats = hardlink.link_tree(job.backup_latest, dsts, resume=True)
+        elif job.hardlink_engine == "cp":
+            stats = hardlink.cp_link_tree(job.backup_latest, dsts, slot.ionice)
+        else:
+            stats = hardlink.link_tree(job.backup_latest, dsts)
+
+    log.debug(
+        log.lvl1_ts_msg(
+            f"Created hardlinks for {stats.files} files in {stats.dirs} dirs "
+            f"({stats.errors} errors) in {stats.duration:.2f} seconds."
+        )
+    )
+    log.event(
+        "Hardlinks created",
+        files=stats.files,
+        dirs=stats.dirs,
+        size=stats.size,
+        errors=stats.errors,
+        duration=round(stats.duration, 3),
+    )
+
+    return stats
+
+
+def _link_to(target_name: str, link_path: str) -> None:
+    """
+    Atomically create or replace a shared reference to a snapshot in the same
+    backup root.
+    """
+    tmp_link = f"{link_path}.link-tmp"
+
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+
+    os.symlink(target_name, tmp_link)
+    os.replace(tmp_link, link_path)
+
+
+def _get_path(job: Job, dir_: str) -> str:
+    return f"{job.backup_root}/{dir_}"
+
+
+def _get_snapshot_dir_name(job: Job, created_at: str, name: SnapshotName) -> str:
+    # Stable snapshot dirs keep their name for their whole lifetime.
+    if job.snapshot_rotation == "stable":
+        return f"{created_at}__{name}"
 
-    p = sp.run(cmd, shell=False, stdout=sp.PIPE, stderr=sp.STDOUT, check=False)
+    return f"{created_at}__{name}.0"
 
-    output = p.stdout.decode().strip()
 
-    if output:
-        log.debug("\n    " + output)
+def _rm_snap(job: Job, dir_: Union[SnapshotDir, SnapshotDirTmp]) -> None:
+    """
+    Remove Snapshot directory.
+    The dir is moved to the trash and deleted in the background.
+    """
+    log.debug(log.lvl1_ts_msg(f"Remove deprecated snapshot: {os.path.basename(dir_)}"))
+
+    trash.reclaimer.move_to_trash(job.state_dir, dir_)
+
+
+def _apply(job: Job, index: SnapshotIndex, op: JournalOp) -> None:
+    """
+    Apply a journaled operation to the backup root and the index. Operations
+    that were already applied by an interrupted run are skipped, so that a
+    step can be repeated safely. (If the index missed such an operation, the
+    mtime of the backup root differs and the index was rescanned.)
+    """
+    kind, *args = op
+    path = _get_path(job, args[-1])
+
+    if kind == "rename":
+        src, dst = args
+
+        if os.path.lexists(_get_path(job, src)) and not os.path.lexists(path):
+            os.rename(src=_get_path(job, src), dst=path)
+            index.rename(src, dst)
 
+    elif kind == "link":
+        _link_to(args[0], path)
+        index.set_target(args[1], args[0])
 
-def _split_number_from_path(path: str) -> tuple[str, int]:
+    elif kind == "unlink":
+        if os.path.islink(path):
+            os.unlink(path)
+            index.remove(args[0])
 
-    path_split = path.split(".")
-    number = int(path_split[-1])
-    path_without_num = ".".join(path_split[:-1]) + "."
+    elif kind == "trash":
+        if not os.path.lexists(path):
+            return
 
-    return path_without_num, number
+        try:
+            _rm_snap(job, path)
+
+        except OSError as e:
+            log.debug(e)
+            log.error(f"    Error: Could not delete deprecated snapshot: {args[0]}")
+            return
 
+        index.remove(args[0])
 
-def _get_snapshot_dirs(backup_root: str, snapshot_name: str) -> list[str]:
 
-    return [
-        path
-        for path in glob(f"{backup_root}/*")
-        if re.search(f"__{snapshot_name}\.[0-9]+", path)
+def _apply_ops(job: Job, index: SnapshotIndex, record: StepRecord) -> None:
+
+    with index.transaction():
+        for op in record["ops"]:
+            _apply(job, index, op)
+
+        if record.get("entry"):
+            index.add(SnapshotEntry(**record["entry"]))
+
+    fsync_dir(job.backup_root)
+
+
+def _move_shared_tree(
+    src: SnapshotDir,
+    dst: SnapshotDir,
+    referrers: list[SnapshotEntry],
+) -> list[JournalOp]:
+    """
+    Rename a snapshot tree and let all references point to its new name.
+    """
+    return [["rename", src, dst]] + [
+        ["link", dst, referrer.dir] for referrer in referrers if referrer.dir != dst
     ]
 
 
-def _shift(job: Job, snapshot: Snapshot) -> None:
+def _shift(job: Job, index: SnapshotIndex, name: SnapshotName) -> list[JournalOp]:
     """
     Increase the num in the dir by one for the given snapshot name.
     """
-    log.debug(log.lvl1_ts_msg(f'Shift snapshot "{snapshot.name}" in {job.backup_root}'))
+    log.debug(log.lvl1_ts_msg(f'Shift snapshot "{name}" in {job.backup_root}'))
+
+    ops: list[JournalOp] = []
+
+    numbered = [(e.seq, e) for e in index.get_numbered(name) if e.seq is not None]
+
+    for seq, entry in sorted(numbered, key=lambda item: item[0], reverse=True):
+        new_dir = f"{entry.created_at}__{entry.name}.{seq + 1}"
+        ops += _move_shared_tree(entry.dir, new_dir, index.get_referrers(entry.dir))
+
+    return ops
+
+
+def _get_place_step(
+    job: Job,
+    index: SnapshotIndex,
+    created_at: str,
+    name: SnapshotName,
+    shared_name: str,
+    link_stats: Optional[hardlink.LinkStats],
+) -> StepRecord:
+    """
+    Shift the snapshots of the interval (in the 'shift' rotation mode) and move
+    the new snapshot in place, or in shared mode, link it to the shared tree.
+    """
+    snapshot_dir = _get_snapshot_dir_name(job, created_at, name)
+    ops: list[JournalOp] = []
 
-    snapshot_dirs_to_shift = _get_snapshot_dirs(job.backup_root, snapshot.name)
+    if job.snapshot_rotation != "stable":
+        ops += _shift(job, index, name)
 
-    for path in sorted(snapshot_dirs_to_shift, reverse=True):
+    if shared_name and shared_name != snapshot_dir:
+        ops.append(["link", shared_name, snapshot_dir])
+        target: Optional[str] = shared_name
+    else:
+        ops.append(["rename", f"{name}.tmp", snapshot_dir])
+        target = None
 
-        path_wo_number, number = _split_number_from_path(path)
+    # The stats of a resumed hardlink run are incomplete.
+    files: Optional[int] = None
+    size: Optional[int] = None
 
-        search = f"{path_wo_number}{number}"
-        replacement = f"{path_wo_number}{number+1}"
+    if link_stats is not None and link_stats.size is not None:
+        files, size = link_stats.files, link_stats.size
 
-        new_path: str = re.sub(search, replacement, path)
+    entry = SnapshotEntry(
+        dir=snapshot_dir,
+        name=name,
+        seq=None if job.snapshot_rotation == "stable" else 0,
+        created_at=created_at,
+        target=target,
+        files=files,
+        size=size,
+    )
 
-        os.rename(src=path, dst=new_path)
+    return {"ops": ops, "entry": asdict(entry)}
 
 
-def _get_deprecated_snaps(job: Job, snapshot: Snapshot) -> list[SnapshotDir]:
+def _rm_deprecated_snaps(
+    job: Job,
+    index: SnapshotIndex,
+    name: SnapshotName,
+    keep_amount: SnapshotKeepAmount,
+) -> StepRecord:
     """
-    Get all deprecated snapshot dirs.
+    Delete deprecated snapshot directories.
     Dirs that contain snapshots that are older than what the user wants to keep.
     The keep range is defined in the config yaml file.
     """
-    return [
-        path
-        for path in _get_snapshot_dirs(job.backup_root, snapshot.name)
-        if _split_number_from_path(path)[1] not in range(0, snapshot.keep_amount)
-    ]
+    if job.snapshot_rotation == "stable":
+        deprecated = index.get_expired(name, keep_amount)
+    else:
+        deprecated = index.get_deprecated(name, keep_amount)
+
+    ops: list[JournalOp] = []
 
+    for entry in deprecated:
+        referrers = index.get_referrers(entry.dir)
 
-def _rm_snap(dir_: Union[SnapshotDir, SnapshotDirTmp]) -> None:
+        # A tree that is still referenced by other snapshots is handed over to
+        # one of them instead of being deleted.
+        if referrers and entry.target is None:
+            log.debug(
+                log.lvl1_ts_msg(
+                    f"Hand over shared snapshot: {entry.dir} -> {referrers[0].dir}"
+                )
+            )
+            ops.append(["unlink", referrers[0].dir])
+            ops += _move_shared_tree(entry.dir, referrers[0].dir, referrers[1:])
+        else:
+            ops.append(["trash", entry.dir])
+
+    return {"ops": ops}
+
+
+def _update_aliases(job: Job, index: SnapshotIndex, name: SnapshotName) -> None:
     """
-    Remove Snapshot directory.
-    Uses unix rm instead of shutil.rmtree for better performance.
+    Let the numbered aliases '<name>.0', '<name>.1', ... point to the stable
+    snapshot dirs of an interval, newest first.
     """
-    log.debug(log.lvl1_ts_msg(f"Remove deprecated snapshot: {os.path.basename(dir_)}"))
+    entries = index.get_snapshots(name)
+
+    for num, entry in enumerate(entries):
+        _link_to(entry.dir, f"{job.backup_root}/{name}.{num}")
+
+    num = len(entries)
 
-    sp.check_call(["rm", "-rf", dir_])
+    while os.path.islink(f"{job.backup_root}/{name}.{num}"):
+        os.unlink(f"{job.backup_root}/{name}.{num}")
+        num += 1
 
 
-def _rm_deprecated_snaps(job: Job, snapshot: Snapshot) -> bool:
+def _update_timestamps(app: App, job: Job, timestamps: SnapshotTimestamps) -> None:
+
+    log.debug(log.lvl1_ts_msg(f'Update timestamps for "{", ".join(timestamps)}".'))
+
+    timestamp_store.store.update(app, job.backup_root, timestamps)
+
+
+def _begin_step(
+    journal: Journal,
+    state: JournalState,
+    step: StepKey,
+    get_record: Callable[[], StepRecord],
+) -> Optional[StepRecord]:
     """
-    Delete deprecated snapshot directories.
+    Get the record of a step and write it to the journal. Steps that were
+    recorded by an interrupted run are repeated with the recorded data.
+    Returns None if the step was already completed.
     """
-    deprecated: Union[list[SnapshotDir], list] = _get_deprecated_snaps(job, snapshot)
+    if step in state.done:
+        return None
 
-    for snap_dir in deprecated:
-        try:
-            _rm_snap(str(snap_dir))
+    if step in state.recorded:
+        return state.recorded[step]
 
-        except sp.CalledProcessError as e:
-            log.debug(e)
-            log.error(f"    Error: Could not delete deprecated snapshot: {snap_dir}")
-            return False
+    record = get_record()
+    journal.record(step, record)
 
-    return True
+    return record
+
+
+def _run(
+    app: App,
+    job: Job,
+    index: SnapshotIndex,
+    journal: Journal,
+    state: JournalState,
+    resume: bool = False,
+) -> None:
+    created_at: str = state.plan["created_at"]
+    keep_amounts: dict[SnapshotName, SnapshotKeepAmount] = state.plan["snapshots"]
+    names = list(keep_amounts)
+    link_stats: Optional[hardlink.LinkStats] = None
+
+    # In shared mode only the first snapshot gets a tree of its own, all other
+    # snapshots become references to it.
+    if job.share_snapshots:
+        owners = names[:1]
+        shared_name = _get_snapshot_dir_name(job, created_at, names[0])
+    else:
+        owners = names
+        shared_name = ""
+
+    with stats.phase(job.stats, "hardlink"):
+        record = _begin_step(
+            journal,
+            state,
+            "hardlink",
+            lambda: {"dsts": [f"{name}.tmp" for name in owners]},
+        )
+
+        if record:
+            link_stats = _create_hardlinks(
+                job, [_get_path(job, dst) for dst in record["dsts"]], resume
+            )
+            journal.done("hardlink")
+
+    for name in names:
+
+        with log.context(snapshot=name), stats.phase(job.stats, "shift"):
+            record = _begin_step(
+                journal,
+                state,
+                f"place:{name}",
+                lambda: _get_place_step(
+                    job, index, created_at, name, shared_name, link_stats
+                ),
+            )
+
+            if record:
+                _apply_ops(job, index, record)
+                journal.done(f"place:{name}")
+
+    # Timestamps are updated and old snapshots are removed after all new
+    # snapshots are in place, so that shared trees can be handed over. The
+    # timestamps of all snapshots are written at once.
+    with stats.phase(job.stats, "timestamp"):
+        record = _begin_step(
+            journal,
+            state,
+            "timestamps",
+            lambda: {"values": {name: int(time.time()) for name in names}},
+        )
+
+        if record:
+            _update_timestamps(app, job, record["values"])
+            journal.done("timestamps")
 
+    for name in names:
 
-def _update_timestamp(app: App, job: Job, snapshot: Snapshot) -> None:
+        with log.context(snapshot=name):
 
-    log.debug(log.lvl1_ts_msg(f'Update timestamp for "{snapshot.name}".'))
+            with stats.phase(job.stats, "prune"):
+                record = _begin_step(
+                    journal,
+                    state,
+                    f"prune:{name}",
+                    lambda: _rm_deprecated_snaps(job, index, name, keep_amounts[name]),
+                )
 
-    timestamp_file: str = lib.clean_path(f"{job.backup_root}/{app.timestamp_file_name}")
-    timestamps: dict[SnapshotName, str] = lib.load_yaml(timestamp_file) or {}
+                if record:
+                    _apply_ops(job, index, record)
+                    journal.done(f"prune:{name}")
 
-    timestamps[snapshot.name] = time.strftime(app.timestamp_format)
+            if job.snapshot_rotation == "stable" and job.snapshot_aliases:
+                with index.transaction():
+                    _update_aliases(job, index, name)
 
-    lib.save_yaml(timestamps, timestamp_file)
+            log.info(log.lvl1_ts_msg(f"Completed Snapshot: {name}"))
 
+    journal.commit()
 
-def run(app: App, job: Job, snapshot: Snapshot):
+
+def run(app: App, job: Job, snapshots: list[Snapshot]):
     """
-    Create a new snapshot from 'backup.latest'.
+    Create a new snapshot from 'backup.latest' for each given snapshot.
+    Each step is recorded in a journal, so that an interrupted run can be
+    rolled forward by recover().
     """
     timestamp = datetime.fromtimestamp(time.time())
 
@@ -211,27 +493,66 @@ def run(app: App, job: Job, snapshot: Snapshot):
 
     log.debug(
         log.lvl1_ts_msg(
-            f'Start snapshot sequence: "{snapshot.name}" for: {job.backup_src}'
+            f"Start snapshot sequence: "
+            f'"{", ".join(s.name for s in snapshots)}" for: {job.backup_src}'
         )
     )
 
-    # Remove leftovers.
-    if os.path.exists(snapshot.dst_tmp):
-        _rm_snap(snapshot.dst_tmp)
+    plan = {
+        "created_at": timestamp.strftime("%Y-%m-%d__%H:%M:%S"),
+        "snapshots": {snapshot.name: snapshot.keep_amount for snapshot in snapshots},
+        "share_snapshots": job.share_snapshots,
+        "snapshot_rotation": job.snapshot_rotation,
+    }
+
+    journal = Journal(job.state_dir)
+
+    with SnapshotIndex(job.backup_root, job.state_dir) as index:
 
-    _create_hardlinks(job, snapshot)
+        # Remove leftovers. Changes of the backup root are made inside a
+        # transaction, so that the index keeps its mtime.
+        with index.transaction():
+            for snapshot in snapshots:
+                if os.path.exists(snapshot.dst_tmp):
+                    _rm_snap(job, snapshot.dst_tmp)
 
-    _shift(job, snapshot)
+        journal.begin(plan)
+        _run(app, job, index, journal, JournalState(plan=plan))
 
-    os.rename(
-        src=snapshot.dst_tmp,
-        dst=f'{job.backup_root}/{timestamp.strftime("%Y-%m-%d__%H:%M:%S")}__'
-        f"{snapshot.name}.0",
+    log.debug("")
+
+
+def recover(app: App, job: Job) -> bool:
+    """
+    Roll an interrupted snapshot run of a job forward. Partial hardlink trees
+    are completed instead of being rebuilt. Returns True if there was an
+    interrupted run.
+    """
+    journal = Journal(job.state_dir)
+    state = journal.load()
+
+    if state is None:
+        # The run was interrupted before its plan was written.
+        if journal.exists():
+            journal.commit()
+        return False
+
+    log.info(
+        log.lvl0_ts_msg(
+            f"[Snapshot] Resume interrupted snapshot run in: {job.backup_root}"
+        )
+    )
+
+    # Finish the run with the settings it was started with.
+    job = replace(
+        job,
+        share_snapshots=state.plan["share_snapshots"],
+        snapshot_rotation=state.plan["snapshot_rotation"],
     )
 
-    _update_timestamp(app, job, snapshot)
+    journal.reopen()
 
-    _rm_deprecated_snaps(job, snapshot)
+    with SnapshotIndex(job.backup_root, job.state_dir) as index:
+        _run(app, job, index, journal, state, resume=True)
 
-    log.info(log.lvl1_ts_msg(f"Completed Snapshot: {snapshot.name}"))
-    log.debug("")
+    return True
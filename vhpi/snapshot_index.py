@@ -0,0 +1,265 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from typing import Optional
+
+from .logging import log
+from .types import BackupRoot, SnapshotEntry, SnapshotName, StateDir
+
+# The basename of a snapshot dir, e.g. '2020-01-02__10:00:00__daily.0', or
+# '2020-01-02__10:00:00__daily' in the 'stable' rotation mode.
+_SNAPSHOT_DIR_PATTERN = re.compile(
+    r"^(?P<created_at>[0-9]{4}-[0-9]{2}-[0-9]{2}__[0-9]{2}:[0-9]{2}:[0-9]{2})"
+    r"__(?P<name>.+?)(\.(?P<seq>[0-9]+))?$"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    dir TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    seq INTEGER,
+    created_at TEXT NOT NULL,
+    target TEXT,
+    files INTEGER,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS snapshots_by_name ON snapshots (name, seq);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+_COLUMNS = "dir, name, seq, created_at, target, files, size"
+
+
+def parse_snapshot_dir(
+    dir_: str,
+) -> Optional[tuple[str, SnapshotName, Optional[int]]]:
+    """
+    Get (created_at, name, seq) from the basename of a snapshot dir. The seq
+    is None for snapshots with a stable name.
+    """
+    match = _SNAPSHOT_DIR_PATTERN.match(dir_)
+
+    if not match:
+        return None
+
+    seq = match.group("seq")
+
+    return (
+        match.group("created_at"),
+        match.group("name"),
+        int(seq) if seq is not None else None,
+    )
+
+
+class SnapshotIndex:
+    """
+    A persistent index of the snapshots in a backup root, stored in its state
+    dir. The index remembers the mtime of the backup root, which changes with
+    every dir that is added, renamed or removed. If it does not match, the
+    index is rebuilt from the dir listing.
+
+    Changes are made inside transaction(), after the corresponding change of
+    the filesystem. If vhpi stops in between, the mtimes differ and the next
+    open() rescans the backup root.
+    """
+
+    def __init__(self, backup_root: BackupRoot, state_dir: StateDir):
+        self.backup_root = backup_root
+        self.state_dir = state_dir
+        self._db: Optional[sqlite3.Connection] = None
+
+    def open(self) -> "SnapshotIndex":
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        self._db = sqlite3.connect(f"{self.state_dir}/index.sqlite")
+        self._db.executescript(_SCHEMA)
+
+        if self._get_stored_mtime() != self._get_root_mtime():
+            self.rescan()
+
+        return self
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            raise RuntimeError(f"Snapshot index is not open: {self.backup_root}")
+
+        return self._db
+
+    def close(self) -> None:
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def __enter__(self) -> "SnapshotIndex":
+        return self.open()
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _get_root_mtime(self) -> int:
+        return os.stat(self.backup_root).st_mtime_ns
+
+    def _get_stored_mtime(self) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'root_mtime'"
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def _store_mtime(self) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('root_mtime', ?)",
+            (self._get_root_mtime(),),
+        )
+
+    def rescan(self) -> None:
+        """
+        Rebuild the index from the dir listing of the backup root. File counts
+        and sizes of known snapshots are kept.
+        """
+        log.debug(log.lvl1_ts_msg(f"Rescan snapshot index of: {self.backup_root}"))
+
+        known = {entry.dir: entry for entry in self.get_all()}
+
+        with self._conn:
+            self._conn.execute("DELETE FROM snapshots")
+
+            for dir_ in os.listdir(self.backup_root):
+                parsed = parse_snapshot_dir(dir_)
+
+                if not parsed:
+                    continue
+
+                path = f"{self.backup_root}/{dir_}"
+                target = os.readlink(path) if os.path.islink(path) else None
+                old = known.get(dir_)
+
+                self._insert(
+                    SnapshotEntry(
+                        dir=dir_,
+                        name=parsed[1],
+                        seq=parsed[2],
+                        created_at=parsed[0],
+                        target=target,
+                        files=old.files if old else None,
+                        size=old.size if old else None,
+                    )
+                )
+
+            self._store_mtime()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commit all changes of the wrapped code together with the current
+        mtime of the backup root.
+        """
+        with self._conn:
+            yield self
+            self._store_mtime()
+
+    def _insert(self, entry: SnapshotEntry) -> None:
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO snapshots ({_COLUMNS}) VALUES (?,?,?,?,?,?,?)",
+            (
+                entry.dir,
+                entry.name,
+                entry.seq,
+                entry.created_at,
+                entry.target,
+                entry.files,
+                entry.size,
+            ),
+        )
+
+    def add(self, entry: SnapshotEntry) -> None:
+        self._insert(entry)
+
+    def rename(self, old_dir: str, new_dir: str) -> None:
+        parsed = parse_snapshot_dir(new_dir)
+
+        if not parsed:
+            raise ValueError(f"Not a snapshot dir: {new_dir}")
+
+        created_at, name, seq = parsed
+
+        self._conn.execute(
+            "UPDATE snapshots SET dir = ?, name = ?, seq = ?, created_at = ? "
+            "WHERE dir = ?",
+            (new_dir, name, seq, created_at, old_dir),
+        )
+        self._conn.execute(
+            "UPDATE snapshots SET target = ? WHERE target = ?", (new_dir, old_dir)
+        )
+
+    def set_target(self, dir_: str, target: str) -> None:
+        self._conn.execute(
+            "UPDATE snapshots SET target = ? WHERE dir = ?", (target, dir_)
+        )
+
+    def remove(self, dir_: str) -> None:
+        self._conn.execute("DELETE FROM snapshots WHERE dir = ?", (dir_,))
+
+    def _query(self, where: str = "1", params: tuple = ()) -> list[SnapshotEntry]:
+        rows = self._conn.execute(
+            f"SELECT {_COLUMNS} FROM snapshots WHERE {where} "
+            "ORDER BY name, created_at DESC, seq",
+            params,
+        )
+
+        return [SnapshotEntry(*row) for row in rows]
+
+    def get_all(self) -> list[SnapshotEntry]:
+        return self._query()
+
+    def get_snapshots(self, name: SnapshotName) -> list[SnapshotEntry]:
+        """
+        Get all snapshots of an interval, newest first.
+        """
+        return self._query("name = ?", (name,))
+
+    def get_numbered(self, name: SnapshotName) -> list[SnapshotEntry]:
+        return self._query("name = ? AND seq IS NOT NULL", (name,))
+
+    def get_deprecated(
+        self, name: SnapshotName, keep_amount: int
+    ) -> list[SnapshotEntry]:
+        """
+        Get the numbered snapshots of an interval, which are beyond the keep
+        amount.
+        """
+        return self._query("name = ? AND seq >= ?", (name, keep_amount))
+
+    def get_expired(self, name: SnapshotName, keep_amount: int) -> list[SnapshotEntry]:
+        """
+        Get all snapshots of an interval, except for the newest 'keep_amount'.
+        """
+        return self.get_snapshots(name)[keep_amount:]
+
+    def get_referrers(self, dir_: str) -> list[SnapshotEntry]:
+        """
+        Get the snapshots that are shared references to the given snapshot.
+        """
+        return self._query("target = ?", (dir_,))
@@ -0,0 +1,176 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess as sp
+import threading
+from typing import Optional
+
+from . import process
+from .logging import log
+from .types import Job, RsyncOptions
+
+# The login part of a remote source, e.g. 'user@192.168.178.20'
+SSHHost = str
+
+# Seconds to wait for a master connection to be established.
+_CONNECT_TIMEOUT = 30
+
+
+def get_ssh_host(job: Job) -> Optional[SSHHost]:
+    """
+    Get the ssh host of a remote source, e.g. 'user@host:/home/user'.
+    Local sources and rsync daemon sources ('host::module') have none.
+    """
+    if ":" not in job.backup_src or "::" in job.backup_src:
+        return None
+
+    return job.backup_src.split(":")[0]
+
+
+def _has_custom_rsh(rsync_options: RsyncOptions) -> bool:
+    return any(
+        option in ("-e", "--rsh") or option.startswith("--rsh=")
+        for option in rsync_options
+    )
+
+
+class SSHPool:
+    """
+    Keep one multiplexed ssh master connection per remote host, which is
+    shared by all rsync processes that sync from this host. Masters exit by
+    themselves after 'persist' seconds without use and are started again on
+    demand.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.control_dir = ""
+        self.persist = 600
+        self._locks: dict[SSHHost, threading.Lock] = {}
+        self._hosts: set[SSHHost] = set()
+        self._lock = threading.Lock()
+
+    def configure(self, control_dir: str, enabled: bool, persist: int) -> None:
+        self.control_dir = control_dir
+        self.enabled = enabled
+        self.persist = persist
+
+        if enabled:
+            os.makedirs(control_dir, mode=0o700, exist_ok=True)
+
+    def _get_control_path(self) -> str:
+        # ssh replaces '%C' with a hash of host, port and user.
+        return f"{self.control_dir}/%C"
+
+    def _get_host_lock(self, host: SSHHost) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(host, threading.Lock())
+
+    def _control(self, host: SSHHost, command: str) -> bool:
+        """
+        Send a control command ('check', 'exit') to the master of a host.
+        """
+        try:
+            p = process.run(
+                [
+                    "ssh",
+                    "-o",
+                    f"ControlPath={self._get_control_path()}",
+                    "-O",
+                    command,
+                    host,
+                ],
+                stdout=sp.DEVNULL,
+                stderr=sp.DEVNULL,
+                check=False,
+            )
+        except OSError:
+            return False
+
+        return p.returncode == 0
+
+    def _start_master(self, job: Job, host: SSHHost) -> bool:
+        cmd = [
+            "ssh",
+            "-M",
+            "-N",
+            "-f",
+            "-o",
+            "ControlMaster=yes",
+            "-o",
+            f"ControlPath={self._get_control_path()}",
+            "-o",
+            f"ControlPersist={self.persist}",
+            "-o",
+            "ServerAliveInterval=10",
+            host,
+        ]
+
+        log.debug(log.lvl1_ts_msg(f"Start ssh master connection to: {host}"))
+
+        try:
+            process.run(
+                cmd,
+                job.login_token,
+                stdin=sp.DEVNULL,
+                stdout=sp.DEVNULL,
+                stderr=sp.DEVNULL,
+                timeout=_CONNECT_TIMEOUT,
+                check=False,
+            )
+        except (sp.TimeoutExpired, OSError):
+            return False
+
+        self._hosts.add(host)
+
+        return self._control(host, "check")
+
+    def ensure(self, job: Job) -> bool:
+        """
+        Make sure a master connection to the source host of a job is up.
+        Returns False if the job does not use a shared connection.
+        """
+        host = get_ssh_host(job)
+
+        if not self.enabled or not host or _has_custom_rsh(job.rsync_options):
+            return False
+
+        with self._get_host_lock(host):
+            return self._control(host, "check") or self._start_master(job, host)
+
+    def get_rsh_option(self, job: Job) -> list[str]:
+        """
+        Get the rsync option that lets ssh use the master connection of the
+        source host. If the master is gone, ssh connects on its own.
+        """
+        if not self.ensure(job):
+            return []
+
+        ssh = process.which("ssh") or "ssh"
+        rsh = f"{ssh} -o ControlPath={self._get_control_path()} -o ControlMaster=no"
+
+        return ["-e", rsh]
+
+    def close_all(self) -> None:
+        for host in list(self._hosts):
+            self._control(host, "exit")
+
+        self._hosts.clear()
+
+
+pool = SSHPool()
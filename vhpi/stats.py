@@ -0,0 +1,168 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, fields
+
+from .logging import log
+from .types import Job, JobStats, RsyncOptions, RsyncStats
+
+# The amount of runs that are kept in the history of a job.
+_HISTORY_SIZE = 500
+
+# Map the labels of 'rsync --stats' to the fields of RsyncStats.
+_STATS_FIELDS = {
+    "Number of files": "files",
+    "Number of created files": "files_created",
+    "Number of deleted files": "files_deleted",
+    "Number of regular files transferred": "files_transferred",
+    "Total file size": "total_size",
+    "Total transferred file size": "transferred_size",
+    "Literal data": "literal_data",
+    "Matched data": "matched_data",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+
+_STATS_PATTERN = re.compile(
+    r"^\s*(?P<label>" + "|".join(_STATS_FIELDS) + r"): (?P<value>[0-9,.]+)"
+)
+
+_SPEEDUP_PATTERN = re.compile(r"speedup is (?P<value>[0-9,.]+)")
+
+
+def _parse_int(value: str) -> int:
+    return int(re.sub(r"[,.]", "", value))
+
+
+class RsyncStatsParser:
+    """
+    Collect the '--stats' output of an rsync process line by line.
+    """
+
+    def __init__(self):
+        self.stats = RsyncStats()
+
+    def feed(self, line: str) -> None:
+        match = _STATS_PATTERN.match(line)
+
+        if match:
+            setattr(
+                self.stats,
+                _STATS_FIELDS[match.group("label")],
+                _parse_int(match.group("value")),
+            )
+            return
+
+        match = _SPEEDUP_PATTERN.search(line)
+
+        if match:
+            self.stats.speedup = float(match.group("value").replace(",", ""))
+
+
+def with_stats_option(rsync_options: RsyncOptions) -> RsyncOptions:
+    if "--stats" in rsync_options:
+        return rsync_options
+
+    return (*rsync_options, "--stats")
+
+
+def merge(stats_list: list[RsyncStats]) -> RsyncStats:
+    """
+    Sum up the stats of several rsync processes, e.g. of a sharded run.
+    """
+    merged = RsyncStats()
+
+    for stats in stats_list:
+        for field_ in fields(RsyncStats):
+            if field_.name not in ("speedup", "duration"):
+                setattr(
+                    merged,
+                    field_.name,
+                    getattr(merged, field_.name) + getattr(stats, field_.name),
+                )
+
+        merged.duration = max(merged.duration, stats.duration)
+
+    traffic = merged.bytes_sent + merged.bytes_received
+
+    if traffic:
+        merged.speedup = round(merged.total_size / traffic, 2)
+
+    return merged
+
+
+@contextmanager
+def phase(job_stats: JobStats, name: str):
+    """
+    Add the duration of the wrapped code to a phase of the job stats. Records
+    that are logged inside the phase get its name as context.
+    """
+    start = time.monotonic()
+
+    try:
+        with log.context(phase=name):
+            yield
+
+    finally:
+        duration = time.monotonic() - start
+        job_stats.phases[name] = round(job_stats.phases.get(name, 0) + duration, 3)
+        log.event("Phase finished", phase=name, duration=round(duration, 3))
+
+
+def get_history_file(job: Job) -> str:
+    return f"{job.state_dir}/history.jsonl"
+
+
+def append_history(job: Job) -> None:
+    """
+    Append the stats of a job run as one JSON line to the history of the job.
+    Only the last '_HISTORY_SIZE' runs are kept. The file is replaced
+    atomically.
+    """
+    os.makedirs(job.state_dir, exist_ok=True)
+    history_file = get_history_file(job)
+
+    record = asdict(job.stats)
+    record["job"] = job.name
+
+    try:
+        with open(history_file, "r") as f:
+            lines = [line for line in f if line.strip()]
+    except FileNotFoundError:
+        lines = []
+
+    lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+
+    with open(f"{history_file}.tmp", "w") as f:
+        f.writelines(lines[-_HISTORY_SIZE:])
+
+    os.replace(f"{history_file}.tmp", history_file)
+
+
+def load_history(job: Job) -> list[dict]:
+    history_file = get_history_file(job)
+
+    if not os.path.isfile(history_file):
+        return []
+
+    with open(history_file, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,131 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from . import lib
+from .journal import fsync_dir
+from .logging import log
+from .types import App, BackupRoot, SnapshotTimestamps
+
+
+def get_timestamps_file(app: App, backup_root: BackupRoot) -> str:
+    return f"{backup_root}/{app.state_dir_name}/timestamps"
+
+
+def _read_legacy_file(app: App, backup_root: BackupRoot) -> SnapshotTimestamps:
+    """
+    Convert the YAML timestamps file of older versions, e.g.:
+    'daily: "2020-01-02 10:00:00"'
+    """
+    legacy_file = lib.clean_path(f"{backup_root}/{app.timestamp_file_name}")
+
+    if not os.path.isfile(legacy_file):
+        return {}
+
+    timestamps: SnapshotTimestamps = {}
+
+    for name, value in (lib.load_yaml(legacy_file) or {}).items():
+        try:
+            timestamp = datetime.strptime(value, app.timestamp_format)
+            timestamps[name] = int(time.mktime(timestamp.timetuple()))
+        except (TypeError, ValueError):
+            continue
+
+    return timestamps
+
+
+def _write_file(file: str, timestamps: SnapshotTimestamps) -> None:
+    """
+    Replace the timestamps file atomically, so that it is either the old or
+    the new version after a crash.
+    """
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+
+    with open(f"{file}.tmp", "w") as f:
+        json.dump(timestamps, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(f"{file}.tmp", file)
+    fsync_dir(os.path.dirname(file))
+
+
+class TimestampStore:
+    """
+    Keep the completion times of the last snapshots of each backup root in
+    memory, as unix times. The file of a backup root is only read again if
+    its mtime changed, and each update replaces the file atomically.
+    """
+
+    def __init__(self):
+        self._cache: dict[str, tuple[int, SnapshotTimestamps]] = {}
+        self._lock = threading.RLock()
+
+    def load(self, app: App, backup_root: BackupRoot) -> SnapshotTimestamps:
+        file = get_timestamps_file(app, backup_root)
+
+        with self._lock:
+            try:
+                mtime: Optional[int] = os.stat(file).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+
+            if mtime is None:
+                return _read_legacy_file(app, backup_root)
+
+            cached = self._cache.get(file)
+
+            if not cached or cached[0] != mtime:
+                with open(file, "r") as f:
+                    cached = (mtime, json.load(f))
+
+                self._cache[file] = cached
+
+            return dict(cached[1])
+
+    def update(
+        self,
+        app: App,
+        backup_root: BackupRoot,
+        updates: SnapshotTimestamps,
+    ) -> None:
+        """
+        Write the new timestamps of several snapshots at once.
+        """
+        file = get_timestamps_file(app, backup_root)
+
+        with self._lock:
+            timestamps = self.load(app, backup_root)
+            timestamps.update(updates)
+
+            _write_file(file, timestamps)
+            self._cache[file] = (os.stat(file).st_mtime_ns, timestamps)
+
+        legacy_file = lib.clean_path(f"{backup_root}/{app.timestamp_file_name}")
+
+        if os.path.isfile(legacy_file):
+            log.debug(log.lvl1_ts_msg(f"Migrated timestamps file: {legacy_file}"))
+            os.unlink(legacy_file)
+
+
+store = TimestampStore()
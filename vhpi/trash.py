@@ -0,0 +1,155 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import queue
+import subprocess as sp
+import threading
+import time
+from typing import Optional
+
+from . import process, resources
+from .logging import log
+from .types import StateDir
+
+# A dir inside the trash dir of a StateDir, which waits for deletion.
+TrashItem = str
+
+# The max amount of trash items that are deleted with a single 'rm' call.
+_BATCH_SIZE = 16
+
+
+def get_trash_dir(state_dir: StateDir) -> str:
+    return f"{state_dir}/trash"
+
+
+def _get_rm_command(paths: list[TrashItem], ionice: list[str]) -> list[str]:
+    """
+    Delete with the io class of the 'delete' phase (idle by default) and the
+    lowest cpu priority, if the tools exist.
+    """
+    cmd = ["rm", "-rf", "--"] + paths
+
+    if process.which("nice"):
+        cmd = ["nice", "-n", "19"] + cmd
+
+    return ionice + cmd
+
+
+def _group_by_device(paths: list[TrashItem]) -> list[list[TrashItem]]:
+    groups: dict[int, list[TrashItem]] = {}
+
+    for path in paths:
+        groups.setdefault(resources.get_device(path), []).append(path)
+
+    return list(groups.values())
+
+
+class Reclaimer:
+    """
+    Delete trashed snapshots in a background thread, in small batches.
+    Snapshots are moved into the trash dir of their backup root with a single
+    rename, so the backup cycle does not have to wait for the deletion. Items
+    that were left in the trash are picked up again after a restart.
+    """
+
+    def __init__(self):
+        self.pause: float = 1
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work,
+                    name="vhpi-reclaimer",
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def _get_batch(self) -> list[TrashItem]:
+        """
+        Wait for the next item and add whatever else is queued up right now.
+        """
+        batch = [self._queue.get()]
+
+        while len(batch) < _BATCH_SIZE and not self._queue.empty():
+            batch.append(self._queue.get())
+
+        return [path for path in dict.fromkeys(batch) if os.path.lexists(path)]
+
+    def _work(self) -> None:
+        while True:
+            batch = self._get_batch()
+
+            if not batch:
+                continue
+
+            for path in batch:
+                log.debug(log.lvl0_ts_msg(f"[Trash] Delete: {path}"))
+
+            # Deletions take an io slot of their disk like any other phase.
+            for paths in _group_by_device(batch):
+                with resources.limiter.acquire("delete", paths[0]) as slot:
+                    try:
+                        process.run(_get_rm_command(paths, slot.ionice), check=True)
+                    except (sp.CalledProcessError, OSError) as e:
+                        log.debug(e)
+                        log.error(
+                            f"[Error] Could not delete trashed snapshots: {paths}"
+                        )
+
+            # Give the disk a break between two batches.
+            time.sleep(self.pause)
+
+    def enqueue(self, path: TrashItem) -> None:
+        self._ensure_worker()
+        self._queue.put(path)
+
+    def move_to_trash(self, state_dir: StateDir, path: str) -> TrashItem:
+        """
+        Atomically move a dir into the trash and schedule its deletion.
+        """
+        trash_dir = get_trash_dir(state_dir)
+        os.makedirs(trash_dir, exist_ok=True)
+
+        item = f"{trash_dir}/{os.path.basename(path)}"
+
+        if os.path.lexists(item):
+            item = f"{item}.{time.time_ns()}"
+
+        os.rename(path, item)
+        self.enqueue(item)
+
+        return item
+
+    def recover(self, state_dir: StateDir) -> None:
+        """
+        Schedule the deletion of items that are left in the trash.
+        """
+        trash_dir = get_trash_dir(state_dir)
+
+        if not os.path.isdir(trash_dir):
+            return
+
+        for name in sorted(os.listdir(trash_dir)):
+            self.enqueue(f"{trash_dir}/{name}")
+
+
+reclaimer = Reclaimer()
@@ -14,8 +14,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
-from dataclasses import dataclass
-from typing import Any
+from dataclasses import dataclass, field
+from typing import Any, Optional
 
 # The source path that is backup-ed.
 BackupSrc = str
@@ -27,6 +27,10 @@ BackupRoot = str
 # It's located in BackupRoot.
 BackupLatest = str
 
+# The dir that holds the state files of vhpi for a BackupRoot, e.g. the file
+# index of the incremental mode. It's located in BackupRoot.
+StateDir = str
+
 # A snapshot dir, e.g hourly.0, daily.2, etc.
 # Each SnapDir is located in BackupRoot.
 SnapshotDir = str
@@ -46,8 +50,12 @@ SnapshotIntervals = dict[SnapshotName, SnapshotInterval]
 SnapshotKeepAmount = int
 SnapshotKeepAmounts = dict[SnapshotName, SnapshotKeepAmount]
 
-# The interval timestamp e.g. "2020-01-02 00:00:00"
-SnapshotTimestamp = str
+# The options of rsync as separate arguments, e.g. ('-aAHSvX', '--delete').
+RsyncOptions = tuple[str, ...]
+
+# The unix time at which the last snapshot of an interval was completed, e.g.
+# 1577959200 (0 if there is none).
+SnapshotTimestamp = int
 SnapshotTimestamps = dict[SnapshotName, SnapshotTimestamp]
 
 
@@ -60,25 +68,111 @@ class App:
     cfg_file: str
     log_dir: str
     timestamp_file_name: str
+    state_dir_name: str
     timestamp_format: str
 
 
+@dataclass(frozen=True)
+class JobPlan:
+    """
+    The validated settings of a job, computed once per config load. Plans are
+    never modified, a changed config file results in new plans.
+    """
+
+    name: str
+    login_token: Optional[bytes]
+    source_ip: str
+    backup_src: BackupSrc
+    backup_root: BackupRoot
+    rsync_options: RsyncOptions
+    # The items of 'excludes' and of all 'exclude_lists', without duplicates.
+    excludes: tuple[str, ...]
+    # The rsync filter file with the excludes, None if there are none.
+    exclude_file: Optional[str]
+    incremental: bool
+    full_sync_every: int
+    rsync_shards: int
+    hardlink_engine: str
+    share_snapshots: bool
+    snapshot_rotation: str
+    snapshot_aliases: bool
+    snapshots: SnapshotKeepAmounts
+
+
+@dataclass(frozen=True)
+class Config:
+    app_cfg: dict[str, Any]
+    intervals: SnapshotIntervals
+    # The plans of all valid jobs, in the order of the config file.
+    jobs: tuple[JobPlan, ...]
+
+
+@dataclass
+class RsyncStats:
+    files: int = 0
+    files_created: int = 0
+    files_deleted: int = 0
+    files_transferred: int = 0
+    total_size: int = 0
+    transferred_size: int = 0
+    literal_data: int = 0
+    matched_data: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    speedup: float = 0
+    duration: float = 0
+
+
+@dataclass
+class JobStats:
+    # Identifies the run in the history and the log, see Log.context().
+    run_id: str = ""
+    started_at: float = 0
+    # 'completed' or 'failed'
+    result: str = ""
+    snapshots: list[SnapshotName] = field(default_factory=list)
+    rsync: Optional[RsyncStats] = None
+    # The duration of each phase in seconds, e.g. {'rsync': 12.3, 'prune': 1.2}
+    phases: dict[str, float] = field(default_factory=dict)
+
+
 @dataclass
 class Job:
     name: str
-    login_token: bytes
+    login_token: Optional[bytes]
     source_ip: str
     backup_src: BackupSrc
     backup_root: BackupRoot
     backup_latest: BackupLatest
-    rsync_options: str
-    exclude_lib: dict[str, list[str]]
-    exclude_lists: list[str]
-    excludes: list[str]
+    state_dir: StateDir
+    rsync_options: RsyncOptions
+    incremental: bool
+    full_sync_every: int
+    rsync_shards: int
+    hardlink_engine: str
+    share_snapshots: bool
+    snapshot_rotation: str
+    snapshot_aliases: bool
+    excludes: tuple[str, ...]
+    exclude_file: Optional[str]
     init_time: float
     snapshot_timestamps: SnapshotTimestamps
     snapshot_intervals: SnapshotIntervals
-    jobs_raw: dict[str, Any]
+    stats: JobStats = field(default_factory=JobStats)
+
+
+@dataclass
+class SnapshotEntry:
+    # The basename of the snapshot dir, e.g. '2020-01-02__10:00:00__daily.0'
+    dir: str
+    name: SnapshotName
+    # The number of a shifted snapshot, None for stable names.
+    seq: Optional[int]
+    created_at: str
+    # The snapshot dir that a shared reference points to.
+    target: Optional[str] = None
+    files: Optional[int] = None
+    size: Optional[int] = None
 
 
 @dataclass
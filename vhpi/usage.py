@@ -0,0 +1,299 @@
+# Copyright (C) 2016-2017 Felix Meyer-Wolters
+#
+# This file is part of 'Very Hungry Pi' (vhpi) - An application to create
+# backups.
+#
+# 'Very Hungry Pi' is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License v3 as published by
+# the Free Software Foundation.
+#
+# 'Very Hungry Pi' is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with 'Very Hungry Pi'.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import stat
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Iterable
+
+from .logging import log
+from .snapshot_index import SnapshotIndex
+from .types import BackupRoot, StateDir
+
+Inode = int
+
+# (st_ino, st_mtime_ns) of the top dir of a snapshot. Snapshots are never
+# changed after they were created, so this identifies them across renames.
+TreeKey = tuple[int, int]
+
+# The tree that rsync writes to. It changes with every run and is always
+# scanned again.
+_LATEST = "backup.latest"
+
+
+@dataclass
+class _TreeScan:
+    key: TreeKey
+    files: int = 0
+    exclusive: int = 0
+    shared: int = 0
+    # The bytes of the tree, with the size of each file split evenly between
+    # its links. The sum over all trees is the size of the backup root.
+    weighted: int = 0
+
+
+@dataclass
+class TreeUsage:
+    # 'backup.latest' or the dir of a snapshot.
+    dir: str
+    files: int = 0
+    # The bytes that would be freed by deleting the tree.
+    exclusive: int = 0
+    # The bytes of files that are also linked outside of the tree.
+    shared: int = 0
+
+
+@dataclass
+class RootUsage:
+    trees: list[TreeUsage] = field(default_factory=list)
+    # The bytes of all trees, each inode counted once.
+    total: int = 0
+    # The amount of trees that were not in the cache.
+    scanned: int = 0
+    duration: float = 0
+
+
+def _get_cache_file(state_dir: StateDir) -> str:
+    return f"{state_dir}/usage_cache.json"
+
+
+def _read_cache(state_dir: StateDir) -> tuple[list[TreeKey], list[_TreeScan]]:
+    try:
+        with open(_get_cache_file(state_dir)) as f:
+            data = json.load(f)
+
+        generation = [(ino, mtime_ns) for ino, mtime_ns in data["generation"]]
+        scans = []
+
+        for scan in data["trees"]:
+            ino, mtime_ns = scan.pop("key")
+            scans.append(_TreeScan(key=(ino, mtime_ns), **scan))
+
+        return generation, scans
+
+    except (OSError, ValueError, KeyError, TypeError):
+        return [], []
+
+
+def _load_cache(
+    state_dir: StateDir, generation: list[TreeKey]
+) -> dict[TreeKey, _TreeScan]:
+    """
+    Load the cached scans of the snapshots. The cache is only valid for the
+    set of snapshots ('generation') it was written for, because adding or
+    removing a tree changes which files of the others are shared.
+    """
+    cached_generation, scans = _read_cache(state_dir)
+
+    if cached_generation != generation:
+        return {}
+
+    return {scan.key: scan for scan in scans}
+
+
+def _save_cache(
+    state_dir: StateDir, generation: list[TreeKey], scans: Iterable[_TreeScan]
+) -> None:
+    os.makedirs(state_dir, exist_ok=True)
+    cache_file = _get_cache_file(state_dir)
+    data = {"generation": generation, "trees": [asdict(scan) for scan in scans]}
+
+    with open(f"{cache_file}.tmp", "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+
+    os.replace(f"{cache_file}.tmp", cache_file)
+
+
+def _get_key(path: str) -> TreeKey:
+    st = os.stat(path)
+
+    return st.st_ino, st.st_mtime_ns
+
+
+def _scan_tree(path: str) -> _TreeScan:
+    """
+    Walk a tree once and sum up the allocated blocks of its entries. A file
+    with several links is exclusive, if all of its links were found in the
+    tree. Only the files whose links were not all found yet are kept in
+    memory during the walk. Other filesystems are not entered.
+    """
+    top = os.stat(path)
+    size = top.st_blocks * 512
+    scan = _TreeScan(key=(top.st_ino, top.st_mtime_ns), exclusive=size)
+    weighted = float(size)
+    # The links that were not found yet, of each inode with several links.
+    pending: dict[Inode, int] = {}
+    stack = [path]
+
+    while stack:
+        dir_ = stack.pop()
+
+        try:
+            entries = list(os.scandir(dir_))
+        except OSError as e:
+            log.warning(f"    Warning: Could not scan dir: {dir_}: {e}")
+            continue
+
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if st.st_dev != top.st_dev:
+                continue
+
+            size = st.st_blocks * 512
+            weighted += size / st.st_nlink
+
+            if stat.S_ISDIR(st.st_mode):
+                scan.exclusive += size
+                stack.append(entry.path)
+                continue
+
+            scan.files += 1
+
+            if st.st_nlink == 1:
+                scan.exclusive += size
+                continue
+
+            remaining = pending.pop(st.st_ino, None)
+
+            if remaining is None:
+                remaining = st.st_nlink
+                scan.shared += size
+
+            if remaining > 1:
+                pending[st.st_ino] = remaining - 1
+            else:
+                scan.shared -= size
+                scan.exclusive += size
+
+    scan.weighted = round(weighted)
+
+    return scan
+
+
+def _get_snapshot_dirs(backup_root: BackupRoot, state_dir: StateDir) -> list[str]:
+    """
+    Get the snapshot dirs of a backup root. Shared references to other
+    snapshots are left out.
+    """
+    with SnapshotIndex(backup_root, state_dir) as index:
+        return [entry.dir for entry in index.get_all() if entry.target is None]
+
+
+def _get_scans(
+    backup_root: BackupRoot, state_dir: StateDir, dirs: list[str]
+) -> tuple[dict[str, _TreeScan], int]:
+    """
+    Get the scans of 'backup.latest' and the given snapshots and the amount
+    of trees that were not in the cache.
+    """
+    keys: dict[str, TreeKey] = {}
+
+    for dir_ in dirs:
+        try:
+            keys[dir_] = _get_key(f"{backup_root}/{dir_}")
+        except OSError:
+            continue
+
+    generation = sorted(keys.values())
+    cache = _load_cache(state_dir, generation)
+    scans: dict[str, _TreeScan] = {}
+    scanned = 0
+
+    for dir_ in [_LATEST] + list(keys):
+        path = f"{backup_root}/{dir_}"
+
+        if dir_ in keys and keys[dir_] in cache:
+            scans[dir_] = cache[keys[dir_]]
+            continue
+
+        log.debug(log.lvl1_ts_msg(f"Scan disk usage of: {path}"))
+
+        try:
+            scans[dir_] = _scan_tree(path)
+        except OSError:
+            continue
+
+        scanned += 1
+
+    _save_cache(
+        state_dir,
+        generation,
+        (scan for dir_, scan in scans.items() if dir_ != _LATEST),
+    )
+
+    return scans, scanned
+
+
+def invalidate(
+    backup_root: BackupRoot, state_dir: StateDir, dirs: Iterable[str]
+) -> None:
+    """
+    Drop the cached scans of trees whose files were replaced in place, e.g. by
+    'vhpi dedupe'. Their top dirs keep their mtime, so the cache can't tell.
+    """
+    generation, scans = _read_cache(state_dir)
+
+    if not scans:
+        return
+
+    keys = set()
+
+    for dir_ in dirs:
+        try:
+            keys.add(_get_key(f"{backup_root}/{dir_}"))
+        except OSError:
+            continue
+
+    _save_cache(state_dir, generation, (s for s in scans if s.key not in keys))
+
+
+def get_usage(backup_root: BackupRoot, state_dir: StateDir) -> RootUsage:
+    """
+    Get the exclusive and shared bytes of each snapshot in a backup root.
+
+    Only compact totals of each snapshot are cached in the state dir. They
+    stay valid until a snapshot is added or removed, so between two snapshot
+    runs only 'backup.latest' is walked.
+
+    Files that are also linked outside of the backup root (e.g. by 'vhpi
+    dedupe') count as shared.
+    """
+    start = time.time()
+    usage = RootUsage()
+    dirs = _get_snapshot_dirs(backup_root, state_dir)
+    scans, usage.scanned = _get_scans(backup_root, state_dir, dirs)
+
+    for dir_, scan in scans.items():
+        usage.trees.append(
+            TreeUsage(
+                dir=dir_,
+                files=scan.files,
+                exclusive=scan.exclusive,
+                shared=scan.shared,
+            )
+        )
+        usage.total += scan.weighted
+
+    usage.duration = round(time.time() - start, 3)
+
+    return usage